@@ -0,0 +1,147 @@
+"""Helpers for the JSON API under /api/v1.
+
+The API serves the data on the home and profile pages to clients that
+render it themselves (the mobile apps, the SPA), without paying for
+Jinja rendering. Its queries select only the columns in the response, so
+no ORM objects are built, and the rows are written straight out as
+compact JSON.
+
+Messages carry just their author's user_id. Clients fetch the authors they
+haven't seen yet in one request, with /api/v1/users?ids=1,2,3.
+
+Lists of messages use the same keyset cursors as the HTML pages: pass a
+page's `next` back as ?before= to get the page after it.
+"""
+
+import json
+from datetime import datetime
+
+from flask import Response, request
+
+from models import db, Message, TimelineEntry, User
+from pagination import paginate_messages
+
+API_PAGE_SIZE = 20
+API_MAX_PAGE_SIZE = 100
+
+# Most users that one ?ids= request can ask for.
+API_MAX_IDS = 100
+
+MESSAGE_FIELDS = (
+    Message.id,
+    Message.text,
+    Message.timestamp,
+    Message.user_id,
+    Message.like_count,
+)
+
+USER_FIELDS = (
+    User.id,
+    User.username,
+    User.image_url,
+    User.header_image_url,
+    User.bio,
+    User.location,
+    User.messages_count,
+    User.following_count,
+    User.followers_count,
+    User.likes_count,
+)
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+
+    raise TypeError(f"Can't serialize {type(value).__name__}")
+
+
+def json_response(payload, status=200):
+    """Return `payload` as a compact JSON response."""
+
+    return Response(json.dumps(payload,
+                               separators=(",", ":"),
+                               ensure_ascii=False,
+                               default=_encode),
+                    status=status,
+                    mimetype="application/json")
+
+
+def api_error(status, message):
+    """Return a JSON error response."""
+
+    return json_response({"error": message}, status)
+
+
+def page_size():
+    """Return the ?limit= page size, clamped to 1..API_MAX_PAGE_SIZE."""
+
+    try:
+        limit = int(request.args.get("limit", API_PAGE_SIZE))
+    except ValueError:
+        return API_PAGE_SIZE
+
+    return max(1, min(limit, API_MAX_PAGE_SIZE))
+
+
+def parse_ids(raw):
+    """Turn "1,2,3" into [1, 2, 3], without duplicates.
+
+    Raises ValueError if there are none, more than API_MAX_IDS, or one
+    isn't an id. Callers word the error for what the ids are of.
+    """
+
+    try:
+        ids = list(dict.fromkeys(int(part) for part in raw.split(",") if part))
+    except ValueError:
+        ids = []
+
+    if not ids or len(ids) > API_MAX_IDS:
+        raise ValueError(f"Expected 1 to {API_MAX_IDS} comma-separated ids.")
+
+    return ids
+
+
+def message_page(query, timestamp=Message.timestamp, message_id=Message.id):
+    """Return a page of the MESSAGE_FIELDS rows of `query`, newest first,
+    as {"messages": [...], "next": cursor or null}."""
+
+    page = paginate_messages(query,
+                             request.args.get("before"),
+                             per_page=page_size(),
+                             timestamp=timestamp,
+                             message_id=message_id)
+
+    return {"messages": [row._asdict() for row in page.items],
+            "next": page.next_cursor}
+
+
+def timeline_messages(user_id):
+    """Return the columns query for a user's home timeline; page it with
+    the TimelineEntry key columns."""
+
+    return (db.session
+            .query(Message.id, Message.text, TimelineEntry.timestamp,
+                   Message.user_id, Message.like_count)
+            .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+            .join(User, User.id == Message.user_id)
+            .filter(TimelineEntry.user_id == user_id,
+                    User.deleted_at.is_(None)))
+
+
+def user_messages(user_id):
+    """Return the columns query for the messages `user_id` posted."""
+
+    return db.session.query(*MESSAGE_FIELDS).filter(Message.user_id == user_id)
+
+
+def users_by_id(ids):
+    """Return the USER_FIELDS of the users with `ids` as dicts, in the
+    order of `ids`; ids with no user, or a deleted one, are left out."""
+
+    rows = (db.session
+            .query(*USER_FIELDS)
+            .filter(User.id.in_(ids), User.deleted_at.is_(None)))
+    users = {row.id: row._asdict() for row in rows}
+
+    return [users[user_id] for user_id in ids if user_id in users]
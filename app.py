@@ -1,12 +1,35 @@
 import os
+from datetime import datetime
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+from flask import (
+    Flask, render_template, request, flash, redirect, session, g, abort)
 from flask_debugtoolbar import DebugToolbarExtension
-from flask_bcrypt import Bcrypt
+from sqlalchemy import func, select
 from sqlalchemy.exc import IntegrityError
+from werkzeug.middleware.proxy_fix import ProxyFix
 
+from api import (
+    API_MAX_IDS, api_error, json_response, message_page, parse_ids,
+    timeline_messages, user_messages, users_by_id)
 from forms import CSRFOnlyForm, EditUserForm, UserAddForm, LoginForm, MessageForm
-from models import db, connect_db, User, Message
+from assets import StaticAssets, build as build_static_assets
+from caching import apply_cache_policy, render_conditional
+from compression import CompressionMiddleware
+from fragments import FragmentCache
+from metrics import RequestMetrics
+from models import (
+    db, connect_db, User, Message, Follows, Likes, TimelineEntry, MessageTerm)
+from pagination import paginate_messages, paginate_users, StreamedPage
+from passwords import password_hasher, PasswordHasherBusy
+from purge import UserPurger
+from rate_limit import AuthRateLimiter, RateLimited
+from replicas import ReadReplicas
+from search import search_messages, search_users
+from streaming import stream_template
+from user_cache import UserCache
+
+import migrations
 
 import dotenv
 dotenv.load_dotenv()
@@ -15,19 +38,94 @@ CURR_USER_KEY = "curr_user"
 
 app = Flask(__name__)
 
-bcrypt= Bcrypt()
-
 # Get DB_URI from environ variable (useful for production/testing) or,
 # if not set there, use development local db.
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ['DATABASE_URL'].replace("postgres://", "postgresql://"))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
+# Request threads per gunicorn worker; the Procfile passes it to --threads.
+app.config['WEB_THREADS'] = int(os.environ.get('WEB_THREADS', 8))
+# Connection pool per engine and process, one connection per thread.
+# SQLite engines ignore the sizing (see replicas.RoutingSQLAlchemy).
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': int(os.environ.get('DATABASE_POOL_SIZE',
+                                    app.config['WEB_THREADS'])),
+    'max_overflow': int(os.environ.get('DATABASE_MAX_OVERFLOW', 4)),
+    'pool_timeout': float(os.environ.get('DATABASE_POOL_TIMEOUT', 10)),
+    'pool_recycle': int(os.environ.get('DATABASE_POOL_RECYCLE', 1800)),
+    'pool_pre_ping': os.environ.get('DATABASE_POOL_PRE_PING', '1') == '1',
+}
+# Comma-separated read replica URLs; see replicas.py.
+app.config['DATABASE_REPLICA_URLS'] = [
+    url.strip().replace("postgres://", "postgresql://")
+    for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+    if url.strip()]
+app.config['REPLICA_STICKY_SECONDS'] = float(
+    os.environ.get('REPLICA_STICKY_SECONDS', 5))
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 1024))
+app.config['USER_CACHE_TTL'] = float(os.environ.get('USER_CACHE_TTL', 30))
+app.config['FRAGMENT_CACHE_SIZE'] = int(
+    os.environ.get('FRAGMENT_CACHE_SIZE', 10_000))
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['BCRYPT_WORKERS'] = int(os.environ.get('BCRYPT_WORKERS', 2))
+# Hashes running or queued per process; must be below WEB_THREADS (see
+# passwords.py). Past it, requests get a 503 after BCRYPT_QUEUE_WAIT seconds.
+app.config['BCRYPT_MAX_PENDING'] = int(os.environ.get(
+    'BCRYPT_MAX_PENDING', app.config['WEB_THREADS'] // 2))
+app.config['BCRYPT_QUEUE_WAIT'] = float(
+    os.environ.get('BCRYPT_QUEUE_WAIT', 0))
+app.config['AUTH_RATE_LIMIT_DB'] = os.environ.get('AUTH_RATE_LIMIT_DB')
+# Proxies in front of gunicorn that append to X-Forwarded-For: 1 for the
+# Heroku router. request.remote_addr (which keys the per-IP rate limits) is
+# the address the outermost of them saw; entries before it are whatever the
+# client sent, and are ignored. 0 when gunicorn is reached directly, or
+# anyone could pick their own IP bucket.
+app.config['TRUSTED_PROXY_HOPS'] = int(
+    os.environ.get('TRUSTED_PROXY_HOPS', 1))
+app.config['USERS_DIRECTORY_PAGE_SIZE'] = int(
+    os.environ.get('USERS_DIRECTORY_PAGE_SIZE', 48))
+app.config['COMPRESS_LEVEL'] = int(os.environ.get('COMPRESS_LEVEL', 6))
+app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 500))
+# Accounts whose delete cascades to more rows than this are purged in the
+# background, about USER_PURGE_BATCH_SIZE rows per transaction; see purge.py.
+app.config['USER_PURGE_THRESHOLD'] = int(
+    os.environ.get('USER_PURGE_THRESHOLD', 10_000))
+app.config['USER_PURGE_BATCH_SIZE'] = int(
+    os.environ.get('USER_PURGE_BATCH_SIZE', 10_000))
+# Bearer token a Prometheus scraper must send to read /metrics; unset, the
+# endpoint is a 404. See metrics.py.
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
 toolbar = DebugToolbarExtension(app)
 
+# Registered before the other request hooks so their queries are counted.
+metrics = RequestMetrics(app)
+
 connect_db(app)
+# Registered before add_user_to_g, so loading g.user reads from a replica.
+replicas = ReadReplicas(app)
+metrics.register_collector(replicas.render_metrics)
+password_hasher.init_app(app)
+auth_limiter = AuthRateLimiter(app)
+metrics.register_collector(auth_limiter.render_metrics)
+fragment_cache = FragmentCache(app)
+static_assets = StaticAssets(app)
+metrics.register_collector(fragment_cache.render_metrics)
+
+user_cache = UserCache(maxsize=app.config['USER_CACHE_SIZE'],
+                       ttl=app.config['USER_CACHE_TTL'])
+metrics.register_collector(user_cache.render_metrics)
+user_purger = UserPurger(app)
+metrics.register_collector(user_purger.render_metrics)
+
+if app.config['TRUSTED_PROXY_HOPS']:
+    app.wsgi_app = ProxyFix(app.wsgi_app,
+                            x_for=app.config['TRUSTED_PROXY_HOPS'])
+app.wsgi_app = CompressionMiddleware(app.wsgi_app,
+                                     level=app.config['COMPRESS_LEVEL'],
+                                     min_size=app.config['COMPRESS_MIN_SIZE'])
 
 
 
@@ -42,7 +140,12 @@ def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = user_cache.get(session[CURR_USER_KEY])
+
+        # Deleted elsewhere (another browser) and waiting to be purged.
+        if g.user is not None and g.user.deleted_at is not None:
+            do_logout()
+            g.user = None
 
     else:
         g.user = None
@@ -66,6 +169,31 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
+def active_user_or_404(user_id):
+    """Return the user with `user_id`; 404 if there's none, or if they
+    deleted their account and it's waiting to be purged."""
+
+    user = User.query.get_or_404(user_id)
+
+    if user.deleted_at is not None:
+        abort(404)
+
+    return user
+
+
+def ids_from_request(single_id):
+    """Return [single_id] if given, else the ids in the form's `ids`.
+
+    Raises ValueError if `ids` isn't a comma-separated list of up to
+    API_MAX_IDS ids.
+    """
+
+    if single_id is not None:
+        return [single_id]
+
+    return parse_ids(request.form.get('ids', ''))
+
+
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
@@ -81,6 +209,8 @@ def signup():
     form = UserAddForm()
 
     if form.validate_on_submit():
+        auth_limiter.check(request.remote_addr, form.username.data)
+
         try:
             user = User.signup(
                 username=form.username.data,
@@ -110,10 +240,15 @@ def login():
     form = LoginForm()
 
     if form.validate_on_submit():
+        auth_limiter.check(request.remote_addr, form.username.data)
+
         user = User.authenticate(form.username.data,
                                  form.password.data)
 
         if user:
+            # authenticate may have upgraded the stored hash's cost.
+            db.session.commit()
+            user_cache.invalidate(user.id)
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -123,6 +258,24 @@ def login():
     return render_template('users/login.html', form=form)
 
 
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(error):
+    """Too many password hashes are queued; ask the client to retry."""
+
+    return ("Too many sign-in attempts are in progress. Please try again.",
+            503,
+            {"Retry-After": "1"})
+
+
+@app.errorhandler(RateLimited)
+def rate_limited(error):
+    """Too many auth attempts from this IP or for this username."""
+
+    return ("Too many attempts. Please wait and try again.",
+            429,
+            {"Retry-After": str(error.retry_after)})
+
+
 @app.post('/logout')
 def logout():
     """Handle logout of user."""
@@ -147,7 +300,12 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search usernames, bios and
+    locations.
+
+    The directory is streamed: users are read off a server-side cursor in
+    batches while the page renders, so memory stays flat however large
+    USERS_DIRECTORY_PAGE_SIZE is.
     """
 
     if not g.user:
@@ -157,11 +315,16 @@ def list_users():
     search = request.args.get('q')
 
     if not search:
-        users = User.query.all()
+        page = StreamedPage(
+            User.query.filter(User.deleted_at.is_(None)),
+            request.args.get('after'),
+            per_page=app.config['USERS_DIRECTORY_PAGE_SIZE'],
+            on_batch=lambda users: g.user.preload_membership(users=users))
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        page = search_users(search, request.args.get('after'))
+        g.user.preload_membership(users=page.items)
 
-    return render_template('users/index.html', users=users)
+    return stream_template('users/index.html', page=page)
 
 
 @app.get('/users/<int:user_id>')
@@ -172,9 +335,22 @@ def users_show(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = active_user_or_404(user_id)
+    # Every message here is by `user`, which is already in the session, so
+    # `message.user` is an identity-map hit and needs no eager load.
+    page = paginate_messages(Message.query.filter_by(user_id=user.id),
+                             request.args.get('before'))
+    g.user.preload_membership(users=[user], messages=page.items)
 
-    return render_template('users/show.html', user=user)
+    return render_conditional(
+        (g.user.cache_key(),
+         user.cache_key(),
+         [(message.id, message.like_count) for message in page.items],
+         g.user.membership_key()),
+        'users/show.html',
+        user=user,
+        messages=page.items,
+        next_cursor=page.next_cursor)
 
 
 @app.get('/users/<int:user_id>/following')
@@ -185,8 +361,24 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = active_user_or_404(user_id)
+    query = (User
+             .query
+             .join(Follows, Follows.user_being_followed_id == User.id)
+             .filter(Follows.user_following_id == user.id,
+                     User.deleted_at.is_(None)))
+    page = paginate_users(query, request.args.get('after'))
+    g.user.preload_membership(users=[user, *page.items])
+
+    return render_conditional(
+        (g.user.cache_key(),
+         user.cache_key(),
+         [followed.cache_key() for followed in page.items],
+         g.user.membership_key()),
+        'users/following.html',
+        user=user,
+        users=page.items,
+        next_cursor=page.next_cursor)
 
 
 @app.get('/users/<int:user_id>/followers')
@@ -197,13 +389,31 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
-
-
+    user = active_user_or_404(user_id)
+    query = (User
+             .query
+             .join(Follows, Follows.user_following_id == User.id)
+             .filter(Follows.user_being_followed_id == user.id,
+                     User.deleted_at.is_(None)))
+    page = paginate_users(query, request.args.get('after'))
+    g.user.preload_membership(users=[user, *page.items])
+
+    return render_conditional(
+        (g.user.cache_key(),
+         user.cache_key(),
+         [follower.cache_key() for follower in page.items],
+         g.user.membership_key()),
+        'users/followers.html',
+        user=user,
+        users=page.items,
+        next_cursor=page.next_cursor)
+
+
+@app.post('/users/follow')
 @app.post('/users/follow/<int:follow_id>')
-def add_follow(follow_id):
-    """Add a follow for the currently-logged-in user."""
+def add_follow(follow_id=None):
+    """Have the currently-logged-in user follow `follow_id`, or every user
+    in the form's comma-separated `ids`."""
 
     form = g.csrf_form
 
@@ -211,12 +421,22 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    # Read before the commit expires g.user, which would reload it.
+    user_id = g.user.id
+
     if form.validate_on_submit():
-        followed_user = User.query.get_or_404(follow_id)
-        g.user.following.append(followed_user)
+        try:
+            user_ids = ids_from_request(follow_id)
+        except ValueError:
+            flash(f"Pick between 1 and {API_MAX_IDS} users to follow.",
+                  "danger")
+            return redirect(f"/users/{user_id}/following")
+
+        followed_ids = g.user.follow(user_ids)
         db.session.commit()
+        user_cache.invalidate(user_id, *followed_ids)
 
-    return redirect(f"/users/{g.user.id}/following")
+    return redirect(f"/users/{user_id}/following")
 
 
 @app.post('/users/stop-following/<int:follow_id>')
@@ -230,9 +450,9 @@ def stop_following(follow_id):
         return redirect("/")
 
     if form.validate_on_submit():
-        followed_user = User.query.get(follow_id)
-        g.user.following.remove(followed_user)
+        unfollowed_ids = g.user.unfollow([follow_id])
         db.session.commit()
+        user_cache.invalidate(g.user.id, *unfollowed_ids)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -244,13 +464,24 @@ def show_user_likes(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template("/users/liked_messages.html", user=user)
+    user = active_user_or_404(user_id)
+    query = (Message
+             .published()
+             .join(Likes, Likes.message_liked_id == Message.id)
+             .filter(Likes.user_liking_id == user.id))
+    page = paginate_messages(query, request.args.get('before'))
+    g.user.preload_membership(users=[user], messages=page.items)
+
+    return render_template("/users/liked_messages.html",
+                           user=user,
+                           messages=page.items,
+                           next_cursor=page.next_cursor)
 
+@app.post('/messages/likes')
 @app.post('/messages/likes/<int:unliked_message_id>')
-def add_like(unliked_message_id):
-    """Add a like for the message chosen by the currently-logged-in user."""
-    # TODO: like and unlike could be handled as functions on the model.
+def add_like(unliked_message_id=None):
+    """Have the currently-logged-in user like `unliked_message_id`, or every
+    message in the form's comma-separated `ids`."""
 
     form = g.csrf_form
 
@@ -259,11 +490,18 @@ def add_like(unliked_message_id):
         return redirect("/")
 
     if form.validate_on_submit():
-        unliked_message = Message.query.get_or_404(unliked_message_id)
-        g.user.liked_messages.append(unliked_message)
-        db.session.commit()
+        try:
+            message_ids = ids_from_request(unliked_message_id)
+        except ValueError:
+            flash(f"Pick between 1 and {API_MAX_IDS} messages to like.",
+                  "danger")
+            return redirect(f"/users/{g.user.id}/likes")
 
-    return redirect(f"/users/{g.user.id}/likes") 
+        if g.user.like(message_ids):
+            db.session.commit()
+            user_cache.invalidate(g.user.id)
+
+    return redirect(f"/users/{g.user.id}/likes")
 
 
 @app.post('/messages/unlikes/<int:liked_message_id>')
@@ -277,9 +515,9 @@ def remove_like(liked_message_id):
         return redirect("/")
 
     if form.validate_on_submit():
-        liked_message = Message.query.get(liked_message_id)
-        g.user.liked_messages.remove(liked_message)
-        db.session.commit()
+        if g.user.unlike([liked_message_id]):
+            db.session.commit()
+            user_cache.invalidate(g.user.id)
 
     return redirect(f"/users/{g.user.id}/likes")
 
@@ -296,8 +534,10 @@ def edit_user_profile():
     form = EditUserForm(obj=g.user)
 
     if form.validate_on_submit():
+        auth_limiter.check(request.remote_addr, g.user.username)
+
         #check if entered password is correct, if not, return error
-        if bcrypt.check_password_hash(g.user.password, form.validate_password.data):
+        if password_hasher.check(g.user.password, form.validate_password.data):
             #try to update details, if integrity error, it's because UN is not unique
             try:
                 g.user.username = form.username.data  
@@ -306,8 +546,10 @@ def edit_user_profile():
                 g.user.header_image_url = form.header_image_url.data or "/static/images/warbler-hero.jpg"
                 g.user.bio = form.bio.data
                 g.user.location = form.location.data
+                g.user.version = User.version + 1
 
                 db.session.commit()
+                user_cache.invalidate(g.user.id)
 
             except IntegrityError:
                 db.session.rollback()
@@ -339,9 +581,23 @@ def delete_user():
 
     if form.validate_on_submit():
         do_logout()
+        user_id = g.user.id
+
+        # Big accounts are hidden now and purged in the background; the
+        # rest go in one DELETE that the database cascades. Other users'
+        # counters are updated either way; their cached snapshots catch up
+        # within USER_CACHE_TTL.
+        if user_purger.too_big(g.user):
+            User.query.filter_by(id=user_id).update(
+                {User.deleted_at: datetime.utcnow()},
+                synchronize_session=False)
+            db.session.commit()
+            user_purger.schedule(user_id)
+        else:
+            User.delete_account(user_id)
+            db.session.commit()
 
-        db.session.delete(g.user)
-        db.session.commit()
+        user_cache.invalidate(user_id)
 
     return redirect("/signup")
 
@@ -365,13 +621,36 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        TimelineEntry.fan_out(msg)
+        MessageTerm.index(msg)
+        User.change_counts([g.user.id], messages_count=1)
         db.session.commit()
+        user_cache.invalidate(g.user.id)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
+@app.get('/messages/search')
+def messages_search():
+    """Search messages for the words in the 'q' querystring param."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    search = request.args.get('q', '')
+    page = search_messages(search, request.args.get('before'))
+    g.user.preload_membership(messages=page.items)
+
+    return render_template('messages/search.html',
+                           search=search,
+                           messages=page.items,
+                           next_cursor=page.next_cursor)
+
+
 @app.get('/messages/<int:message_id>')
 def messages_show(message_id):
     """Show a message."""
@@ -380,8 +659,23 @@ def messages_show(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = (Message
+           .published()
+           .filter(Message.id == message_id)
+           .first_or_404())
+
+    # The follow and like buttons only show on other people's messages.
+    if msg.user_id != g.user.id:
+        g.user.preload_membership(users=[msg.user], messages=[msg])
+
+    return render_conditional(
+        (g.user.cache_key(),
+         msg.id,
+         msg.like_count,
+         msg.user.cache_key(),
+         g.user.membership_key()),
+        'messages/show.html',
+        message=msg)
 
 
 @app.post('/messages/<int:message_id>/delete')
@@ -395,13 +689,83 @@ def messages_destroy(message_id):
         return redirect("/")
 
     if form.validate_on_submit():
-        msg = Message.query.get(message_id)
-        db.session.delete(msg)
+        # One DELETE, cascaded by the database to the message's likes,
+        # timeline entries and search postings.
+        deleted = Message.delete_many([message_id])
         db.session.commit()
+        fragment_cache.invalidate(message_id)
+        # Likers' likes_count changed too; their snapshots catch up
+        # within USER_CACHE_TTL.
+        user_cache.invalidate(*[row.user_id for row in deleted])
 
     return redirect(f"/users/{g.user.id}")
 
 
+##############################################################################
+# JSON API (see api.py)
+
+
+@app.get('/api/v1/timeline')
+def api_timeline():
+    """The logged-in user's home timeline, newest first."""
+
+    if not g.user:
+        return api_error(401, "Log in first.")
+
+    return json_response(message_page(timeline_messages(g.user.id),
+                                      timestamp=TimelineEntry.timestamp,
+                                      message_id=TimelineEntry.message_id))
+
+
+@app.get('/api/v1/users')
+def api_users():
+    """The users listed in ?ids=, e.g. the authors of a page of messages."""
+
+    if not g.user:
+        return api_error(401, "Log in first.")
+
+    try:
+        ids = parse_ids(request.args.get('ids', ''))
+    except ValueError:
+        return api_error(400, f"Pass ?ids= between 1 and {API_MAX_IDS} "
+                              f"comma-separated user ids.")
+
+    return json_response({"users": users_by_id(ids)})
+
+
+@app.get('/api/v1/users/<int:user_id>')
+def api_user(user_id):
+    """One user's profile."""
+
+    if not g.user:
+        return api_error(401, "Log in first.")
+
+    users = users_by_id([user_id])
+
+    if not users:
+        return api_error(404, "No such user.")
+
+    return json_response(users[0])
+
+
+@app.get('/api/v1/users/<int:user_id>/messages')
+def api_user_messages(user_id):
+    """The messages a user posted, newest first."""
+
+    if not g.user:
+        return api_error(401, "Log in first.")
+
+    exists = (db.session
+              .query(User.id)
+              .filter_by(id=user_id, deleted_at=None)
+              .scalar())
+
+    if exists is None:
+        return api_error(404, "No such user.")
+
+    return json_response(message_page(user_messages(user_id)))
+
+
 ##############################################################################
 # Homepage and error pages
 
@@ -414,35 +778,125 @@ def homepage():
     - logged in: 100 most recent messages of followed_users
     """
 
-    if g.user:       
-        # followers = g.user.following, use list comprehension to get ids of those people plus themselves
-        # # then filter for message.user.followers are in that list
-        follower_ids = [u.id for u in g.user.following] + [g.user.id]
+    if g.user:
+        # The home timeline is materialized on write (see TimelineEntry),
+        # so this is a range read on the user's own entries.
+        page = paginate_messages(TimelineEntry.timeline(g.user.id),
+                                 request.args.get('before'),
+                                 per_page=100,
+                                 timestamp=TimelineEntry.timestamp,
+                                 message_id=TimelineEntry.message_id)
+        g.user.preload_membership(messages=page.items)
 
-        messages = (Message
-                    .query
-                    # .filter(Message.user_id.in_(follower_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        # breakpoint()
-        return render_template('home.html', messages=messages)
+        return render_template('home.html',
+                               messages=page.items,
+                               next_cursor=page.next_cursor)
 
     else:
         return render_template('home-anon.html')
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# Maintenance commands (run with `flask <command>`)
+
+
+@app.cli.command("migrate")
+def migrate():
+    """Bring the database schema up to date (see migrations/)."""
+
+    applied = migrations.upgrade(db.engine, db.metadata)
+
+    for name in applied:
+        print(f"Applied {name}")
+
+    print(f"Schema is up to date ({len(migrations.migrations())} migrations).")
+
+
+@app.cli.command("rebuild-timelines")
+def rebuild_timelines():
+    """Recompute every user's home timeline from messages and follows."""
+
+    TimelineEntry.rebuild()
+    db.session.commit()
+    print(f"Rebuilt {TimelineEntry.query.count()} timeline entries.")
+
+
+@app.cli.command("rebuild-message-index")
+def rebuild_message_index():
+    """Recompute the message search index from the messages table."""
+
+    MessageTerm.rebuild()
+    db.session.commit()
+    print(f"Indexed {MessageTerm.query.count()} message terms.")
+
+
+@app.cli.command("build-assets")
+def build_assets():
+    """Write fingerprinted, gzipped copies of static/ to static/dist/."""
+
+    manifest = build_static_assets(app.static_folder)
+    print(f"Built {len(manifest)} static assets.")
+
+
+@app.cli.command("reconcile-counters")
+@click.option("--batch-size", default=10_000,
+              help="Messages to recompute per transaction.")
+def reconcile_counters(batch_size):
+    """Recompute the denormalized user and message counters and report
+    drift."""
+
+    drift = User.reconcile_counters()
+    db.session.commit()
+
+    for name, users_fixed in drift.items():
+        print(f"{name}: fixed {users_fixed} user(s)")
+
+    # There are far more messages than users, so they go in id ranges,
+    # each in a short transaction of its own.
+    last_id = db.session.query(func.max(Message.id)).scalar() or 0
+    messages_fixed = 0
+
+    for start in range(0, last_id, batch_size):
+        ids = select(Message.id).where(Message.id > start,
+                                       Message.id <= start + batch_size)
+        messages_fixed += Message.reconcile_counters(ids)['like_count']
+        db.session.commit()
+
+    print(f"like_count: fixed {messages_fixed} message(s)")
+
+
+@app.cli.command("purge-deleted-users")
+@click.option("--batch-size", default=None, type=int,
+              help="About how many rows to delete per transaction "
+                   "(default: USER_PURGE_BATCH_SIZE).")
+def purge_deleted_users(batch_size):
+    """Finish purging the accounts marked deleted (see purge.py)."""
+
+    if batch_size:
+        user_purger.batch_size = batch_size
+
+    user_ids = [user_id for (user_id,) in (db.session
+                                           .query(User.id)
+                                           .filter(User.deleted_at.isnot(None))
+                                           .order_by(User.id))]
+    db.session.commit()
+
+    for user_id in user_ids:
+        messages = user_purger.purge(user_id)
+        print(f"Purged user {user_id} ({messages} message(s))")
+
+    print(f"Purged {len(user_ids)} user(s).")
+
+
+##############################################################################
+# HTTP caching
 #
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Each endpoint's Cache-Control comes from caching.CACHE_POLICIES; anything
+# not listed there is `no-store`.
 
 @app.after_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Add this endpoint's caching headers to the response."""
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
-    return response
+    return apply_cache_policy(response)
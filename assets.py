@@ -0,0 +1,169 @@
+"""Fingerprinted, precompressed static assets.
+
+`flask build-assets` copies every file under static/ to static/dist/ with a
+hash of its contents in the name (style.css -> style.3f2a9c0d1e4b.css), and
+writes a gzipped copy next to each text file. A manifest maps the original
+paths to the hashed ones. Stylesheets are rewritten to point at the hashed
+names of the images they use before they are hashed themselves.
+
+Templates link assets through static_url(), which returns the hashed URL
+when a manifest exists and the plain /static/ URL otherwise (e.g. in
+development before the first build). A hashed file never changes, so it is
+served as immutable and cached for a year; the gzipped copy is sent to
+clients that accept it.
+"""
+
+import gzip
+import json
+import mimetypes
+import os
+import re
+import shutil
+from hashlib import sha256
+
+from flask import request, send_from_directory, url_for
+
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+
+# Extensions worth precompressing; images are already compressed.
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.txt', '.json', '.map'}
+
+# url("/static/...") references inside stylesheets.
+CSS_URL_RE = re.compile(r"""url\(\s*(['"]?)/static/([^'")]+)\1\s*\)""")
+
+
+def fingerprint(path, content):
+    """Return `path` with a hash of `content` before its extension."""
+
+    root, ext = os.path.splitext(path)
+    return f"{root}.{sha256(content).hexdigest()[:12]}{ext}"
+
+
+def build(static_folder, dist_folder=None):
+    """Write hashed (and gzipped) copies of the files in `static_folder`.
+
+    Returns the manifest, {original path: hashed path}, paths being
+    relative to `static_folder` with forward slashes.
+    """
+
+    dist_folder = os.path.abspath(
+        dist_folder or os.path.join(static_folder, DIST_DIR))
+    paths = []
+
+    for dirpath, dirnames, filenames in os.walk(static_folder):
+        # Don't fingerprint the output of an earlier build.
+        dirnames[:] = [
+            name for name in dirnames
+            if os.path.abspath(os.path.join(dirpath, name)) != dist_folder]
+
+        for filename in filenames:
+            full_path = os.path.join(dirpath, filename)
+            paths.append(os.path.relpath(full_path, static_folder)
+                         .replace(os.sep, '/'))
+
+    # Stylesheets embed the hashed names of other assets, so go last.
+    paths.sort(key=lambda path: (path.endswith('.css'), path))
+
+    if os.path.isdir(dist_folder):
+        shutil.rmtree(dist_folder)
+
+    manifest = {}
+
+    for path in paths:
+        with open(os.path.join(static_folder, path), 'rb') as f:
+            content = f.read()
+
+        if path.endswith('.css'):
+            content = CSS_URL_RE.sub(
+                lambda match: 'url("/static/{}/{}")'.format(
+                    DIST_DIR, manifest.get(match[2], match[2])),
+                content.decode('utf-8')).encode('utf-8')
+
+        hashed = fingerprint(path, content)
+        manifest[path] = hashed
+        dest = os.path.join(dist_folder, hashed)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+
+        with open(dest, 'wb') as f:
+            f.write(content)
+
+        if os.path.splitext(path)[1] in COMPRESSIBLE:
+            # mtime=0 keeps the output identical between builds.
+            with open(dest + '.gz', 'wb') as f:
+                f.write(gzip.compress(content, compresslevel=9, mtime=0))
+
+    with open(os.path.join(dist_folder, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+class StaticAssets:
+    """Serves built assets and provides the static_url() template helper."""
+
+    def __init__(self, app=None):
+        self.dist_folder = None
+        self.manifest = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.dist_folder = os.path.join(app.static_folder, DIST_DIR)
+        self.load()
+
+        app.add_template_global(self.static_url)
+        app.add_url_rule(f"{app.static_url_path}/{DIST_DIR}/<path:filename>",
+                         endpoint='hashed_static',
+                         view_func=self.send_hashed)
+
+    def load(self, dist_folder=None):
+        """(Re)read the manifest, e.g. after a build."""
+
+        if dist_folder is not None:
+            self.dist_folder = dist_folder
+
+        try:
+            with open(os.path.join(self.dist_folder, MANIFEST)) as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = {}
+
+    def static_url(self, filename):
+        """Return the URL for static file `filename`, hashed if built."""
+
+        hashed = self.manifest.get(filename)
+
+        if hashed is None:
+            return url_for('static', filename=filename)
+
+        return url_for('hashed_static', filename=hashed)
+
+    def send_hashed(self, filename):
+        """Send a built asset, gzipped if the client accepts it."""
+
+        mimetype = None
+        encoding = None
+
+        if ('gzip' in request.accept_encodings
+                and os.path.isfile(os.path.join(self.dist_folder,
+                                                filename + '.gz'))):
+            mimetype = guess_mimetype(filename)
+            encoding = 'gzip'
+            filename += '.gz'
+
+        response = send_from_directory(self.dist_folder, filename,
+                                       mimetype=mimetype)
+        response.vary.add('Accept-Encoding')
+
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+
+        return response
+
+
+def guess_mimetype(filename):
+    """Return the Content-Type for `filename`, as send_file would."""
+
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
@@ -0,0 +1,112 @@
+"""Benchmark response compression on the largest pages.
+
+Renders home.html (message cards) and users/index.html (user cards) with
+100, 1,000 and 10,000 rows, then streams each page through
+CompressionMiddleware in 8 KiB chunks, as a streamed response would arrive.
+Reports the bytes saved, the time spent compressing, and the transfer time
+saved on a link of BENCH_MBPS megabits/sec.
+
+The rows are built in memory, so no database is touched:
+
+    DATABASE_URL=postgresql:///warbler_bench python benchmarks/compression.py
+"""
+
+import os
+import sys
+from datetime import datetime, timedelta
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import g, render_template  # noqa: E402
+
+from app import app  # noqa: E402
+from compression import CompressionMiddleware  # noqa: E402
+from forms import CSRFOnlyForm  # noqa: E402
+from models import Message, User  # noqa: E402
+from pagination import Page  # noqa: E402
+
+ROWS = [int(n) for n in os.environ.get("BENCH_ROWS", "100,1000,10000").split(",")]
+LEVELS = [int(n) for n in os.environ.get("BENCH_LEVELS", "1,6,9").split(",")]
+MBPS = float(os.environ.get("BENCH_MBPS", 10))
+CHUNK_SIZE = 8 * 1024
+
+
+def make_rows(count):
+    """Return (viewer, users, messages) with `count` users and messages."""
+
+    viewer = User(id=0, username="viewer", email="viewer@example.com",
+                  image_url="/static/images/default-pic.png",
+                  header_image_url="/static/images/warbler-hero.jpg",
+                  version=1, messages_count=0, following_count=count,
+                  followers_count=0, likes_count=count // 2)
+    users = [User(id=i, username=f"user{i}", email=f"user{i}@example.com",
+                  image_url="/static/images/default-pic.png",
+                  header_image_url="/static/images/warbler-hero.jpg",
+                  bio=f"Bio of user {i}, who warbles now and then.",
+                  version=1)
+             for i in range(1, count + 1)]
+    now = datetime.utcnow()
+    messages = [Message(id=i, text=f"Warble number {i} from {user.username}",
+                        timestamp=now - timedelta(minutes=i), user=user)
+                for i, user in enumerate(users, 1)]
+
+    viewer._following_ids = {user.id: user.id % 2 == 0 for user in users}
+    viewer._liked_ids = {msg.id: msg.id % 3 == 0 for msg in messages}
+
+    return viewer, users, messages
+
+
+def render(template, viewer, **context):
+    """Render `template` for `viewer` and return it as bytes."""
+
+    with app.test_request_context("/"):
+        g.user = viewer
+        g.csrf_form = CSRFOnlyForm()
+        return render_template(template, **context).encode("utf-8")
+
+
+def compress(html, level):
+    """Stream `html` through the middleware; return (bytes, seconds)."""
+
+    def page(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/html; charset=utf-8")])
+        return (html[i:i + CHUNK_SIZE] for i in range(0, len(html), CHUNK_SIZE))
+
+    middleware = CompressionMiddleware(page, level=level)
+    environ = {"REQUEST_METHOD": "GET", "HTTP_ACCEPT_ENCODING": "gzip"}
+
+    start = perf_counter()
+    size = sum(len(chunk) for chunk in middleware(environ, lambda *args: None))
+    return size, perf_counter() - start
+
+
+def main():
+    bytes_per_second = MBPS * 1_000_000 / 8
+
+    print(f"{'page':<18}{'rows':>7}{'level':>7}{'raw KiB':>10}"
+          f"{'gz KiB':>9}{'saved':>8}{'gzip ms':>9}{'net ms saved':>14}")
+
+    for count in ROWS:
+        viewer, users, messages = make_rows(count)
+        pages = [
+            ("home.html",
+             render("home.html", viewer, messages=messages, next_cursor=None)),
+            ("users/index.html",
+             render("users/index.html", viewer,
+                    page=Page(users, next_cursor=None))),
+        ]
+
+        for name, html in pages:
+            for level in LEVELS:
+                size, seconds = compress(html, level)
+                saved_ms = (len(html) - size) / bytes_per_second * 1000
+
+                print(f"{name:<18}{count:>7}{level:>7}"
+                      f"{len(html) / 1024:>10.0f}{size / 1024:>9.0f}"
+                      f"{1 - size / len(html):>8.0%}{seconds * 1000:>9.1f}"
+                      f"{saved_ms - seconds * 1000:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""Benchmark deleting a heavy account.
+
+For each size (BENCH_DELETE_SIZES, messages posted by the account) this
+builds a user with that many messages, BENCH_DELETE_FOLLOWERS followers
+who each like BENCH_DELETE_LIKES of them, and the timelines and search
+postings that go with it. Then it deletes the account through POST
+/users/delete, twice, rebuilding the data in between:
+
+- in one request: USER_PURGE_THRESHOLD is raised above the account's
+  size, so the request runs the whole cascading DELETE;
+- in the background: the threshold is set to 0, so the request only
+  marks the account deleted, and the worker thread purges it in
+  transactions of about USER_PURGE_BATCH_SIZE rows (see purge.py).
+
+It reports the request latency, how long the purge took after it, and the
+rows the delete cascaded to.
+
+The tables are dropped and recreated, so run against a scratch database:
+
+    DATABASE_URL=postgresql:///warbler_bench python benchmarks/delete_user.py
+"""
+
+import os
+import sys
+from datetime import datetime, timedelta
+from random import Random
+from time import perf_counter
+
+from sqlalchemy import literal, select, union
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import migrations  # noqa: E402
+from app import app, CURR_USER_KEY, user_purger  # noqa: E402
+from models import (  # noqa: E402
+    db, Follows, Likes, Message, MessageTerm, TimelineEntry, User,
+    TIMELINE_MAX_LENGTH)
+
+SIZES = [int(n) for n in
+         os.environ.get("BENCH_DELETE_SIZES", "1000,100000").split(",")]
+FOLLOWERS = int(os.environ.get("BENCH_DELETE_FOLLOWERS", 1000))
+LIKES = int(os.environ.get("BENCH_DELETE_LIKES", 20))
+
+# Rows per INSERT while loading.
+CHUNK = 10_000
+
+
+def insert(table, rows):
+    """Insert the dicts `rows` into `table`, CHUNK at a time."""
+
+    for start in range(0, len(rows), CHUNK):
+        db.session.execute(table.insert(), rows[start:start + CHUNK])
+
+
+def build_account(messages):
+    """Recreate the tables with one account of `messages` messages and its
+    followers; return the account's id and {table: rows tied to it}."""
+
+    rng = Random(f"delete:{messages}")
+    db.drop_all()
+    db.create_all()
+    migrations.stamp(db.engine)
+
+    users = [dict(id=n,
+                  username=f"bench_delete_{n}",
+                  email=f"bench_delete_{n}@example.com",
+                  password="HASHED_PASSWORD")
+             for n in range(1, FOLLOWERS + 2)]
+    insert(User.__table__, users)
+    account_id = 1
+
+    start = datetime(2024, 1, 1)
+    insert(Message.__table__,
+           [dict(id=n,
+                 text=f"bench message {n} " + " ".join(
+                     f"word{rng.randrange(1000)}" for _ in range(8)),
+                 timestamp=start - timedelta(minutes=n),
+                 user_id=account_id)
+            for n in range(1, messages + 1)])
+
+    follower_ids = range(2, FOLLOWERS + 2)
+    insert(Follows.__table__,
+           [dict(user_being_followed_id=account_id, user_following_id=n)
+            for n in follower_ids])
+    insert(Likes.__table__,
+           [dict(user_liking_id=n, message_liked_id=message_id)
+            for n in follower_ids
+            for message_id in rng.sample(range(1, messages + 1),
+                                         min(LIKES, messages))])
+
+    # Each timeline holds the account's newest messages, which are the
+    # lowest ids here. (TimelineEntry.rebuild() would rank every message
+    # for every follower.)
+    readers = union(
+        select(Follows.user_following_id.label("user_id")),
+        select(literal(account_id).label("user_id"))).subquery()
+    db.session.execute(TimelineEntry.__table__.insert().from_select(
+        ["user_id", "message_id", "timestamp"],
+        select(readers.c.user_id, Message.id, Message.timestamp)
+        .where(Message.id <= TIMELINE_MAX_LENGTH)))
+    MessageTerm.rebuild()
+    User.reconcile_counters()
+    Message.reconcile_counters()
+    db.session.commit()
+
+    with db.engine.connect() as connection:
+        if db.engine.dialect.name == "postgresql":
+            connection.exec_driver_sql("ANALYZE")
+
+    tied = {
+        "messages": messages,
+        "likes": Likes.query.count(),
+        "timeline_entries": TimelineEntry.query.count(),
+        "message_terms": MessageTerm.query.count(),
+        "follows": Follows.query.count(),
+    }
+
+    return account_id, tied
+
+
+def delete_account(account_id, threshold):
+    """POST /users/delete as the account with USER_PURGE_THRESHOLD at
+    `threshold`; return (request seconds, purge seconds after it)."""
+
+    user_purger.threshold = threshold
+    client = app.test_client()
+
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = account_id
+
+    start = perf_counter()
+    resp = client.post("/users/delete")
+    resp.close()
+    request_seconds = perf_counter() - start
+
+    if resp.status_code >= 400:
+        raise RuntimeError(f"POST /users/delete returned {resp.status_code}")
+
+    start = perf_counter()
+    user_purger.join()
+    purge_seconds = perf_counter() - start
+
+    with app.app_context():
+        if User.query.get(account_id) is not None:
+            raise RuntimeError("The account wasn't deleted.")
+
+        drift = User.reconcile_counters()
+        db.session.rollback()
+
+    if any(drift.values()):
+        raise RuntimeError(f"Counters drifted: {drift}")
+
+    return request_seconds, purge_seconds
+
+
+def main():
+    app.config['WTF_CSRF_ENABLED'] = False
+    threshold = user_purger.threshold
+
+    print(f"{'messages':>10}  {'mode':<12}{'request ms':>12}{'purge s':>10}"
+          f"  cascaded rows")
+
+    for size in SIZES:
+        for mode, mode_threshold in (("one request", float("inf")),
+                                     ("background", 0)):
+            with app.app_context():
+                account_id, tied = build_account(size)
+
+            request_seconds, purge_seconds = delete_account(account_id,
+                                                            mode_threshold)
+            rows = ", ".join(f"{name} {count:,}"
+                             for name, count in tied.items())
+            print(f"{size:>10,}  {mode:<12}{request_seconds * 1000:>12.1f}"
+                  f"{purge_seconds:>10.2f}  {rows}", flush=True)
+
+    user_purger.threshold = threshold
+
+
+if __name__ == "__main__":
+    main()
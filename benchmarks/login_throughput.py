@@ -0,0 +1,117 @@
+"""Benchmark login throughput against concurrent page traffic.
+
+Runs login threads (POST /login) and page threads (GET a profile page)
+side by side through the Flask test client, once per password-hasher pool
+size, and reports logins/sec plus page latency. With a small pool, logins
+queue for bcrypt while page latency stays flat; with a pool as large as the
+number of login threads, bcrypt competes with page traffic for every core.
+
+Run against a scratch database:
+
+    DATABASE_URL=postgresql:///warbler_bench python benchmarks/login_throughput.py
+"""
+
+import os
+import sys
+import threading
+from statistics import quantiles
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, CURR_USER_KEY  # noqa: E402
+from models import db, User  # noqa: E402
+from passwords import password_hasher  # noqa: E402
+
+DURATION = float(os.environ.get("BENCH_SECONDS", 10))
+LOGIN_THREADS = int(os.environ.get("BENCH_LOGIN_THREADS", 8))
+PAGE_THREADS = int(os.environ.get("BENCH_PAGE_THREADS", 4))
+POOL_SIZES = [int(n) for n in
+              os.environ.get("BENCH_POOL_SIZES", "1,2,4,8").split(",")]
+
+USERNAME = "bench_login"
+PASSWORD = "bench_password"
+
+
+def ensure_user():
+    """Create the benchmark user if needed and return its id."""
+
+    with app.app_context():
+        db.create_all()
+        user = User.query.filter_by(username=USERNAME).first()
+
+        if user is None:
+            user = User.signup(username=USERNAME,
+                               email="bench_login@example.com",
+                               password=PASSWORD,
+                               image_url=None)
+            db.session.commit()
+
+        return user.id
+
+
+def run(pool_size, user_id):
+    """Run one round at `pool_size`; return (logins/sec, page latencies)."""
+
+    password_hasher.configure(rounds=app.config['BCRYPT_LOG_ROUNDS'],
+                              workers=pool_size,
+                              max_pending=LOGIN_THREADS,
+                              wait=DURATION)
+    stop = perf_counter() + DURATION
+    logins = []
+    page_times = []
+    lock = threading.Lock()
+
+    def login_loop():
+        client = app.test_client()
+        while perf_counter() < stop:
+            resp = client.post("/login", data={"username": USERNAME,
+                                               "password": PASSWORD})
+            if resp.status_code == 302:
+                with lock:
+                    logins.append(1)
+
+    def page_loop():
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        while perf_counter() < stop:
+            start = perf_counter()
+            client.get(f"/users/{user_id}")
+            with lock:
+                page_times.append(perf_counter() - start)
+
+    threads = ([threading.Thread(target=login_loop)
+                for _ in range(LOGIN_THREADS)] +
+               [threading.Thread(target=page_loop)
+                for _ in range(PAGE_THREADS)])
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return len(logins) / DURATION, page_times
+
+
+def main():
+    app.config['WTF_CSRF_ENABLED'] = False
+    user_id = ensure_user()
+
+    print(f"{LOGIN_THREADS} login threads, {PAGE_THREADS} page threads, "
+          f"{DURATION:g}s per run, bcrypt cost "
+          f"{app.config['BCRYPT_LOG_ROUNDS']}\n")
+    print(f"{'pool':>4}  {'logins/s':>8}  {'pages/s':>8}  "
+          f"{'page p50 ms':>11}  {'page p95 ms':>11}")
+
+    for pool_size in POOL_SIZES:
+        login_rate, page_times = run(pool_size, user_id)
+        cuts = quantiles(page_times, n=20)
+        print(f"{pool_size:>4}  {login_rate:>8.1f}  "
+              f"{len(page_times) / DURATION:>8.1f}  "
+              f"{cuts[9] * 1000:>11.1f}  {cuts[18] * 1000:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
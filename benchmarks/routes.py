@@ -0,0 +1,329 @@
+"""Benchmark every route at several dataset sizes.
+
+For each scale (a number of messages, with a tenth as many users and half
+as many follows) this generates a dataset with generator/create_csvs.py,
+loads it with seed.py, and drives each route in app.py through the Flask
+test client as a logged-in user:
+
+- The viewer is the user following the most people, so their timeline is
+  the busiest one.
+- The profile pages belong to the most-followed user.
+- Writes run in pairs that undo each other: follow/unfollow,
+  like/unlike, post/delete and signup/delete account.
+
+Each route reports latency percentiles, SQL queries per request and the
+peak memory Python allocated while serving one request. Results are
+compared with the JSON baseline; a route that got noticeably slower, or
+that runs more queries than it used to, fails the run. Set
+BENCH_SAVE=1 to write the results as the new baseline.
+
+The tables are dropped and recreated, so run against a scratch database:
+
+    DATABASE_URL=postgresql:///warbler_bench python benchmarks/routes.py
+    DATABASE_URL=sqlite:////tmp/warbler_bench.db BENCH_SCALES=1000,100000 \\
+        python benchmarks/routes.py
+"""
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from datetime import datetime
+from statistics import median, quantiles
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app import app, CURR_USER_KEY, auth_limiter  # noqa: E402
+from models import db, Follows, Likes, Message, User  # noqa: E402
+from passwords import password_hasher  # noqa: E402
+from query_budget import QueryCounter  # noqa: E402
+from seed import seed  # noqa: E402
+
+SCALES = [int(n) for n in
+          os.environ.get("BENCH_SCALES", "1000,100000,1000000").split(",")]
+REQUESTS = int(os.environ.get("BENCH_REQUESTS", 50))
+BASELINE = os.environ.get("BENCH_BASELINE",
+                          os.path.join(ROOT, "benchmarks", "baseline.json"))
+SAVE = os.environ.get("BENCH_SAVE") == "1"
+# How much slower (as a fraction) a route's median may get before the run
+# fails; differences under NOISE_MS are ignored whatever the fraction.
+TOLERANCE = float(os.environ.get("BENCH_TOLERANCE", 0.25))
+NOISE_MS = 1.0
+
+PASSWORD = "benchmark"
+METRICS_TOKEN = "benchmark"
+METRICS_AUTH = {"Authorization": f"Bearer {METRICS_TOKEN}"}
+
+
+def build_dataset(messages):
+    """Generate and load a dataset of `messages` messages."""
+
+    with tempfile.TemporaryDirectory() as directory:
+        subprocess.run(
+            [sys.executable, os.path.join(ROOT, "generator", "create_csvs.py"),
+             "--users", str(max(100, messages // 10)),
+             "--messages", str(messages),
+             "--follows", str(messages // 2),
+             "--seed", "benchmark",
+             "--end", "2024-01-01",
+             "--out", directory],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+
+        with app.app_context():
+            seed(directory)
+
+
+def prepare():
+    """Pick the users and message the routes act on; return their ids."""
+
+    with app.app_context():
+        viewer = User.query.order_by(User.following_count.desc()).first()
+        target = (User.query
+                  .filter(User.id != viewer.id)
+                  .order_by(User.followers_count.desc())
+                  .first())
+        message = (Message.query
+                   .filter(Message.user_id != viewer.id)
+                   .order_by(Message.timestamp.desc())
+                   .first())
+
+        # The follow and like pairs need them not followed / liked yet.
+        Follows.query.filter_by(user_following_id=viewer.id,
+                                user_being_followed_id=target.id).delete()
+        Likes.query.filter_by(user_liking_id=viewer.id,
+                              message_liked_id=message.id).delete()
+        viewer.password = password_hasher.hash(PASSWORD)
+        db.session.commit()
+        User.reconcile_counters([viewer.id, target.id])
+        Message.reconcile_counters([message.id])
+        db.session.commit()
+
+        word = message.text.split()[0]
+        return dict(viewer=viewer.id,
+                    viewer_name=viewer.username,
+                    viewer_email=viewer.email,
+                    target=target.id,
+                    message=message.id,
+                    word=word)
+
+
+def scenarios(ids):
+    """Return a list of scenarios, each a list of (name, action) steps run
+    in turn; action(client, n) makes one request and returns its response.
+
+    Writes come in pairs that undo each other, so every repetition starts
+    from the same state.
+    """
+
+    def newest_message():
+        with app.app_context():
+            return (Message.query
+                    .filter_by(user_id=ids["viewer"])
+                    .order_by(Message.id.desc())
+                    .first().id)
+
+    viewer, target = ids["viewer"], ids["target"]
+
+    reads = [
+        ("GET /", lambda c, n: c.get("/")),
+        ("GET /users", lambda c, n: c.get("/users")),
+        ("GET /users?q=", lambda c, n: c.get(f"/users?q={ids['viewer_name']}")),
+        ("GET /users/<id>", lambda c, n: c.get(f"/users/{target}")),
+        ("GET /users/<id>/following",
+         lambda c, n: c.get(f"/users/{viewer}/following")),
+        ("GET /users/<id>/followers",
+         lambda c, n: c.get(f"/users/{target}/followers")),
+        ("GET /users/<id>/likes", lambda c, n: c.get(f"/users/{viewer}/likes")),
+        ("GET /users/profile", lambda c, n: c.get("/users/profile")),
+        ("GET /messages/new", lambda c, n: c.get("/messages/new")),
+        ("GET /messages/search",
+         lambda c, n: c.get(f"/messages/search?q={ids['word']}")),
+        ("GET /messages/<id>", lambda c, n: c.get(f"/messages/{ids['message']}")),
+        ("GET /api/v1/timeline", lambda c, n: c.get("/api/v1/timeline")),
+        ("GET /api/v1/users/<id>/messages",
+         lambda c, n: c.get(f"/api/v1/users/{target}/messages")),
+        ("GET /api/v1/users?ids=",
+         lambda c, n: c.get(f"/api/v1/users?ids={viewer},{target}")),
+        ("GET /metrics",
+         lambda c, n: c.get("/metrics", headers=METRICS_AUTH)),
+        ("GET /signup", lambda c, n: c.get("/signup")),
+        ("GET /login", lambda c, n: c.get("/login")),
+        ("POST /users/profile",
+         lambda c, n: c.post("/users/profile",
+                             data={"username": ids["viewer_name"],
+                                   "email": ids["viewer_email"],
+                                   "validate_password": PASSWORD})),
+    ]
+
+    pairs = [
+        [("POST /users/follow/<id>",
+          lambda c, n: c.post(f"/users/follow/{target}")),
+         ("POST /users/stop-following/<id>",
+          lambda c, n: c.post(f"/users/stop-following/{target}"))],
+        [("POST /messages/likes/<id>",
+          lambda c, n: c.post(f"/messages/likes/{ids['message']}")),
+         ("POST /messages/unlikes/<id>",
+          lambda c, n: c.post(f"/messages/unlikes/{ids['message']}"))],
+        [("POST /messages/new",
+          lambda c, n: c.post("/messages/new", data={"text": f"bench {n}"})),
+         ("POST /messages/<id>/delete",
+          lambda c, n: c.post(f"/messages/{newest_message()}/delete"))],
+        [("POST /login",
+          lambda c, n: c.post("/login", data={"username": ids["viewer_name"],
+                                              "password": PASSWORD})),
+         ("POST /logout", lambda c, n: c.post("/logout"))],
+        [("POST /signup",
+          lambda c, n: c.post("/signup",
+                              data={"username": f"bench_signup_{n}",
+                                    "email": f"bench_signup_{n}@example.com",
+                                    "password": PASSWORD})),
+         ("POST /users/delete", lambda c, n: c.post("/users/delete"))],
+    ]
+
+    return [[read] for read in reads] + pairs
+
+
+def request(client, name, action, n, viewer):
+    """Make one request as `viewer`, reading the whole (possibly streamed)
+    body; return (seconds, queries)."""
+
+    with client.session_transaction() as sess:
+        sess.setdefault(CURR_USER_KEY, viewer)
+
+    with QueryCounter(keep_statements=False) as counter:
+        start = perf_counter()
+        resp = action(client, n)
+        resp.get_data()
+        resp.close()
+        seconds = perf_counter() - start
+
+    if resp.status_code >= 400:
+        raise RuntimeError(f"{name} returned {resp.status_code}")
+
+    return seconds, counter.count
+
+
+def measure(scenario, viewer):
+    """Run `scenario`'s steps REQUESTS times; return {name: stats}."""
+
+    client = app.test_client()
+    timings = {name: [] for name, action in scenario}
+    queries = {name: [] for name, action in scenario}
+    peaks = {}
+
+    for n in range(REQUESTS + 1):
+        # Start each repetition logged in as the viewer; steps such as
+        # signup or logout change who is logged in for the next step.
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = viewer
+
+        for name, action in scenario:
+            if n < REQUESTS:
+                seconds, count = request(client, name, action, n, viewer)
+                timings[name].append(seconds)
+                queries[name].append(count)
+            else:
+                # One more round, traced for memory; tracing slows
+                # everything down, so it isn't timed.
+                tracemalloc.start()
+                request(client, name, action, n, viewer)
+                peaks[name] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+    stats = {}
+
+    for name, seconds in timings.items():
+        cuts = quantiles(seconds, n=100, method="inclusive")
+        stats[name] = {
+            "p50_ms": round(cuts[49] * 1000, 2),
+            "p95_ms": round(cuts[94] * 1000, 2),
+            "p99_ms": round(cuts[98] * 1000, 2),
+            "queries": round(median(queries[name]), 1),
+            "peak_kib": round(peaks[name] / 1024),
+        }
+
+    return stats
+
+
+def regressions(results, baseline):
+    """Return a line for each route that's worse than in `baseline`."""
+
+    found = []
+
+    for scale, routes_now in results.items():
+        for name, now in routes_now.items():
+            before = baseline.get(scale, {}).get(name)
+
+            if before is None:
+                continue
+
+            slower = now["p50_ms"] - before["p50_ms"]
+            if (slower > NOISE_MS
+                    and now["p50_ms"] > before["p50_ms"] * (1 + TOLERANCE)):
+                found.append(f"{scale} {name}: p50 {before['p50_ms']} -> "
+                             f"{now['p50_ms']} ms")
+
+            if now["queries"] > before["queries"]:
+                found.append(f"{scale} {name}: queries {before['queries']} "
+                             f"-> {now['queries']}")
+
+    return found
+
+
+def main():
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['METRICS_TOKEN'] = METRICS_TOKEN
+    auth_limiter.enabled = False
+    results = {}
+
+    for scale in SCALES:
+        print(f"\n{scale:,} messages ({db.engine.dialect.name})")
+        build_dataset(scale)
+        ids = prepare()
+        results[str(scale)] = {}
+
+        print(f"{'route':<34}{'p50 ms':>8}{'p95 ms':>8}{'p99 ms':>8}"
+              f"{'queries':>9}{'peak KiB':>10}")
+
+        for scenario in scenarios(ids):
+            for name, stats in measure(scenario, ids["viewer"]).items():
+                results[str(scale)][name] = stats
+                print(f"{name:<34}{stats['p50_ms']:>8}{stats['p95_ms']:>8}"
+                      f"{stats['p99_ms']:>8}{stats['queries']:>9}"
+                      f"{stats['peak_kib']:>10}")
+
+    if SAVE:
+        with open(BASELINE, "w") as f:
+            json.dump({"created": datetime.now().isoformat(timespec="seconds"),
+                       "database": db.engine.dialect.name,
+                       "python": platform.python_version(),
+                       "requests": REQUESTS,
+                       "scales": results},
+                      f, indent=2, sort_keys=True)
+        print(f"\nSaved baseline to {BASELINE}")
+        return
+
+    if not os.path.exists(BASELINE):
+        print(f"\nNo baseline at {BASELINE}; run with BENCH_SAVE=1 to make one.")
+        return
+
+    with open(BASELINE) as f:
+        found = regressions(results, json.load(f)["scales"])
+
+    if found:
+        print("\nRegressions against the baseline:")
+        print("\n".join(found))
+        sys.exit(1)
+
+    print("\nNo regressions against the baseline.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""HTTP caching policy and conditional responses for Warbler.
+
+CACHE_POLICIES declares the Cache-Control header for each endpoint; any
+endpoint not listed gets `no-store`, which is what every response used to
+get.
+
+Fingerprinted static assets (see assets.py) never change under the same
+URL, so browsers and CDNs may keep them for a year without revalidating.
+Unhashed /static/ URLs are only cached briefly.
+
+Profile, follower/following and message pages are `private, no-cache`: the
+browser (or a local reverse proxy) keeps its copy but revalidates it each
+time. Those routes call render_conditional() with the data the page is
+built from; it derives an ETag from it and answers a matching If-None-Match
+with a 304 before rendering the template.
+"""
+
+from hashlib import sha1
+from time import time
+
+from flask import make_response, render_template, request, session
+
+DEFAULT_POLICY = "no-store"
+
+REVALIDATE = "private, no-cache"
+
+CACHE_POLICIES = {
+    "users_show": REVALIDATE,
+    "show_following": REVALIDATE,
+    "users_followers": REVALIDATE,
+    "messages_show": REVALIDATE,
+    "static": "public, max-age=3600",
+    "hashed_static": "public, max-age=31536000, immutable",
+}
+
+# Pages embed CSRF tokens, which expire (WTF_CSRF_TIME_LIMIT, an hour by
+# default). Folding this epoch into every ETag makes browsers fetch a fresh
+# page, with fresh tokens, well before the old ones stop working.
+CSRF_EPOCH_SECONDS = 1800
+
+
+def apply_cache_policy(response):
+    """Set Cache-Control from CACHE_POLICIES.
+
+    Listed endpoints always get their policy (overriding the `no-cache`
+    that send_file adds); others get `no-store` unless the view set one.
+    """
+
+    if request.endpoint in CACHE_POLICIES:
+        response.headers["Cache-Control"] = CACHE_POLICIES[request.endpoint]
+    elif "Cache-Control" not in response.headers:
+        response.headers["Cache-Control"] = DEFAULT_POLICY
+
+    if response.headers["Cache-Control"] == REVALIDATE:
+        response.vary.add("Cookie")
+
+    return response
+
+
+def make_etag(*parts):
+    """Return an ETag for the values in `parts`."""
+
+    epoch = int(time() // CSRF_EPOCH_SECONDS)
+    return sha1(repr((epoch, parts)).encode()).hexdigest()
+
+
+def render_conditional(etag_parts, template, **context):
+    """Render `template`, or a 304 if the client already has this version.
+
+    `etag_parts` must cover everything the page shows that can change.
+    """
+
+    etag = make_etag(request.endpoint, request.full_path, *etag_parts)
+
+    # A pending flash message isn't part of the ETag, so always render it.
+    # If-None-Match compares weakly: CompressionMiddleware weakens the ETags
+    # of the compressed responses browsers will send back.
+    if (request.if_none_match.contains_weak(etag)
+            and not session.get("_flashes")):
+        response = make_response("", 304)
+    else:
+        response = make_response(render_template(template, **context))
+
+    response.set_etag(etag)
+    return response
@@ -0,0 +1,167 @@
+"""Streaming gzip/deflate compression of responses, as WSGI middleware.
+
+Warbler's pages are large and very repetitive (every message card repeats
+the same markup and CSRF fields), so they compress well. The middleware
+picks gzip or deflate from the request's Accept-Encoding and compresses the
+body chunk by chunk as the app produces it, so a streamed page is never
+held in memory whole and its first bytes still go out early.
+
+Responses are passed through untouched when they are:
+
+- smaller than `min_size` bytes (not worth the overhead),
+- not a compressible Content-Type (images are already compressed),
+- already encoded (e.g. the precompressed static assets),
+- for a HEAD request, or a 1xx/204/206/304 status,
+- marked Cache-Control: no-transform.
+
+Compressing a page that holds a secret alongside text an attacker chooses
+lets the attacker read the secret back from response sizes (BREACH), so the
+CSRF tokens in pages are masked afresh for every response (see csrf.py).
+"""
+
+import zlib
+from itertools import chain
+
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header
+
+COMPRESSIBLE_TYPES = {
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml',
+    'text/css',
+    'text/html',
+    'text/javascript',
+    'text/plain',
+    'text/xml',
+}
+
+# zlib window bits for each Content-Encoding: "gzip" wants a gzip header,
+# HTTP "deflate" means the zlib format (RFC 9110 8.4.1.2).
+WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+def negotiate(accept_encoding):
+    """Return the encoding to use for `accept_encoding`, or None."""
+
+    accepted = parse_accept_header(accept_encoding)
+    best = max(WBITS, key=accepted.quality)
+
+    return best if accepted.quality(best) > 0 else None
+
+
+class CompressionMiddleware:
+    """Compress `app`'s responses with gzip or deflate.
+
+    `level` is the zlib level (1 fastest - 9 smallest). Compressed output
+    is flushed to the client at least every `flush_size` bytes of input, so
+    slow streamed pages keep arriving as they are rendered.
+    """
+
+    def __init__(self, app, level=6, min_size=500, flush_size=64 * 1024):
+        self.app = app
+        self.level = level
+        self.min_size = min_size
+        self.flush_size = flush_size
+
+    def __call__(self, environ, start_response):
+        encoding = negotiate(environ.get('HTTP_ACCEPT_ENCODING', ''))
+
+        if encoding is None or environ['REQUEST_METHOD'] == 'HEAD':
+            return self.app(environ, start_response)
+
+        response = []
+        # Data the app passes to write() (PEP 3333's legacy way of sending
+        # a body) goes out ahead of the body it returns.
+        written = []
+
+        def capture(status, headers, exc_info=None):
+            response[:] = [status, Headers(headers), exc_info]
+            return written.append
+
+        body = self.app(environ, capture)
+
+        return self._compress(body, chain(written, body), response,
+                              encoding, start_response)
+
+    def should_compress(self, status, headers):
+        """Can this response be compressed (if it is big enough)?"""
+
+        code = int(status.split(None, 1)[0])
+        mimetype = headers.get('Content-Type', '').split(';')[0].strip()
+        length = headers.get('Content-Length')
+
+        return (200 <= code < 300 and code not in (204, 206)
+                and mimetype in COMPRESSIBLE_TYPES
+                and 'Content-Encoding' not in headers
+                and 'no-transform' not in headers.get('Cache-Control', '')
+                and (length is None or int(length) >= self.min_size))
+
+    def _compress(self, body, chunks, response, encoding, start_response):
+        """Yield `chunks`, the app's response `body` (after any data it
+        wrote), compressed if it qualifies."""
+
+        try:
+            chunks = iter(chunks)
+            buffered = []
+            size = 0
+
+            # Hold back the start of the body until we know it's worth
+            # compressing; the app may also only start its response once
+            # iteration begins.
+            for chunk in chunks:
+                buffered.append(chunk)
+                size += len(chunk)
+
+                if size >= self.min_size:
+                    break
+
+            status, headers, exc_info = response
+
+            if size < self.min_size or not self.should_compress(status,
+                                                               headers):
+                start_response(status, headers.to_wsgi_list(), exc_info)
+                yield from buffered
+                yield from chunks
+                return
+
+            del headers['Content-Length']
+            headers['Content-Encoding'] = encoding
+            vary = headers.get('Vary')
+            headers['Vary'] = (f"{vary}, Accept-Encoding" if vary
+                               else "Accept-Encoding")
+
+            # The compressed body is a different representation of the same
+            # page, so its ETag may only match weakly.
+            etag = headers.get('ETag')
+            if etag and not etag.startswith('W/'):
+                headers['ETag'] = f"W/{etag}"
+
+            start_response(status, headers.to_wsgi_list(), exc_info)
+
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                          WBITS[encoding])
+            # Send the head of the page straight away.
+            data = (compressor.compress(b''.join(buffered))
+                    + compressor.flush(zlib.Z_SYNC_FLUSH))
+            pending = 0
+            del buffered
+
+            for chunk in chunks:
+                data += compressor.compress(chunk)
+                pending += len(chunk)
+
+                if pending >= self.flush_size:
+                    data += compressor.flush(zlib.Z_SYNC_FLUSH)
+                    pending = 0
+
+                if data:
+                    yield data
+                    data = b''
+
+            yield data + compressor.flush()
+
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
@@ -0,0 +1,78 @@
+"""CSRF tokens masked afresh for every response.
+
+Flask-WTF signs the same session token on every request, so each page
+starts its CSRF token with the same bytes. Pages are gzipped (see
+compression.py) together with text a third party controls: a search term
+echoed back, a bio or message they wrote. That is what the BREACH attack
+needs to recover the token a byte at a time from compressed response sizes.
+
+MaskedCSRF XORs the signed token with a random pad and sends the pad along
+with it, so the bytes on the page differ in every response; validation
+takes the pad off again and checks the token as Flask-WTF would. The pad is
+chosen once per response rather than once per form, so the many like-button
+forms on a page stay identical to each other and still compress well.
+"""
+
+import os
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+from flask import g
+from flask_wtf.csrf import generate_csrf, validate_csrf
+from wtforms import ValidationError
+from wtforms.csrf.core import CSRF
+
+
+def mask(token):
+    """Return `token` XORed with a random pad, with the pad in front."""
+
+    token = token.encode('ascii')
+    pad = os.urandom(len(token))
+
+    return urlsafe_b64encode(
+        pad + bytes(a ^ b for a, b in zip(pad, token))).decode('ascii')
+
+
+def unmask(masked):
+    """Return the token `masked` was made from.
+
+    Raises ValidationError if it isn't a masked token.
+    """
+
+    try:
+        data = urlsafe_b64decode(masked.encode('ascii'))
+    except ValueError:
+        data = b''
+
+    if not data or len(data) % 2:
+        raise ValidationError('The CSRF token is invalid.')
+
+    half = len(data) // 2
+
+    # A forged token may unmask to any bytes; validate_csrf rejects them.
+    return bytes(a ^ b for a, b in zip(data[:half], data[half:])).decode(
+        'latin-1')
+
+
+class MaskedCSRF(CSRF):
+    """Flask-WTF's form CSRF, with the token masked (see above)."""
+
+    def setup_form(self, form):
+        self.meta = form.meta
+        return super().setup_form(form)
+
+    def generate_csrf_token(self, csrf_token_field):
+        if 'masked_csrf_token' not in g:
+            g.masked_csrf_token = mask(generate_csrf(
+                secret_key=self.meta.csrf_secret,
+                token_key=self.meta.csrf_field_name))
+
+        return g.masked_csrf_token
+
+    def validate_csrf_token(self, form, field):
+        # An empty token gets Flask-WTF's "missing" error.
+        token = unmask(field.data) if field.data else field.data
+
+        validate_csrf(token,
+                      self.meta.csrf_secret,
+                      self.meta.csrf_time_limit,
+                      self.meta.csrf_field_name)
@@ -2,14 +2,24 @@ from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, TextAreaField
 from wtforms.validators import DataRequired, Email, Length
 
+from csrf import MaskedCSRF
 
-class MessageForm(FlaskForm):
+
+class Form(FlaskForm):
+    """Base for Warbler's forms: a CSRF token masked afresh for every
+    response, so it can't be read back out of compressed pages."""
+
+    class Meta:
+        csrf_class = MaskedCSRF
+
+
+class MessageForm(Form):
     """Form for adding/editing messages."""
 
     text = TextAreaField('text', validators=[DataRequired()])
 
 
-class UserAddForm(FlaskForm):
+class UserAddForm(Form):
     """Form for adding users."""
 
     username = StringField('Username', validators=[DataRequired()])
@@ -17,7 +27,7 @@ class UserAddForm(FlaskForm):
     password = PasswordField('Password', validators=[Length(min=6)])
     image_url = StringField('(Optional) Image URL')
 
-class EditUserForm(FlaskForm):
+class EditUserForm(Form):
     """Form for editing users."""
 
     username = StringField('Username', validators=[DataRequired()])
@@ -30,11 +40,11 @@ class EditUserForm(FlaskForm):
 
 
 
-class LoginForm(FlaskForm):
+class LoginForm(Form):
     """Login form."""
 
     username = StringField('Username', validators=[DataRequired()])
     password = PasswordField('Password', validators=[Length(min=6)])
 
-class CSRFOnlyForm(FlaskForm):
+class CSRFOnlyForm(Form):
     """CSRF Protection only"""
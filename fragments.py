@@ -0,0 +1,97 @@
+"""Cache of rendered message cards.
+
+The timeline, profile, likes and search pages all render the same message
+card (author link, avatar, date, text) for every viewer. FragmentCache keeps
+the rendered card for each message, tagged with its author's profile
+version, and templates only render the per-viewer like button:
+
+    {% set like_button %}{% include 'messages/_like_button.html' %}{% endset %}
+    {{ message_card(msg, like_button) }}
+
+A card is re-rendered when its author's version has moved on (they edited
+their profile) and dropped when the message is deleted.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+from markupsafe import Markup
+
+CARD_TEMPLATE = 'messages/_card.html'
+
+# Stands in for the like button in cached cards.
+LIKE_BUTTON_SLOT = Markup('<!--like-button-->')
+
+
+class FragmentCache:
+    """Bounded LRU of rendered message cards, keyed by message id."""
+
+    def __init__(self, app=None, maxsize=10_000):
+        self.maxsize = maxsize
+        # {message id: (author version, rendered card)}
+        self._cards = OrderedDict()
+        self._lock = Lock()
+        self._jinja_env = None
+        self.hits = 0
+        self.misses = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.maxsize = app.config.get('FRAGMENT_CACHE_SIZE', self.maxsize)
+        self._jinja_env = app.jinja_env
+        app.add_template_global(self.message_card)
+
+    def message_card(self, msg, like_button=''):
+        """Return the card for `msg` with `like_button` spliced in."""
+
+        version = msg.user.version
+
+        with self._lock:
+            cached = self._cards.get(msg.id)
+
+            if cached is not None and cached[0] == version:
+                self._cards.move_to_end(msg.id)
+                self.hits += 1
+                card = cached[1]
+            else:
+                self.misses += 1
+                card = None
+
+        if card is None:
+            template = self._jinja_env.get_template(CARD_TEMPLATE)
+            card = template.render(msg=msg, like_button=LIKE_BUTTON_SLOT)
+
+            with self._lock:
+                self._cards[msg.id] = (version, card)
+                self._cards.move_to_end(msg.id)
+
+                while len(self._cards) > self.maxsize:
+                    self._cards.popitem(last=False)
+
+        return Markup(card.replace(LIKE_BUTTON_SLOT, Markup(like_button)))
+
+    def invalidate(self, *message_ids):
+        """Drop the cards for `message_ids`."""
+
+        with self._lock:
+            for message_id in message_ids:
+                self._cards.pop(message_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._cards.clear()
+
+    def render_metrics(self):
+        """Return hit/miss counters as Prometheus text lines."""
+
+        with self._lock:
+            return [
+                "# TYPE warbler_fragment_cache_hits_total counter",
+                f"warbler_fragment_cache_hits_total {self.hits}",
+                "# TYPE warbler_fragment_cache_misses_total counter",
+                f"warbler_fragment_cache_misses_total {self.misses}",
+                "# TYPE warbler_fragment_cache_size gauge",
+                f"warbler_fragment_cache_size {len(self._cards)}",
+            ]
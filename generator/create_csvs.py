@@ -3,14 +3,41 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+Rows are generated in shards of SHARD_SIZE on a process pool and streamed
+to disk, so memory use doesn't grow with the size of the dataset. Each
+shard seeds its own random generator from --seed, so the same arguments
+always produce the same files, however many workers run. Nothing is
+fetched from the network.
+
+Follows are sampled per follower, with the users being followed drawn from
+a power law: a few celebrities get a large share of all follows, and most
+users get a handful.
+
+Run from the project root, e.g. for a load-testing dataset:
+
+    python generator/create_csvs.py --users 1000000 --messages 100000000 \\
+        --follows 50000000 --out /tmp/warbler-data
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import shutil
+from collections import Counter
+from datetime import datetime
+from multiprocessing import Pool
+from random import Random
+
 from faker import Faker
-from helpers import get_random_datetime
+
+from helpers import (
+    HEADER_IMAGE_URLS,
+    IMAGE_URLS,
+    get_random_datetime,
+    id_scatterer,
+    power_law_rank,
+)
 
 MAX_WARBLER_LENGTH = 140
 
@@ -20,58 +47,188 @@ FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+NUM_FOLLOWS = 5000
+
+# Rows per shard of users and messages; users per shard of follows.
+SHARD_SIZE = 50_000
+
+# How steeply follows concentrate on the most popular users.
+FOLLOW_EXPONENT = 0.9
+
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+
+def shards(total, size=SHARD_SIZE):
+    """Split the 1-based ids 1..total into [start, stop) ranges."""
+
+    return [(start, min(start + size, total + 1))
+            for start in range(1, total + 1, size)]
+
+
+def write_users(path, seed, shard, start, stop):
+    """Write users with ids start..stop-1 to `path`."""
+
+    rng = Random(f"{seed}:users:{shard}")
+    fake = Faker()
+    fake.seed_instance(f"{seed}:users:{shard}")
+
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+
+        for user_id in range(start, stop):
+            # The id suffix keeps usernames and emails unique.
+            username = f"{fake.user_name()}{user_id}"
+            writer.writerow([
+                f"{username}@{fake.free_email_domain()}",
+                username,
+                rng.choice(IMAGE_URLS),
+                PASSWORD,
+                fake.sentence(),
+                rng.choice(HEADER_IMAGE_URLS),
+                fake.city(),
+            ])
+
+    return path
+
+
+def write_messages(path, seed, shard, start, stop, num_users, now):
+    """Write messages start..stop-1, by random users, to `path`."""
+
+    rng = Random(f"{seed}:messages:{shard}")
+    words = Faker().get_words_list()
+
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+
+        for _ in range(start, stop):
+            text = " ".join(rng.choices(words, k=rng.randint(4, 25)))
+            if len(text) >= MAX_WARBLER_LENGTH:
+                text = text[:MAX_WARBLER_LENGTH].rsplit(" ", 1)[0]
+            text = text.capitalize() + "."
+            writer.writerow([
+                text,
+                get_random_datetime(now=now, rng=rng),
+                rng.randint(1, num_users),
+            ])
+
+    return path
+
+
+def write_follows(path, seed, shard, start, stop, num_users, count, exponent):
+    """Write `count` follows by the users with ids start..stop-1 to `path`.
+
+    Each follower's users are distinct and never include themself, so a
+    follower can have at most num_users - 1 of them; follows over that are
+    dropped.
+    """
+
+    rng = Random(f"{seed}:follows:{shard}")
+    # The same mapping in every shard, so the celebrities are the same.
+    user_for_rank = id_scatterer(num_users,
+                                 Random(f"{seed}:celebrities").randrange(
+                                     num_users))
+    degrees = Counter(rng.randrange(start, stop) for _ in range(count))
+
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+
+        for follower in sorted(degrees):
+            degree = min(degrees[follower], num_users - 1)
+            followed = set()
+            attempts = 0
+
+            while len(followed) < degree:
+                attempts += 1
 
-fake = Faker()
+                # Someone following most of the celebrities already keeps
+                # drawing them; fill the rest of their list uniformly.
+                if attempts <= 4 * degree:
+                    user_id = user_for_rank(
+                        power_law_rank(rng, num_users, exponent))
+                else:
+                    user_id = rng.randint(1, num_users)
 
-# Generate random profile image URLs to use for users
+                if user_id != follower:
+                    followed.add(user_id)
 
-image_urls = [
-    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
-    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
-    for i in range(count)
-]
+            writer.writerows((user_id, follower) for user_id in followed)
 
-# Generate random header image URLs to use for users
+    return path
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
+def run(task):
+    """Run one shard's writer; `task` is (function, *args)."""
 
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
+    function, *args = task
+    return function(*args)
 
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
 
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
+def write_csv(pool, path, headers, tasks):
+    """Run `tasks` on `pool` and join their part files, in order, into
+    the CSV at `path`."""
+
+    with open(path, 'w', newline='') as f:
+        csv.writer(f).writerow(headers)
+
+        for part in pool.imap(run, tasks):
+            with open(part, newline='') as part_file:
+                shutil.copyfileobj(part_file, f)
+
+            os.remove(part)
+
+    print(f"Wrote {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLOWS)
+    parser.add_argument('--exponent', type=float, default=FOLLOW_EXPONENT,
+                        help="power-law exponent for who gets followed")
+    parser.add_argument('--seed', default='warbler')
+    parser.add_argument('--end', type=datetime.fromisoformat,
+                        default=datetime.now().replace(hour=0, minute=0,
+                                                       second=0,
+                                                       microsecond=0),
+                        help="latest message timestamp (default: today)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--out', default='generator')
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+
+    def part(name, shard):
+        return os.path.join(args.out, f".{name}.{shard:05d}.part")
+
+    user_shards = shards(args.users)
+    # Split the follows between user shards in proportion to their size.
+    follow_counts = [args.follows * (stop - start) // args.users
+                     for start, stop in user_shards]
+    for i in range(args.follows - sum(follow_counts)):
+        follow_counts[i % len(follow_counts)] += 1
 
-# Generate follows.csv from random pairings of users
+    with Pool(args.workers) as pool:
+        write_csv(pool, os.path.join(args.out, 'users.csv'),
+                  USERS_CSV_HEADERS,
+                  [(write_users, part('users', shard), args.seed, shard,
+                    start, stop)
+                   for shard, (start, stop) in enumerate(user_shards)])
+
+        write_csv(pool, os.path.join(args.out, 'messages.csv'),
+                  MESSAGES_CSV_HEADERS,
+                  [(write_messages, part('messages', shard), args.seed, shard,
+                    start, stop, args.users, args.end)
+                   for shard, (start, stop)
+                   in enumerate(shards(args.messages))])
 
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
+        write_csv(pool, os.path.join(args.out, 'follows.csv'),
+                  FOLLOWS_CSV_HEADERS,
+                  [(write_follows, part('follows', shard), args.seed, shard,
+                    start, stop, args.users, count, args.exponent)
+                   for shard, ((start, stop), count)
+                   in enumerate(zip(user_shards, follow_counts))])
 
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
 
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == '__main__':
+    main()
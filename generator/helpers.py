@@ -1,14 +1,111 @@
 """Support functions for CSV generation."""
 
 from datetime import datetime
+from math import gcd
 from random import uniform
 
+# Profile and header images. These are fixed lists so the generator never
+# has to go to the network.
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+IMAGE_URLS = [
+    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
+    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
+    for i in range(count)
+]
 
-    now = datetime.now()
+HEADER_IMAGE_BASE_URL = "https://splashbase.s3.amazonaws.com/unsplash/regular/"
+
+HEADER_IMAGE_URLS = [HEADER_IMAGE_BASE_URL + name for name in [
+    "tumblr_mnh0n9pHJW1st5lhmo1_1280.jpg",
+    "tumblr_mnh0uemhCk1st5lhmo1_1280.jpg",
+    "tumblr_mnh121HEWa1st5lhmo1_1280.jpg",
+    "tumblr_mnh17lfd9R1st5lhmo1_1280.jpg",
+    "tumblr_mnh1d7s3UD1st5lhmo1_1280.jpg",
+    "tumblr_mnh1jdFvHR1st5lhmo1_1280.jpg",
+    "tumblr_mnh1uhYnog1st5lhmo1_1280.jpg",
+    "tumblr_mnh25vNOvI1st5lhmo1_1280.jpg",
+    "tumblr_mnh29fxz111st5lhmo1_1280.jpg",
+    "tumblr_mnh2m1hnS81st5lhmo1_1280.jpg",
+    "tumblr_mo1h6tGOZf1st5lhmo1_1280.jpg",
+    "tumblr_mo2wz2LTCs1st5lhmo1_1280.jpg",
+    "tumblr_mo2x3aAnRH1st5lhmo1_1280.jpg",
+    "tumblr_mo2x80NkDu1st5lhmo1_1280.jpg",
+    "tumblr_mo2x9xqeef1st5lhmo1_1280.jpg",
+    "tumblr_mo2xbk8JUK1st5lhmo1_1280.jpg",
+    "tumblr_mo2xdqmle51st5lhmo1_1280.jpg",
+    "tumblr_mo2xfarCvW1st5lhmo1_1280.jpg",
+    "tumblr_mo2xgqdEFn1st5lhmo1_1280.jpg",
+    "tumblr_mo2xijE2nr1st5lhmo1_1280.jpg",
+    "tumblr_mopq4kHmAg1st5lhmo1_1280.jpg",
+    "tumblr_mopq69jlcS1st5lhmo1_1280.jpg",
+    "tumblr_mopq8fyQwI1st5lhmo1_1280.jpg",
+    "tumblr_mopqamedKu1st5lhmo1_1280.jpg",
+    "tumblr_mopqc3ZZcz1st5lhmo1_1280.jpg",
+    "tumblr_mopqdfx05t1st5lhmo1_1280.jpg",
+    "tumblr_mopqfpSTPN1st5lhmo1_1280.jpg",
+    "tumblr_mopqhxFulr1st5lhmo1_1280.jpg",
+    "tumblr_mopqj9QUeq1st5lhmo1_1280.jpg",
+    "tumblr_mopqkkwK2M1st5lhmo1_1280.jpg",
+    "tumblr_mp6rzyNlAN1st5lhmo1_1280.jpg",
+    "tumblr_mp6s1hAudo1st5lhmo1_1280.jpg",
+    "tumblr_mp6s32zb6l1st5lhmo1_1280.jpg",
+    "tumblr_mp6s4dzqHA1st5lhmo1_1280.jpg",
+    "tumblr_mp6s661UgK1st5lhmo1_1280.jpg",
+    "tumblr_mp6s7lR1lS1st5lhmo1_1280.jpg",
+    "tumblr_mp6s995bvI1st5lhmo1_1280.jpg",
+    "tumblr_mp6sasSvPZ1st5lhmo1_1280.jpg",
+    "tumblr_mp6scv2xrZ1st5lhmo1_1280.jpg",
+    "tumblr_mpp6f50W261st5lhmo1_1280.jpg",
+    "tumblr_mpp6gwrYvm1st5lhmo1_1280.jpg",
+    "tumblr_mpp6l06zXi1st5lhmo1_1280.jpg",
+    "tumblr_mpp6poZxE51st5lhmo1_1280.jpg",
+    "tumblr_mpp6tjdFhf1st5lhmo1_1280.jpg",
+    "tumblr_mpp6w0dxAm1st5lhmo1_1280.jpg",
+]]
+
+
+def get_random_datetime(year_gap=2, now=None, rng=None):
+    """Get a random datetime within the `year_gap` years before `now`.
+
+    Pass a random.Random as `rng` for repeatable results.
+    """
+
+    now = now or datetime.now()
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    random_timestamp = (rng.uniform if rng else uniform)(
+        then.timestamp(), now.timestamp())
 
     return datetime.fromtimestamp(random_timestamp)
+
+
+def power_law_rank(rng, count, exponent):
+    """Pick a rank in [0, count), rank k having weight (k + 1) ** -exponent.
+
+    Low ranks are picked far more often than high ones, like followers
+    piling onto a few celebrities. Uses the inverse CDF of a bounded
+    power law, so it takes O(1) time and memory however large `count` is.
+    """
+
+    if exponent == 1:
+        rank = (count + 1) ** rng.random()
+    else:
+        power = 1 - exponent
+        rank = (((count + 1) ** power - 1) * rng.random() + 1) ** (1 / power)
+
+    return min(int(rank) - 1, count - 1)
+
+
+def id_scatterer(count, offset):
+    """Return a function mapping a rank in [0, count) to a user id in
+    [1, count], one to one.
+
+    Spreads the popular ranks over the id range, so celebrities aren't
+    simply the first users created.
+    """
+
+    # Any step coprime to `count` visits every id exactly once.
+    step = 2_654_435_761 % count or 1
+    while gcd(step, count) != 1:
+        step += 1
+
+    return lambda rank: (rank * step + offset) % count + 1
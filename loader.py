@@ -0,0 +1,228 @@
+"""Bulk loading of CSV files into Warbler's tables.
+
+Used by seed.py (and for restoring large datasets). Rows never go through
+the ORM:
+
+- On Postgres each file is streamed to the server with COPY, which parses
+  and inserts it in one pass.
+- Elsewhere (SQLite for local runs) the file is read in batches of
+  `batch_size` rows, each inserted with one executemany and committed.
+
+Maintaining secondary indexes, unique and foreign key constraints row by
+row is most of the cost of a big load, so deferred_indexes() drops them
+for the duration and rebuilds each in one pass at the end.
+
+Each step reports how many rows it loaded and how fast.
+"""
+
+import csv
+from contextlib import contextmanager
+from itertools import islice
+from time import perf_counter
+
+from sqlalchemy import text
+
+BATCH_SIZE = 10_000
+
+# How each DB-API paramstyle spells the n-th (0-based) placeholder.
+PLACEHOLDERS = {
+    'qmark': lambda n, name: '?',
+    'numeric': lambda n, name: f':{n + 1}',
+    'named': lambda n, name: f':{name}',
+    'format': lambda n, name: '%s',
+    'pyformat': lambda n, name: '%s',
+}
+
+
+def report(what, rows, seconds):
+    """Print a line of throughput for a step of the load."""
+
+    rate = rows / seconds if seconds else float('inf')
+    print(f"{what}: {rows:,} rows in {seconds:.2f}s ({rate:,.0f} rows/sec)")
+
+
+def load_csv(engine, table, path, batch_size=BATCH_SIZE):
+    """Load the CSV file at `path` into `table`; return the row count.
+
+    The file's header row names the columns it provides; the others get
+    their server defaults.
+    """
+
+    start = perf_counter()
+
+    with open(path, newline='') as f:
+        columns = next(csv.reader(f))
+
+        if engine.dialect.name == 'postgresql':
+            rows = _copy(engine, table, columns, f)
+        else:
+            rows = _insert_batches(engine, table, columns, csv.reader(f),
+                                   batch_size)
+
+    report(table.name, rows, perf_counter() - start)
+    return rows
+
+
+def _copy(engine, table, columns, f):
+    """Stream the rest of file `f` into `table` with COPY."""
+
+    quote = engine.dialect.identifier_preparer.quote
+    statement = (f"COPY {quote(table.name)} "
+                 f"({', '.join(quote(column) for column in columns)}) "
+                 f"FROM STDIN WITH (FORMAT csv)")
+
+    connection = engine.raw_connection()
+
+    try:
+        cursor = connection.cursor()
+        cursor.copy_expert(statement, f)
+        rows = cursor.rowcount
+        connection.commit()
+    finally:
+        connection.close()
+
+    return rows
+
+
+def _insert_batches(engine, table, columns, reader, batch_size):
+    """Insert the rows from `reader` with one executemany per batch."""
+
+    quote = engine.dialect.identifier_preparer.quote
+    placeholder = PLACEHOLDERS[engine.dialect.paramstyle]
+    values = [placeholder(n, column) for n, column in enumerate(columns)]
+    statement = (f"INSERT INTO {quote(table.name)} "
+                 f"({', '.join(quote(column) for column in columns)}) "
+                 f"VALUES ({', '.join(values)})")
+    named = engine.dialect.paramstyle in ('named', 'pyformat')
+    rows = 0
+
+    with engine.connect() as connection:
+        while batch := list(islice(reader, batch_size)):
+            # Unquoted empty fields mean NULL, as they do for COPY.
+            batch = [tuple(value if value != '' else None for value in row)
+                     for row in batch]
+
+            if named:
+                batch = [dict(zip(columns, row)) for row in batch]
+
+            with connection.begin():
+                connection.exec_driver_sql(statement, batch)
+
+            rows += len(batch)
+
+    return rows
+
+
+@contextmanager
+def deferred_indexes(engine, tables):
+    """Drop the secondary indexes and constraints on `tables` while the
+    block runs, then recreate them.
+
+    Primary keys stay, so rows can still be looked up by id during the
+    load. Recreating a unique or foreign key constraint checks every row,
+    so bad data still fails the load, just at the end. They are recreated
+    if the block raises, too.
+    """
+
+    names = [table.name for table in tables]
+
+    if engine.dialect.name == 'postgresql':
+        drop, create = _postgres_deferrables(engine, names)
+    elif engine.dialect.name == 'sqlite':
+        drop, create = _sqlite_deferrables(engine, names)
+    else:
+        drop, create = [], []
+
+    with engine.begin() as connection:
+        for statement in drop:
+            connection.execute(text(statement))
+
+    # Put them back even if the load fails, so a bad file can't leave the
+    # tables without their indexes and constraints.
+    try:
+        yield
+    finally:
+        start = perf_counter()
+
+        with engine.begin() as connection:
+            for statement in create:
+                connection.execute(text(statement))
+
+            if engine.dialect.name == 'postgresql':
+                for name in names:
+                    connection.execute(text(f'ANALYZE "{name}"'))
+
+        print(f"Rebuilt {len(create)} indexes and constraints "
+              f"in {perf_counter() - start:.2f}s")
+
+
+def _postgres_deferrables(engine, names):
+    """Return (drop, create) statements for the indexes and unique /
+    foreign key constraints on tables `names`."""
+
+    drop = []
+    create = []
+
+    with engine.connect() as connection:
+        constraints = connection.execute(text(
+            "SELECT conrelid::regclass::text, conname, "
+            "pg_get_constraintdef(oid), contype "
+            "FROM pg_constraint "
+            "WHERE conrelid::regclass::text = ANY(:names) "
+            "AND contype IN ('u', 'f') "
+            # Drop foreign keys first: they may depend on unique indexes.
+            "ORDER BY contype = 'u'"), {"names": names}).all()
+
+        indexes = connection.execute(text(
+            "SELECT indexname, indexdef FROM pg_indexes "
+            "WHERE schemaname = current_schema() "
+            "AND tablename = ANY(:names) "
+            "AND indexname NOT IN ("
+            "  SELECT conname FROM pg_constraint "
+            "  WHERE conrelid::regclass::text = ANY(:names))"),
+            {"names": names}).all()
+
+    for table, name, definition, kind in constraints:
+        drop.append(f'ALTER TABLE "{table}" DROP CONSTRAINT "{name}"')
+
+    for name, definition in indexes:
+        drop.append(f'DROP INDEX "{name}"')
+        create.append(definition)
+
+    # Unique constraints before the foreign keys that may need them.
+    for table, name, definition, kind in reversed(constraints):
+        create.append(
+            f'ALTER TABLE "{table}" ADD CONSTRAINT "{name}" {definition}')
+
+    return drop, create
+
+
+def _sqlite_deferrables(engine, names):
+    """Return (drop, create) statements for the indexes and triggers on
+    tables `names`.
+
+    SQLite can't drop constraints, so UNIQUE and foreign keys stay. Full
+    text tables kept in sync by the triggers are rebuilt from their
+    content table afterwards.
+    """
+
+    drop = []
+    create = []
+
+    with engine.connect() as connection:
+        rows = connection.execute(text(
+            "SELECT type, name, tbl_name, sql FROM sqlite_master "
+            "WHERE type IN ('index', 'trigger', 'table') "
+            "AND sql IS NOT NULL")).all()
+
+    for kind, name, table, sql in rows:
+        if kind in ('index', 'trigger') and table in names:
+            drop.append(f'DROP {kind.upper()} "{name}"')
+            create.append(sql)
+
+        elif kind == 'table' and 'USING fts5' in sql and any(
+                f"content='{content}'" in sql for content in names):
+            create.append(
+                f"INSERT INTO \"{name}\"(\"{name}\") VALUES ('rebuild')")
+
+    return drop, create
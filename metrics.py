@@ -0,0 +1,246 @@
+"""Per-request latency and database-time metrics for Warbler.
+
+RequestMetrics records, for every request, the wall time, the number of
+SQL statements run and the time spent in SQL, grouped by endpoint. Each
+response gets a `Server-Timing` header so the numbers show up in browser
+dev tools, and `/metrics` serves the aggregates in Prometheus text format.
+
+Per-route traffic and latency are not for the public, so `/metrics` only
+answers a scraper that sends `Authorization: Bearer <METRICS_TOKEN>`; with
+no METRICS_TOKEN configured it is a 404.
+
+A streamed response (see streaming.py) renders its body, and runs the
+queries for it, after the response hooks; it is recorded when the body has
+been sent instead, and its Server-Timing header only gives the time to
+headers.
+
+Recording a request is a few perf_counter() calls and bucket increments,
+so it is cheap enough to leave on in production. Metrics are kept per
+process; with several gunicorn workers, each worker reports its own.
+"""
+
+from bisect import bisect_left
+from functools import partial
+from hmac import compare_digest
+from threading import Lock
+from time import perf_counter
+
+from flask import Response, abort, current_app, g, request
+
+from query_budget import QueryCounter
+
+DURATION_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+QUANTILES = (0.5, 0.95, 0.99)
+
+# (metric name, help text, buckets)
+METRICS = (
+    ("warbler_request_duration_seconds",
+     "Wall time spent handling a request.",
+     DURATION_BUCKETS),
+    ("warbler_request_db_queries",
+     "SQL statements run per request.",
+     QUERY_COUNT_BUCKETS),
+    ("warbler_request_db_duration_seconds",
+     "Time spent executing SQL per request.",
+     DURATION_BUCKETS),
+)
+
+
+class Histogram:
+    """Fixed-bucket histogram, in the style of a Prometheus histogram."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One count per bucket, plus the +Inf bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Record one observation of `value`."""
+
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Yield (upper bound, observations <= upper bound) per bucket."""
+
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield bound, total
+
+    def quantile(self, q):
+        """Estimate the `q` quantile by interpolating within its bucket.
+
+        This is the same estimate Prometheus' histogram_quantile() makes.
+        """
+
+        if not self.count:
+            return float("nan")
+
+        rank = q * self.count
+        lower_bound = 0.0
+        below = 0
+
+        for bound, total in self.cumulative():
+            if total >= rank:
+                if bound == float("inf"):
+                    return self.buckets[-1]
+                in_bucket = total - below
+                return lower_bound + (bound - lower_bound) * (
+                    (rank - below) / in_bucket)
+            lower_bound = bound
+            below = total
+
+        return self.buckets[-1]
+
+
+class RequestMetrics:
+    """Flask extension that records per-endpoint request metrics.
+
+    Create it before any other before_request hooks are registered, so the
+    queries those hooks run are counted too.
+    """
+
+    def __init__(self, app=None):
+        self._lock = Lock()
+        # {(metric name, endpoint): Histogram}
+        self.histograms = {}
+        # Callables returning extra exposition lines, e.g. cache stats.
+        self.collectors = []
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.teardown_request(self._stop_counting)
+        app.add_url_rule("/metrics", "metrics", self.metrics_view)
+
+    def _start_request(self):
+        g.metrics_start = perf_counter()
+        g.metrics_queries = QueryCounter(keep_statements=False).__enter__()
+
+    def _stop_counting(self, exc):
+        counter = g.pop("metrics_queries", None)
+
+        if counter is not None:
+            counter.__exit__(None, None, None)
+
+    def _finish_request(self, response):
+        start = g.get("metrics_start")
+        counter = g.get("metrics_queries")
+
+        if start is None or counter is None:
+            return response
+
+        endpoint = request.endpoint or "<unmatched>"
+
+        if response.is_streamed:
+            # The body hasn't been rendered yet; record the request once it
+            # has been sent. The counter keeps counting until teardown,
+            # which stream_with_context defers to the end of the body.
+            response.call_on_close(
+                partial(self._record, endpoint, start, counter))
+            elapsed = perf_counter() - start
+            response.headers.add(
+                "Server-Timing",
+                f'headers;dur={elapsed * 1000:.1f};desc="body streamed"')
+            return response
+
+        elapsed = self._record(endpoint, start, counter)
+
+        response.headers.add(
+            "Server-Timing",
+            f'app;dur={elapsed * 1000:.1f}, '
+            f'db;dur={counter.duration * 1000:.1f};desc="{counter.count} queries"')
+
+        return response
+
+    def _record(self, endpoint, start, counter):
+        """Observe a finished request; return its wall time."""
+
+        elapsed = perf_counter() - start
+        self.observe(endpoint, elapsed, counter.count, counter.duration)
+
+        return elapsed
+
+    def observe(self, endpoint, duration, db_queries, db_duration):
+        """Record one request's measurements against `endpoint`."""
+
+        values = (duration, db_queries, db_duration)
+
+        with self._lock:
+            for (name, _, buckets), value in zip(METRICS, values):
+                key = (name, endpoint)
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(buckets)
+                self.histograms[key].observe(value)
+
+    def register_collector(self, collector):
+        """Append the lines `collector()` returns to every /metrics scrape."""
+
+        self.collectors.append(collector)
+
+    def render(self):
+        """Return all metrics in Prometheus text exposition format."""
+
+        lines = []
+
+        with self._lock:
+            for name, help_text, _ in METRICS:
+                series = sorted(
+                    (endpoint, histogram)
+                    for (metric, endpoint), histogram in self.histograms.items()
+                    if metric == name)
+
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} histogram")
+
+                for endpoint, histogram in series:
+                    for bound, total in histogram.cumulative():
+                        le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                        lines.append(
+                            f'{name}_bucket{{endpoint="{endpoint}",le="{le}"}} '
+                            f'{total}')
+                    lines.append(
+                        f'{name}_sum{{endpoint="{endpoint}"}} {histogram.sum:g}')
+                    lines.append(
+                        f'{name}_count{{endpoint="{endpoint}"}} {histogram.count}')
+
+                lines.append(f"# HELP {name}_quantile "
+                             f"Estimated quantiles of {name}.")
+                lines.append(f"# TYPE {name}_quantile gauge")
+
+                for endpoint, histogram in series:
+                    for q in QUANTILES:
+                        lines.append(
+                            f'{name}_quantile{{endpoint="{endpoint}",'
+                            f'quantile="{q:g}"}} {histogram.quantile(q):g}')
+
+        for collector in self.collectors:
+            lines.extend(collector())
+
+        return "\n".join(lines) + "\n"
+
+    def metrics_view(self):
+        """Serve metrics for a Prometheus scraper holding METRICS_TOKEN."""
+
+        token = current_app.config.get("METRICS_TOKEN")
+
+        if not token:
+            abort(404)
+
+        if not compare_digest(request.headers.get("Authorization", ""),
+                              f"Bearer {token}"):
+            return Response("Unauthorized.\n", 401,
+                            {"WWW-Authenticate": 'Bearer realm="metrics"'},
+                            mimetype="text/plain")
+
+        return Response(self.render(),
+                        mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,10 @@
+"""The original schema: users, messages, follows and likes.
+
+Databases created before this framework existed have at least these
+tables, so there is nothing to do; migrations 0005-0009 add what came
+after them.
+"""
+
+
+def upgrade(connection):
+    pass
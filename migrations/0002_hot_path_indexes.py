@@ -0,0 +1,32 @@
+"""Index the hot access paths on the original tables.
+
+- messages by author, newest first (profile pages), and by time
+- follows by follower (who a user is following)
+- likes by message (a message's likers; cascades on delete)
+
+The timeline and search tables may not exist yet at this point; their
+indexes are made with them, in 0007-0009.
+
+Postgres can build these with CREATE INDEX CONCURRENTLY to avoid locking
+writes, but not inside a transaction; on a large, busy database create
+them by hand that way first, and this migration will skip them.
+"""
+
+STATEMENTS = [
+    "CREATE INDEX IF NOT EXISTS ix_messages_user_id_timestamp "
+    "ON messages (user_id, timestamp DESC, id DESC)",
+
+    "CREATE INDEX IF NOT EXISTS ix_messages_timestamp "
+    "ON messages (timestamp DESC, id DESC)",
+
+    "CREATE INDEX IF NOT EXISTS ix_follows_user_following_id "
+    "ON follows (user_following_id, user_being_followed_id)",
+
+    "CREATE INDEX IF NOT EXISTS ix_likes_message_liked_id "
+    "ON likes (message_liked_id)",
+]
+
+
+def upgrade(connection):
+    for statement in STATEMENTS:
+        connection.exec_driver_sql(statement)
@@ -0,0 +1,21 @@
+"""Add messages.like_count and fill it in from likes.
+
+The backfill is one UPDATE over every message; on a large database run it
+in a quiet period, or add the column here and fill it afterwards in
+batches with `flask reconcile-counters`.
+"""
+
+STATEMENTS = [
+    "ALTER TABLE messages "
+    "ADD COLUMN like_count INTEGER NOT NULL DEFAULT 0",
+
+    "UPDATE messages SET like_count = ("
+    "SELECT count(*) FROM likes WHERE likes.message_liked_id = messages.id) "
+    "WHERE EXISTS ("
+    "SELECT 1 FROM likes WHERE likes.message_liked_id = messages.id)",
+]
+
+
+def upgrade(connection):
+    for statement in STATEMENTS:
+        connection.exec_driver_sql(statement)
@@ -0,0 +1,13 @@
+"""Add users.deleted_at, set on accounts waiting to be purged."""
+
+STATEMENTS = [
+    "ALTER TABLE users ADD COLUMN deleted_at TIMESTAMP",
+
+    "CREATE INDEX IF NOT EXISTS ix_users_deleted_at ON users (deleted_at) "
+    "WHERE deleted_at IS NOT NULL",
+]
+
+
+def upgrade(connection):
+    for statement in STATEMENTS:
+        connection.exec_driver_sql(statement)
@@ -0,0 +1,47 @@
+"""Add the user search index.
+
+Postgres gets a GIN index over the search document (the expression is
+models.USER_SEARCH_DOCUMENT as it was when this migration was written). SQLite gets the users_fts
+FTS5 table, filled from `users`, and the triggers that keep it in sync.
+"""
+
+POSTGRES = [
+    "CREATE INDEX IF NOT EXISTS ix_users_search ON users USING gin ("
+    "to_tsvector('simple', "
+    "coalesce(users.username, '') || ' ' || "
+    "coalesce(users.bio, '') || ' ' || "
+    "coalesce(users.location, '')))",
+]
+
+SQLITE = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5("
+    "username, bio, location, content='users', content_rowid='id')",
+
+    "CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users "
+    "BEGIN "
+    "INSERT INTO users_fts(rowid, username, bio, location) "
+    "VALUES (new.id, new.username, new.bio, new.location); END",
+
+    "CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users "
+    "BEGIN "
+    "INSERT INTO users_fts(users_fts, rowid, username, bio, location) "
+    "VALUES ('delete', old.id, old.username, old.bio, old.location); END",
+
+    "CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE ON users "
+    "BEGIN "
+    "INSERT INTO users_fts(users_fts, rowid, username, bio, location) "
+    "VALUES ('delete', old.id, old.username, old.bio, old.location); "
+    "INSERT INTO users_fts(rowid, username, bio, location) "
+    "VALUES (new.id, new.username, new.bio, new.location); END",
+
+    # Reindex every user from the content table.
+    "INSERT INTO users_fts(users_fts) VALUES ('rebuild')",
+]
+
+
+def upgrade(connection):
+    statements = {"postgresql": POSTGRES,
+                  "sqlite": SQLITE}.get(connection.dialect.name, [])
+
+    for statement in statements:
+        connection.exec_driver_sql(statement)
@@ -0,0 +1,60 @@
+"""Add the timeline_entries table and fill it in.
+
+The entries are the ones `flask rebuild-timelines` makes: each user's own
+messages and those of the users they follow, newest TIMELINE_MAX_LENGTH
+only. A database made by create_all() after the table was added keeps its
+entries; only its page-order index is brought up to date, if it was made
+before message_id became the tie-breaker.
+"""
+
+from sqlalchemy import inspect
+
+from migrations import index_columns
+
+# models.TIMELINE_MAX_LENGTH when this migration was written, frozen here
+# (see migrations/__init__.py).
+TIMELINE_MAX_LENGTH = 800
+
+CREATE_TABLE = (
+    "CREATE TABLE timeline_entries ("
+    "user_id INTEGER NOT NULL, "
+    "message_id INTEGER NOT NULL, "
+    "timestamp TIMESTAMP NOT NULL, "
+    "PRIMARY KEY (user_id, message_id), "
+    "FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE, "
+    "FOREIGN KEY (message_id) REFERENCES messages (id) ON DELETE CASCADE)"
+)
+
+FILL = (
+    "INSERT INTO timeline_entries (user_id, message_id, timestamp) "
+    "SELECT reader_id, id, timestamp FROM ("
+    "SELECT pairs.reader_id, messages.id, messages.timestamp, "
+    "row_number() OVER ("
+    "PARTITION BY pairs.reader_id "
+    "ORDER BY messages.timestamp DESC, messages.id DESC) AS position "
+    "FROM ("
+    "SELECT user_following_id AS reader_id, "
+    "user_being_followed_id AS author_id FROM follows "
+    "UNION SELECT id, id FROM users) AS pairs "
+    "JOIN messages ON messages.user_id = pairs.author_id) AS ranked "
+    f"WHERE position <= {TIMELINE_MAX_LENGTH}"
+)
+
+PAGE_INDEX = "ix_timeline_entries_user_id_timestamp"
+
+
+def upgrade(connection):
+    if not inspect(connection).has_table("timeline_entries"):
+        connection.exec_driver_sql(CREATE_TABLE)
+        connection.exec_driver_sql(FILL)
+
+    columns = index_columns(connection, "timeline_entries").get(PAGE_INDEX)
+
+    if columns is not None and "message_id" not in columns:
+        connection.exec_driver_sql(f"DROP INDEX {PAGE_INDEX}")
+        columns = None
+
+    if columns is None:
+        connection.exec_driver_sql(
+            f"CREATE INDEX {PAGE_INDEX} ON timeline_entries "
+            f"(user_id, timestamp DESC, message_id DESC)")
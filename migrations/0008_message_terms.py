@@ -0,0 +1,68 @@
+"""Add the message_terms table (message search postings) and fill it in.
+
+Postings are made as `flask rebuild-message-index` made them when this
+migration was written, a batch of messages at a time. A
+database made by create_all() after the table was added keeps its
+postings.
+"""
+
+import re
+
+from sqlalchemy import inspect, text
+
+BATCH_SIZE = 1000
+
+# models.tokenize when this migration was written, frozen here (see
+# migrations/__init__.py).
+WORD_RE = re.compile(r"\w+")
+
+CREATE_TABLE = (
+    "CREATE TABLE message_terms ("
+    "term TEXT NOT NULL, "
+    "message_id INTEGER NOT NULL, "
+    "timestamp TIMESTAMP NOT NULL, "
+    "PRIMARY KEY (term, message_id), "
+    "FOREIGN KEY (message_id) REFERENCES messages (id) ON DELETE CASCADE)"
+)
+
+
+def tokenize(text):
+    """Split `text` into the distinct lower-case words search indexes on."""
+
+    return list(dict.fromkeys(WORD_RE.findall(text.lower())))
+
+
+def fill(connection):
+    """Add the postings of every message, in batches by id."""
+
+    batch = text("SELECT id, text, timestamp FROM messages "
+                 "WHERE id > :after ORDER BY id LIMIT :limit")
+    insert = text("INSERT INTO message_terms (term, message_id, timestamp) "
+                  "VALUES (:term, :message_id, :timestamp)")
+    after = 0
+
+    while True:
+        messages = connection.execute(
+            batch, {"after": after, "limit": BATCH_SIZE}).all()
+
+        if not messages:
+            break
+
+        postings = [dict(term=term, message_id=message_id, timestamp=timestamp)
+                    for message_id, message_text, timestamp in messages
+                    for term in tokenize(message_text)]
+
+        if postings:
+            connection.execute(insert, postings)
+
+        after = messages[-1].id
+
+
+def upgrade(connection):
+    if not inspect(connection).has_table("message_terms"):
+        connection.exec_driver_sql(CREATE_TABLE)
+        fill(connection)
+
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_message_terms_term_timestamp "
+        "ON message_terms (term, timestamp, message_id)")
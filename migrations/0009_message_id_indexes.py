@@ -0,0 +1,19 @@
+"""Index timeline entries and search postings by message.
+
+Deleting a message cascades to both; without these the cascade scans
+the tables. For a while 0002 made them too, so some databases already
+have them.
+"""
+
+STATEMENTS = [
+    "CREATE INDEX IF NOT EXISTS ix_timeline_entries_message_id "
+    "ON timeline_entries (message_id)",
+
+    "CREATE INDEX IF NOT EXISTS ix_message_terms_message_id "
+    "ON message_terms (message_id)",
+]
+
+
+def upgrade(connection):
+    for statement in STATEMENTS:
+        connection.exec_driver_sql(statement)
@@ -0,0 +1,136 @@
+"""Versioned schema migrations.
+
+Each module here named NNNN_description.py moves the schema forward one
+step, in an `upgrade(connection)` function. The versions applied to a
+database are recorded in its schema_migrations table, and upgrade() runs
+the rest in order, each in its own transaction:
+
+    flask migrate
+
+A new, empty database is instead built straight from models.py with
+create_all() and every migration is recorded as applied. So a migration
+must leave the schema exactly as models.py now declares it, and models.py
+must change in the same commit as the migration.
+
+A migration never imports models.py or reads its settings: any value it
+depends on (a limit, the search tokenizer, an index expression) is copied
+into the migration as it stood when the migration was written. models.py
+keeps changing, and an old migration must still do what it did then.
+
+A database made before there were migrations starts from 0001, the
+original schema. It may have been made by create_all() at any later point
+too, so the migrations that catch up with what was added before then
+(0005-0009) skip the columns, tables and indexes already there.
+"""
+
+import importlib
+import pkgutil
+import re
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
+MIGRATION_RE = re.compile(r"^(\d{4})_\w+$")
+
+
+def migrations():
+    """Return [(version, name, module)] for every migration, in order."""
+
+    found = []
+
+    for info in pkgutil.iter_modules(__path__):
+        match = MIGRATION_RE.match(info.name)
+
+        if match:
+            module = importlib.import_module(f"{__name__}.{info.name}")
+            found.append((int(match[1]), info.name, module))
+
+    return sorted(found)
+
+
+def ensure_table(connection):
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version INTEGER PRIMARY KEY, "
+        "name TEXT NOT NULL, "
+        "applied_at TIMESTAMP NOT NULL)"))
+
+
+def applied_versions(connection):
+    """Return the set of migration versions recorded for this database."""
+
+    ensure_table(connection)
+    rows = connection.execute(text("SELECT version FROM schema_migrations"))
+    return {version for (version,) in rows}
+
+
+def record(connection, version, name):
+    connection.execute(
+        text("INSERT INTO schema_migrations (version, name, applied_at) "
+             "VALUES (:version, :name, :applied_at)"),
+        {"version": version, "name": name, "applied_at": datetime.utcnow()})
+
+
+def column_names(connection, table):
+    """Return the names of `table`'s columns."""
+
+    return {column["name"] for column in inspect(connection).get_columns(table)}
+
+
+def index_columns(connection, table):
+    """Return {index name: [column names]} for `table`'s indexes on
+    plain columns."""
+
+    return {index["name"]: index["column_names"]
+            for index in inspect(connection).get_indexes(table)}
+
+
+def pending(engine):
+    """Return the names of the migrations not yet applied."""
+
+    with engine.begin() as connection:
+        applied = applied_versions(connection)
+
+    return [name for version, name, module in migrations()
+            if version not in applied]
+
+
+def stamp(engine):
+    """Record every migration as applied, e.g. after create_all()."""
+
+    with engine.begin() as connection:
+        applied = applied_versions(connection)
+
+        for version, name, module in migrations():
+            if version not in applied:
+                record(connection, version, name)
+
+
+def upgrade(engine, metadata):
+    """Apply the pending migrations; return their names.
+
+    If the database has no tables yet, create the current schema from
+    `metadata` and record every migration as applied instead.
+    """
+
+    if not inspect(engine).has_table("users"):
+        metadata.create_all(engine)
+        stamp(engine)
+        return []
+
+    with engine.begin() as connection:
+        applied = applied_versions(connection)
+
+    done = []
+
+    for version, name, module in migrations():
+        if version in applied:
+            continue
+
+        with engine.begin() as connection:
+            module.upgrade(connection)
+            record(connection, version, name)
+
+        done.append(name)
+
+    return done
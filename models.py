@@ -1,13 +1,159 @@
 """SQLAlchemy models for Warbler."""
 
+import re
+import sqlite3
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import backref
+from sqlalchemy import DDL, event, func, literal, select, tuple_, union
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import backref, contains_eager
+
+from passwords import password_hasher
+from replicas import RoutingSQLAlchemy
+
+db = RoutingSQLAlchemy()
+
+# Most entries kept in any one user's home timeline; older entries are pruned.
+TIMELINE_MAX_LENGTH = 800
+
+# Posting prunes its readers' timelines for one message in this many (by id),
+# so a timeline runs about this many entries over the limit between prunes.
+TIMELINE_PRUNE_EVERY = 50
+
+# The text user search matches against. On Postgres the search query has to
+# use exactly this expression for the planner to pick ix_users_search.
+USER_SEARCH_DOCUMENT = (
+    "to_tsvector('simple', "
+    "coalesce(users.username, '') || ' ' || "
+    "coalesce(users.bio, '') || ' ' || "
+    "coalesce(users.location, ''))"
+)
+
+WORD_RE = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """Split `text` into the distinct lower-case words search indexes on."""
+
+    return list(dict.fromkeys(WORD_RE.findall(text.lower())))
+
+
+def insert_new_rows(table, rows):
+    """INSERT the rows `rows` selects into `table`, skipping any that are
+    already there (ON CONFLICT DO NOTHING); return the rows inserted.
+
+    `rows` is a select of a value for every column of `table`, in order.
+    Nothing is loaded first, so the cost doesn't depend on the table size,
+    and inserting a row twice (e.g. a double click) is a no-op.
+    """
+
+    columns = [column.name for column in table.columns]
+
+    if db.engine.dialect.name == 'postgresql':
+        return db.session.execute(
+            postgresql.insert(table)
+            .from_select(columns, rows)
+            .on_conflict_do_nothing()
+            .returning(*table.columns)
+        ).all()
+
+    # SQLAlchemy 1.4 can't use RETURNING on SQLite, so look up which rows
+    # are new first.
+    candidates = [tuple(row) for row in db.session.execute(rows)]
+
+    if not candidates:
+        return []
+
+    key = tuple_(*table.columns)
+    existing = {tuple(row) for row in db.session.execute(
+        select(table).where(key.in_(candidates)))}
+    new = [row for row in candidates if row not in existing]
+
+    if not new:
+        return []
+
+    db.session.execute(sqlite.insert(table).on_conflict_do_nothing(),
+                       [dict(zip(columns, row)) for row in new])
+
+    return db.session.execute(select(table).where(key.in_(new))).all()
+
+
+def delete_rows(table, *where):
+    """DELETE the rows of `table` matching `where`; return the rows deleted."""
+
+    if db.engine.dialect.name == 'postgresql':
+        return db.session.execute(
+            table.delete().where(*where).returning(*table.columns)).all()
+
+    deleted = db.session.execute(select(table).where(*where)).all()
+
+    if deleted:
+        db.session.execute(table.delete().where(*where))
+
+    return deleted
+
+
+class CounterColumns:
+    """Denormalized COUNT(*)s stored as columns of a model.
+
+    Writes keep them up to date with change_counts() in the same
+    transaction; reconcile_counters() recomputes them from the sources the
+    model lists in counter_sources().
+    """
+
+    @classmethod
+    def counter_sources(cls):
+        """Return {counter column name: correlated COUNT(*) subquery}."""
+
+        raise NotImplementedError
+
+    @classmethod
+    def change_counts(cls, ids, **deltas):
+        """Atomically add `deltas` to counter columns of the rows in `ids`.
+
+        `ids` may be a list of ids or a select of ids, e.g.:
+
+            User.change_counts([user.id], messages_count=1)
+
+        A delta may also be a scalar subquery correlated with the row, for
+        amounts that differ from row to row.
+        """
+
+        table = cls.__table__
+
+        db.session.execute(
+            table.update()
+            .where(table.c.id.in_(ids))
+            .values({table.c[name]: table.c[name] + delta
+                     for name, delta in deltas.items()})
+        )
+
+    @classmethod
+    def reconcile_counters(cls, ids=None):
+        """Recompute counters from the underlying tables.
+
+        Only touches the rows in `ids` if given, otherwise every row.
+        Returns {counter column name: number of rows whose stored count
+        was wrong}.
+        """
+
+        table = cls.__table__
+        drift = {}
+
+        for name, source in cls.counter_sources().items():
+            actual = source.scalar_subquery()
+            stmt = (table.update()
+                    .where(table.c[name] != actual)
+                    .values({table.c[name]: actual}))
+
+            if ids is not None:
+                stmt = stmt.where(table.c.id.in_(ids))
+
+            drift[name] = db.session.execute(stmt).rowcount
+
+        return drift
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
 
 ## similar to follows, new table with 2 columns:
 ## foreign key of user id & foreign key of message ID
@@ -19,6 +165,12 @@ class Likes(db.Model):
 
     __tablename__ = 'likes'
 
+    # The primary key covers a user's likes; this covers a message's
+    # likers (like counts, and cascades when a message is deleted).
+    __table_args__ = (
+        db.Index('ix_likes_message_liked_id', 'message_liked_id'),
+    )
+
     user_liking_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -37,6 +189,13 @@ class Follows(db.Model):
 
     __tablename__ = 'follows'
 
+    # The primary key covers a user's followers; this covers who a user
+    # is following.
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
     user_being_followed_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -50,7 +209,7 @@ class Follows(db.Model):
     )
 
 
-class User(db.Model):
+class User(CounterColumns, db.Model):
     """User in the system."""
 
     __tablename__ = 'users'
@@ -95,26 +254,83 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message', order_by='Message.timestamp.desc()')
+    # Bumped whenever the profile fields shown next to the user's messages
+    # change, so caches keyed on it (e.g. rendered message cards) miss.
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default="1",
+    )
+
+    # Denormalized counts shown on profile and home pages. They are kept up
+    # to date by change_counts() in the same transaction as each write, and
+    # can be recomputed with reconcile_counters().
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    # Set when the account was deleted but was too big to delete in one
+    # request; the row and everything of theirs is purged in the background
+    # (see purge.py), and until then the user is hidden.
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
+    # Deleting a user (see delete_account) leaves their messages, follows
+    # and likes to the ON DELETE CASCADE foreign keys, so the ORM is told
+    # not to load them (passive_deletes).
+
+    messages = db.relationship('Message',
+                               order_by='Message.timestamp.desc()',
+                               passive_deletes=True)
 
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id)
+        secondaryjoin=(Follows.user_following_id == id),
+        passive_deletes=True,
     )
 
     following = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
-        secondaryjoin=(Follows.user_being_followed_id == id)
+        secondaryjoin=(Follows.user_being_followed_id == id),
+        passive_deletes=True,
     )
 
     # change to liked_messages
     liked_messages = db.relationship(
         "Message",
-        secondary='likes'
+        secondary='likes',
+        passive_deletes=True,
     )
 
 
@@ -129,24 +345,286 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    # Request-scoped answers for is_following / has_liked, filled in by
+    # preload_membership() for just the rows a page is about to render.
+    _following_ids = None
+    _liked_ids = None
+
+    def preload_membership(self, users=(), messages=()):
+        """Look up which of `users` this user follows and which of
+        `messages` they have liked, in one query each.
+
+        Later calls to is_following / has_liked for those rows are answered
+        from sets instead of scanning the whole following / liked_messages
+        relationship.
+        """
+
+        user_ids = {user.id for user in users}
+        message_ids = {message.id for message in messages}
+
+        if user_ids:
+            followed = (db.session
+                        .query(Follows.user_being_followed_id)
+                        .filter(Follows.user_following_id == self.id,
+                                Follows.user_being_followed_id.in_(user_ids)))
+            self._following_ids = {
+                user_id: False for user_id in user_ids}
+            self._following_ids.update(
+                (user_id, True) for (user_id,) in followed)
+
+        if message_ids:
+            liked = (db.session
+                     .query(Likes.message_liked_id)
+                     .filter(Likes.user_liking_id == self.id,
+                             Likes.message_liked_id.in_(message_ids)))
+            self._liked_ids = {
+                message_id: False for message_id in message_ids}
+            self._liked_ids.update(
+                (message_id, True) for (message_id,) in liked)
+
+    def cache_key(self):
+        """Return the fields that change whenever this user's profile or
+        counts, as shown on a page, change."""
+
+        return (self.id,
+                self.version,
+                self.messages_count,
+                self.following_count,
+                self.followers_count,
+                self.likes_count)
+
+    def membership_key(self):
+        """Return the preloaded follow/like answers, for use in cache keys."""
+
+        return (sorted((self._following_ids or {}).items()),
+                sorted((self._liked_ids or {}).items()))
+
+    def follow(self, user_ids):
+        """Follow the users in `user_ids`; return the ids newly followed.
+
+        Ids already followed, of no user (or a deleted one), or of this user
+        are skipped.
+        Timelines and counters are updated for the new follows.
+        """
+
+        followed = insert_new_rows(
+            Follows.__table__,
+            select(User.id, literal(self.id))
+            .where(User.id.in_(user_ids),
+                   User.id != self.id,
+                   User.deleted_at.is_(None)))
+        followed_ids = [row.user_being_followed_id for row in followed]
+
+        if followed_ids:
+            TimelineEntry.backfill(self.id, followed_ids)
+            User.change_counts([self.id], following_count=len(followed_ids))
+            User.change_counts(followed_ids, followers_count=1)
+
+        return followed_ids
+
+    def unfollow(self, user_ids):
+        """Stop following the users in `user_ids`; return the ids that were
+        followed."""
+
+        unfollowed = delete_rows(
+            Follows.__table__,
+            Follows.user_following_id == self.id,
+            Follows.user_being_followed_id.in_(user_ids))
+        unfollowed_ids = [row.user_being_followed_id for row in unfollowed]
+
+        if unfollowed_ids:
+            for followed_id in unfollowed_ids:
+                TimelineEntry.remove_author([self.id], followed_id)
+
+            User.change_counts([self.id],
+                               following_count=-len(unfollowed_ids))
+            User.change_counts(unfollowed_ids, followers_count=-1)
+
+        return unfollowed_ids
+
+    def like(self, message_ids):
+        """Like the messages in `message_ids`; return the ids newly liked.
+
+        Messages already liked, missing, or by this user are skipped.
+        """
+
+        liked = insert_new_rows(
+            Likes.__table__,
+            select(literal(self.id), Message.id)
+            .where(Message.id.in_(message_ids), Message.user_id != self.id))
+        liked_ids = [row.message_liked_id for row in liked]
+
+        if liked_ids:
+            User.change_counts([self.id], likes_count=len(liked_ids))
+            Message.change_counts(liked_ids, like_count=1)
+
+        return liked_ids
+
+    def unlike(self, message_ids):
+        """Unlike the messages in `message_ids`; return the ids that were
+        liked."""
+
+        unliked = delete_rows(
+            Likes.__table__,
+            Likes.user_liking_id == self.id,
+            Likes.message_liked_id.in_(message_ids))
+        unliked_ids = [row.message_liked_id for row in unliked]
+
+        if unliked_ids:
+            User.change_counts([self.id], likes_count=-len(unliked_ids))
+            Message.change_counts(unliked_ids, like_count=-1)
+
+        return unliked_ids
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.is_following(self)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
-    
+        if self._following_ids and other_user.id in self._following_ids:
+            return self._following_ids[other_user.id]
+
+        return db.session.query(
+            Follows.query
+            .filter_by(user_following_id=self.id,
+                       user_being_followed_id=other_user.id)
+            .exists()
+        ).scalar()
+
     ## a function to check to see if user has liked
     def has_liked(self,selected_message):
         """pass in a message and see if user has liked, return T/F """
 
-        found_liked_list = [message for message in self.liked_messages if message == selected_message]
-        return len(found_liked_list) == 1
+        if self._liked_ids and selected_message.id in self._liked_ids:
+            return self._liked_ids[selected_message.id]
+
+        return db.session.query(
+            Likes.query
+            .filter_by(user_liking_id=self.id,
+                       message_liked_id=selected_message.id)
+            .exists()
+        ).scalar()
+
+    @classmethod
+    def counter_sources(cls):
+        """Return {counter column name: correlated COUNT(*) subquery}."""
+
+        return {
+            'messages_count': (
+                select(func.count())
+                .where(Message.user_id == cls.id)),
+            'following_count': (
+                select(func.count())
+                .where(Follows.user_following_id == cls.id)),
+            'followers_count': (
+                select(func.count())
+                .where(Follows.user_being_followed_id == cls.id)),
+            'likes_count': (
+                select(func.count())
+                .where(Likes.user_liking_id == cls.id)),
+        }
+
+    @classmethod
+    def delete_account(cls, user_id):
+        """Delete the user with `user_id`; return whether there was one.
+
+        The one DELETE of their row cascades, in the database, to their
+        messages, follows, likes and timeline, and from their messages to
+        those messages' likes, timeline entries and search postings.
+        Nothing is loaded into the session. The counters of everyone else
+        involved are taken down first, one UPDATE each, while the rows are
+        still there.
+
+        The cost grows with the rows the delete cascades to; big accounts
+        are emptied with unpublish_batch() and purge_batch() first.
+        """
+
+        # Hold the row, so a concurrent delete of it can't take the
+        # counters down twice, and new follows/likes of it wait.
+        locked = db.session.execute(
+            select(cls.id).where(cls.id == user_id).with_for_update()
+        ).first()
+
+        if locked is None:
+            return False
+
+        followers = (select(Follows.user_following_id)
+                     .where(Follows.user_being_followed_id == user_id))
+        following = (select(Follows.user_being_followed_id)
+                     .where(Follows.user_following_id == user_id))
+        liked = (select(Likes.message_liked_id)
+                 .where(Likes.user_liking_id == user_id))
+        likers = (select(Likes.user_liking_id)
+                  .join(Message, Message.id == Likes.message_liked_id)
+                  .where(Message.user_id == user_id))
+        likes_of_theirs = (select(func.count())
+                           .select_from(Likes)
+                           .join(Message, Message.id == Likes.message_liked_id)
+                           .where(Likes.user_liking_id == cls.id,
+                                  Message.user_id == user_id))
+
+        cls.change_counts(followers, following_count=-1)
+        cls.change_counts(following, followers_count=-1)
+        cls.change_counts(likers,
+                          likes_count=-likes_of_theirs.scalar_subquery())
+        Message.change_counts(liked, like_count=-1)
+
+        db.session.execute(cls.__table__.delete().where(cls.id == user_id))
+
+        return True
+
+    @classmethod
+    def unpublish_batch(cls, user_id, after=0, batch_size=10):
+        """Remove the user's messages from the timelines of their next
+        `batch_size` followers, by id, after the follower `after`.
+
+        Returns the id of the last follower done, to pass as `after` for
+        the next batch, or None once there are no more. The caller
+        commits after each batch.
+        """
+
+        followers = (select(Follows.user_following_id)
+                     .where(Follows.user_being_followed_id == user_id,
+                            Follows.user_following_id > after)
+                     .order_by(Follows.user_following_id)
+                     .limit(batch_size))
+        follower_ids = [follower_id for (follower_id,)
+                        in db.session.execute(followers)]
+
+        if not follower_ids:
+            return None
+
+        TimelineEntry.remove_author(follower_ids, user_id)
+
+        return follower_ids[-1]
+
+    @classmethod
+    def purge_batch(cls, user_id, batch_size=1000):
+        """Delete up to `batch_size` of the user's messages, newest first;
+        once none are left, delete the account.
+
+        Returns the number of messages deleted: 0 means the account is
+        gone. The caller commits after each batch. Run unpublish_batch()
+        over their followers first, or each message cascades to an entry
+        in every follower's timeline.
+        """
+
+        newest = (select(Message.id)
+                  .where(Message.user_id == user_id)
+                  .order_by(Message.timestamp.desc(), Message.id.desc())
+                  .limit(batch_size))
+        message_ids = [message_id for (message_id,)
+                       in db.session.execute(newest)]
+
+        if message_ids:
+            return len(Message.delete_many(message_ids))
+
+        cls.delete_account(user_id)
+
+        return 0
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -155,7 +633,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = password_hasher.hash(password)
 
         user = User(
             username=username,
@@ -176,19 +654,71 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the stored hash was made with a different bcrypt cost than the
+        configured one, it is replaced with a fresh hash; the caller commits.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username, deleted_at=None).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = password_hasher.check(user.password, password)
             if is_auth:
+                if password_hasher.needs_rehash(user.password):
+                    user.password = password_hasher.hash(password)
                 return user
 
         return False
 
 
-class Message(db.Model):
+# The accounts waiting to be purged, without indexing everyone else.
+db.Index('ix_users_deleted_at', User.deleted_at,
+         postgresql_where=User.deleted_at.isnot(None),
+         sqlite_where=User.deleted_at.isnot(None))
+
+
+# User search indexes. Postgres gets a GIN index over USER_SEARCH_DOCUMENT;
+# SQLite (used for quick local runs) gets an FTS5 table kept in sync with
+# `users` by triggers.
+
+event.listen(
+    User.__table__,
+    'after_create',
+    DDL(f"CREATE INDEX ix_users_search ON users "
+        f"USING gin ({USER_SEARCH_DOCUMENT})"
+        ).execute_if(dialect='postgresql'),
+)
+
+for statement in (
+    "CREATE VIRTUAL TABLE users_fts USING fts5("
+    "username, bio, location, content='users', content_rowid='id')",
+
+    "CREATE TRIGGER users_fts_insert AFTER INSERT ON users BEGIN "
+    "INSERT INTO users_fts(rowid, username, bio, location) "
+    "VALUES (new.id, new.username, new.bio, new.location); END",
+
+    "CREATE TRIGGER users_fts_delete AFTER DELETE ON users BEGIN "
+    "INSERT INTO users_fts(users_fts, rowid, username, bio, location) "
+    "VALUES ('delete', old.id, old.username, old.bio, old.location); END",
+
+    "CREATE TRIGGER users_fts_update AFTER UPDATE ON users BEGIN "
+    "INSERT INTO users_fts(users_fts, rowid, username, bio, location) "
+    "VALUES ('delete', old.id, old.username, old.bio, old.location); "
+    "INSERT INTO users_fts(rowid, username, bio, location) "
+    "VALUES (new.id, new.username, new.bio, new.location); END",
+):
+    event.listen(User.__table__,
+                 'after_create',
+                 DDL(statement).execute_if(dialect='sqlite'))
+
+event.listen(
+    User.__table__,
+    'before_drop',
+    DDL("DROP TABLE IF EXISTS users_fts").execute_if(dialect='sqlite'),
+)
+
+
+class Message(CounterColumns, db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
@@ -215,8 +745,350 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # How many users like this message; see CounterColumns.
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
     user = db.relationship('User')
 
+    @classmethod
+    def published(cls):
+        """Return a query for messages with their authors loaded, leaving
+        out those whose author is deleted and waiting to be purged."""
+
+        return (cls.query
+                .join(User, User.id == cls.user_id)
+                .options(contains_eager(cls.user))
+                .filter(User.deleted_at.is_(None)))
+
+    @classmethod
+    def counter_sources(cls):
+        """Return {counter column name: correlated COUNT(*) subquery}."""
+
+        return {
+            'like_count': (
+                select(func.count())
+                .where(Likes.message_liked_id == cls.id)),
+        }
+
+    @classmethod
+    def delete_many(cls, message_ids):
+        """Delete the messages in the list `message_ids`; return the
+        (id, user_id) rows of those that were there.
+
+        The DELETE cascades, in the database, to their likes, timeline
+        entries and search postings. First, in one UPDATE each, authors'
+        messages_count and likers' likes_count are taken down by as many
+        of those rows as they had.
+        """
+
+        # Hold the rows, so a concurrent delete of the same messages (a
+        # double click) waits and then finds nothing left to count.
+        deleted = db.session.execute(
+            select(cls.id, cls.user_id)
+            .where(cls.id.in_(message_ids))
+            .with_for_update()
+        ).all()
+
+        if not deleted:
+            return []
+
+        message_ids = [row.id for row in deleted]
+        likes_taken = (select(func.count())
+                       .where(Likes.user_liking_id == User.id,
+                              Likes.message_liked_id.in_(message_ids)))
+        posts_taken = (select(func.count())
+                       .where(cls.user_id == User.id,
+                              cls.id.in_(message_ids)))
+
+        User.change_counts(
+            select(Likes.user_liking_id)
+            .where(Likes.message_liked_id.in_(message_ids)),
+            likes_count=-likes_taken.scalar_subquery())
+        User.change_counts(
+            sorted({row.user_id for row in deleted}),
+            messages_count=-posts_taken.scalar_subquery())
+
+        db.session.execute(
+            cls.__table__.delete().where(cls.id.in_(message_ids)))
+
+        return deleted
+
+
+# Profile pages page through one user's messages newest first; other
+# message lists (search, likes) order by the same key.
+db.Index('ix_messages_user_id_timestamp',
+         Message.user_id, Message.timestamp.desc(), Message.id.desc())
+db.Index('ix_messages_timestamp', Message.timestamp.desc(), Message.id.desc())
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into a user's home timeline.
+
+    Rows are written when a message is posted (fan-out on write) and when a
+    user follows someone, so the home page is a range read on
+    (user_id, timestamp) instead of a sort over the whole messages table.
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    @classmethod
+    def timeline(cls, user_id):
+        """Return (unordered) query for the messages in a user's timeline."""
+
+        return (Message
+                .published()
+                .join(cls, cls.message_id == Message.id)
+                .filter(cls.user_id == user_id))
+
+    @classmethod
+    def fan_out(cls, message):
+        """Add `message` to its author's timeline and their followers'.
+
+        The message must already be flushed so that it has an id.
+
+        Pruning ranks every reader's whole timeline, so it is only done for
+        one message in TIMELINE_PRUNE_EVERY. Home pages read from the newest
+        end and don't notice the few extra entries in between.
+        """
+
+        readers = union(
+            select(Follows.user_following_id.label('user_id'))
+            .where(Follows.user_being_followed_id == message.user_id),
+            select(literal(message.user_id).label('user_id')),
+        )
+        reader_ids = readers.subquery()
+
+        db.session.execute(
+            cls.__table__.insert().from_select(
+                ['user_id', 'message_id', 'timestamp'],
+                select(reader_ids.c.user_id,
+                       literal(message.id),
+                       literal(message.timestamp, db.DateTime)),
+            )
+        )
+
+        if message.id % TIMELINE_PRUNE_EVERY == 0:
+            cls.prune(select(reader_ids.c.user_id))
+
+    @classmethod
+    def backfill(cls, follower_id, followed_ids):
+        """Copy the recent messages of the users in `followed_ids` into
+        `follower_id`'s timeline, in one INSERT, then prune it once."""
+
+        already_there = (
+            select(cls.message_id)
+            .where(cls.user_id == follower_id)
+        )
+
+        recent = (
+            select(literal(follower_id), Message.id, Message.timestamp)
+            .where(Message.user_id.in_(followed_ids))
+            .where(Message.id.not_in(already_there))
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(TIMELINE_MAX_LENGTH)
+        )
+
+        db.session.execute(
+            cls.__table__.insert().from_select(
+                ['user_id', 'message_id', 'timestamp'], recent)
+        )
+
+        cls.prune([follower_id])
+
+    @classmethod
+    def remove_author(cls, follower_ids, followed_id):
+        """Remove `followed_id`'s messages from the timelines of the users
+        in `follower_ids`."""
+
+        authored = (
+            select(Message.id)
+            .where(Message.user_id == followed_id)
+        )
+
+        (cls.query
+            .filter(cls.user_id.in_(follower_ids),
+                    cls.message_id.in_(authored))
+            .delete(synchronize_session=False))
+
+    @classmethod
+    def prune(cls, user_ids):
+        """Trim the timelines of `user_ids` to TIMELINE_MAX_LENGTH entries.
+
+        `user_ids` may be a list of ids or a select of ids.
+        """
+
+        ranked = (
+            select(
+                cls.user_id,
+                cls.message_id,
+                func.row_number().over(
+                    partition_by=cls.user_id,
+                    order_by=(cls.timestamp.desc(), cls.message_id.desc()),
+                ).label('position'),
+            )
+            .where(cls.user_id.in_(user_ids))
+            .subquery()
+        )
+
+        overflow = (
+            select(ranked.c.user_id, ranked.c.message_id)
+            .where(ranked.c.position > TIMELINE_MAX_LENGTH)
+        )
+
+        db.session.execute(
+            cls.__table__.delete().where(
+                db.tuple_(cls.user_id, cls.message_id).in_(overflow))
+        )
+
+    @classmethod
+    def rebuild(cls):
+        """Recompute every user's timeline from messages and follows."""
+
+        db.session.execute(cls.__table__.delete())
+
+        pairs = union(
+            select(Follows.user_following_id.label('reader_id'),
+                   Follows.user_being_followed_id.label('author_id')),
+            select(User.id.label('reader_id'), User.id.label('author_id')),
+        ).subquery()
+
+        ranked = (
+            select(
+                pairs.c.reader_id,
+                Message.id,
+                Message.timestamp,
+                func.row_number().over(
+                    partition_by=pairs.c.reader_id,
+                    order_by=(Message.timestamp.desc(), Message.id.desc()),
+                ).label('position'),
+            )
+            .join(Message, Message.user_id == pairs.c.author_id)
+            .subquery()
+        )
+
+        db.session.execute(
+            cls.__table__.insert().from_select(
+                ['user_id', 'message_id', 'timestamp'],
+                select(ranked.c.reader_id, ranked.c.id, ranked.c.timestamp)
+                .where(ranked.c.position <= TIMELINE_MAX_LENGTH),
+            )
+        )
+
+
+# A home page is a range read on one user's entries, newest first.
+db.Index('ix_timeline_entries_user_id_timestamp',
+         TimelineEntry.user_id,
+         TimelineEntry.timestamp.desc(),
+         TimelineEntry.message_id.desc())
+# Deleting a message cascades to its entries in every follower's timeline.
+db.Index('ix_timeline_entries_message_id', TimelineEntry.message_id)
+
+
+class MessageTerm(db.Model):
+    """One posting in the inverted index of message words.
+
+    Each (term, message) pair is stored with the message's timestamp, so a
+    search for a term is a range read on (term, timestamp) and never has to
+    touch the messages table to find or order its matches.
+    """
+
+    __tablename__ = 'message_terms'
+
+    __table_args__ = (
+        db.Index('ix_message_terms_term_timestamp',
+                 'term', 'timestamp', 'message_id'),
+        # For the cascade when a message is deleted.
+        db.Index('ix_message_terms_message_id', 'message_id'),
+    )
+
+    term = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    @classmethod
+    def index(cls, message):
+        """Add postings for `message`, which must already be flushed.
+
+        Postings are removed by the ON DELETE CASCADE when the message is
+        deleted.
+        """
+
+        postings = [dict(term=term,
+                         message_id=message.id,
+                         timestamp=message.timestamp)
+                    for term in tokenize(message.text)]
+
+        if postings:
+            db.session.execute(cls.__table__.insert(), postings)
+
+    @classmethod
+    def rebuild(cls, batch_size=1000):
+        """Recompute every posting from the messages table."""
+
+        db.session.execute(cls.__table__.delete())
+
+        messages = (db.session
+                    .query(Message.id, Message.text, Message.timestamp)
+                    .yield_per(batch_size))
+        postings = []
+
+        for message_id, text, timestamp in messages:
+            postings.extend(dict(term=term,
+                                 message_id=message_id,
+                                 timestamp=timestamp)
+                            for term in tokenize(text))
+
+            if len(postings) >= batch_size:
+                db.session.execute(cls.__table__.insert(), postings)
+                postings = []
+
+        if postings:
+            db.session.execute(cls.__table__.insert(), postings)
+
+
+@event.listens_for(Engine, "connect")
+def _enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """Have SQLite enforce foreign keys (and so ON DELETE CASCADE), which
+    it doesn't by default; deleting a message relies on it."""
+
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.execute("PRAGMA foreign_keys = ON")
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
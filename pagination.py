@@ -0,0 +1,150 @@
+"""Keyset (cursor) pagination for Warbler's message and user lists.
+
+Pages are fetched with a `WHERE (key) < (cursor)` range condition rather
+than OFFSET, so loading page 500 of a profile costs the same as page 1.
+"""
+
+from collections import namedtuple
+from datetime import datetime
+from itertools import islice
+
+from models import db, Message, User
+
+MESSAGES_PER_PAGE = 50
+USERS_PER_PAGE = 48
+
+Page = namedtuple("Page", ["items", "next_cursor"])
+
+
+def encode_message_cursor(message):
+    """Return the cursor for the page after `message`."""
+
+    return f"{message.timestamp.isoformat()}_{message.id}"
+
+
+def decode_message_cursor(cursor):
+    """Turn a message cursor back into a (timestamp, id) key.
+
+    Returns None if there is no cursor or it can't be parsed, which shows
+    the first page.
+    """
+
+    try:
+        timestamp, message_id = cursor.rsplit("_", 1)
+        return (datetime.fromisoformat(timestamp), int(message_id))
+    except (AttributeError, ValueError):
+        return None
+
+
+def decode_user_cursor(cursor):
+    """Turn a user cursor back into an (id,) key, or None."""
+
+    try:
+        return (int(cursor),)
+    except (TypeError, ValueError):
+        return None
+
+
+def keyset_query(query, columns, key, per_page, descending):
+    """Return `query` limited to one page (plus one row) after `key`."""
+
+    if key is not None:
+        row = db.tuple_(*columns)
+        bound = db.tuple_(*key)
+        query = query.filter(row < bound if descending else row > bound)
+
+    order = [col.desc() if descending else col.asc() for col in columns]
+    return query.order_by(*order).limit(per_page + 1)
+
+
+def keyset_page(query, columns, key, per_page, descending):
+    """Fetch one page of `query` ordered by `columns`, starting after `key`.
+
+    Returns (items, has_more). One extra row is fetched to find out if
+    there is another page without running a COUNT.
+    """
+
+    items = keyset_query(query, columns, key, per_page, descending).all()
+
+    return items[:per_page], len(items) > per_page
+
+
+def paginate_messages(query,
+                      cursor,
+                      per_page=MESSAGES_PER_PAGE,
+                      timestamp=Message.timestamp,
+                      message_id=Message.id):
+    """Page through a message query, newest first.
+
+    `timestamp` and `message_id` are the columns to key on; pass the
+    TimelineEntry columns when paging through a home timeline.
+    """
+
+    messages, has_more = keyset_page(query,
+                                     (timestamp, message_id),
+                                     decode_message_cursor(cursor),
+                                     per_page,
+                                     descending=True)
+
+    next_cursor = encode_message_cursor(messages[-1]) if has_more else None
+    return Page(messages, next_cursor)
+
+
+def paginate_users(query, cursor, per_page=USERS_PER_PAGE):
+    """Page through a user query in id order."""
+
+    users, has_more = keyset_page(query,
+                                  (User.id,),
+                                  decode_user_cursor(cursor),
+                                  per_page,
+                                  descending=False)
+
+    next_cursor = str(users[-1].id) if has_more else None
+    return Page(users, next_cursor)
+
+
+class StreamedPage:
+    """A page of users fetched in batches while it is being rendered.
+
+    Use in place of a Page whose items are only iterated once, such as by
+    a streamed template: `items` yields rows as they come off a
+    server-side cursor, `batch_size` at a time, calling `on_batch` with
+    each batch first (e.g. to preload follow state for it). `next_cursor`
+    is only known once `items` has been read to the end.
+    """
+
+    def __init__(self, query, cursor, per_page=USERS_PER_PAGE,
+                 batch_size=100, on_batch=None):
+        self.query = keyset_query(query,
+                                  (User.id,),
+                                  decode_user_cursor(cursor),
+                                  per_page,
+                                  descending=False)
+        self.per_page = per_page
+        self.batch_size = batch_size
+        self.on_batch = on_batch
+        self.next_cursor = None
+
+    @property
+    def items(self):
+        rows = iter(self.query
+                    .execution_options(stream_results=True)
+                    .yield_per(self.batch_size))
+        seen = 0
+        last = None
+
+        while batch := list(islice(rows, self.batch_size)):
+            more = seen + len(batch) > self.per_page
+            # The extra row only tells us there's another page.
+            batch = batch[:self.per_page - seen]
+
+            if batch and self.on_batch is not None:
+                self.on_batch(batch)
+
+            yield from batch
+            seen += len(batch)
+            last = batch[-1] if batch else last
+
+            if more:
+                self.next_cursor = str(last.id)
+                break
@@ -0,0 +1,118 @@
+"""Password hashing on a bounded pool of worker threads.
+
+A bcrypt hash or check costs a few hundred milliseconds of CPU. Running it
+on a small, fixed pool caps how many run at once in a worker process, so a
+burst of logins can't take every thread away from page traffic (bcrypt
+releases the GIL while it works).
+
+That only holds if fewer request threads can be waiting on the pool than
+the worker runs (WEB_THREADS, gunicorn's --threads), so BCRYPT_MAX_PENDING
+(hashes running or queued) defaults to half of them and init_app refuses a
+setting that isn't below it. When the pool and its queue are full, callers
+get PasswordHasherBusy straight away (after BCRYPT_QUEUE_WAIT seconds, 0 by
+default) rather than piling up behind it.
+
+The bcrypt cost factor comes from BCRYPT_LOG_ROUNDS. Hashes made with a
+different cost are reported by needs_rehash(), so User.authenticate can
+upgrade them on the next successful login.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+
+import bcrypt
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many hashes are already running or queued."""
+
+
+class PasswordHasher:
+    """Bcrypt hashing and checking on a bounded thread pool."""
+
+    def __init__(self, rounds=12, workers=2, max_pending=4, wait=0):
+        self.configure(rounds, workers, max_pending, wait)
+
+    def init_app(self, app):
+        """Configure from BCRYPT_LOG_ROUNDS, BCRYPT_WORKERS,
+        BCRYPT_MAX_PENDING and BCRYPT_QUEUE_WAIT in `app.config`.
+
+        Raises ValueError unless the pending limit is below WEB_THREADS.
+        """
+
+        threads = app.config.get('WEB_THREADS', 8)
+        workers = app.config.get('BCRYPT_WORKERS', 2)
+        max_pending = max(app.config.get('BCRYPT_MAX_PENDING', threads // 2),
+                          workers)
+
+        if max_pending >= threads:
+            raise ValueError(
+                f"BCRYPT_MAX_PENDING (and BCRYPT_WORKERS) must be below "
+                f"WEB_THREADS ({threads}), or password hashing can hold "
+                f"every request thread; got {max_pending}.")
+
+        self.configure(
+            rounds=app.config.get('BCRYPT_LOG_ROUNDS', 12),
+            workers=workers,
+            max_pending=max_pending,
+            wait=app.config.get('BCRYPT_QUEUE_WAIT', 0),
+        )
+
+    def configure(self, rounds, workers, max_pending, wait):
+        if getattr(self, '_executor', None) is not None:
+            self._executor.shutdown(wait=False)
+
+        self.rounds = rounds
+        self.wait = wait
+        self.max_pending = max(max_pending, workers)
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix="bcrypt")
+        self._slots = BoundedSemaphore(self.max_pending)
+
+    def _run(self, fn, *args):
+        """Run `fn(*args)` on the pool and return its result."""
+
+        # A timeout of 0 doesn't block at all.
+        if not self._slots.acquire(timeout=self.wait):
+            raise PasswordHasherBusy()
+
+        try:
+            return self._executor.submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        """Return a bcrypt hash of `password` (as text) at the current cost."""
+
+        if not password:
+            raise ValueError("Password must be non-empty.")
+
+        hashed = self._run(bcrypt.hashpw,
+                           password.encode('utf-8'),
+                           bcrypt.gensalt(self.rounds))
+        return hashed.decode('utf-8')
+
+    def check(self, hashed, password):
+        """Does `password` match the bcrypt hash `hashed`?
+
+        Raises ValueError if `hashed` isn't a bcrypt hash.
+        """
+
+        if not password:
+            return False
+
+        return self._run(bcrypt.checkpw,
+                         password.encode('utf-8'),
+                         hashed.encode('utf-8'))
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different cost than the current one?"""
+
+        # Bcrypt hashes look like $2b$12$<salt+hash>.
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,168 @@
+"""Deleting big accounts in the background.
+
+User.delete_account() deletes an account with one DELETE and lets the
+database cascade it to everything of theirs. That is quick for most users,
+but an account with a hundred thousand messages cascades to every like,
+timeline entry and search posting of each of them, and one transaction
+that size would hold its locks for seconds.
+
+So an account whose delete would cascade to more than USER_PURGE_THRESHOLD
+rows (estimated from its counters) is only marked deleted in the request:
+its `deleted_at` is set and the user is logged out, can't log in, and is
+gone from profile pages, follow lists, the directory, user search and the
+API. Its messages are gone too: every message listing goes through
+Message.published(), which leaves out deleted authors' messages. A worker
+thread then purges it in transactions of about USER_PURGE_BATCH_SIZE rows
+each:
+
+1. User.unpublish_batch() takes its messages out of its followers'
+   timelines, a few followers at a time (each has up to
+   TIMELINE_MAX_LENGTH of them), so they leave home pages first;
+2. User.purge_batch() deletes its messages, newest first, each cascading
+   to its likes and search postings;
+3. the account row goes last, with its follows and likes.
+
+If the process stops part way, `flask purge-deleted-users` finishes every
+account still marked deleted.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, wait
+from threading import Lock
+
+from models import db, User, TIMELINE_MAX_LENGTH
+
+# Rows a message's delete cascades to once it is out of followers'
+# timelines, roughly: its search postings, likes and the author's own
+# timeline entry.
+ROWS_PER_MESSAGE = 10
+
+
+class UserPurger:
+    """Purge deleted accounts on a single background thread."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.threshold = 10_000
+        self.batch_size = 10_000
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix="purge")
+        self._lock = Lock()
+        self._running = set()
+        self.purged = 0
+        self.messages_purged = 0
+        self.failures = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Configure from USER_PURGE_THRESHOLD and USER_PURGE_BATCH_SIZE in
+        `app.config`."""
+
+        self.app = app
+        self.threshold = app.config.get("USER_PURGE_THRESHOLD",
+                                        self.threshold)
+        self.batch_size = app.config.get("USER_PURGE_BATCH_SIZE",
+                                         self.batch_size)
+
+    def too_big(self, user):
+        """Is `user`'s account too big to delete within a request?"""
+
+        in_timelines = min(user.messages_count, TIMELINE_MAX_LENGTH)
+        rows = (user.messages_count * ROWS_PER_MESSAGE
+                + user.followers_count * (in_timelines + 1)
+                + user.following_count
+                + user.likes_count)
+
+        return rows > self.threshold
+
+    def schedule(self, user_id):
+        """Purge the account `user_id` on the worker thread; return its
+        Future. The account must already be marked deleted (and
+        committed)."""
+
+        future = self._executor.submit(self._run, user_id)
+
+        with self._lock:
+            self._running.add(future)
+
+        future.add_done_callback(self._done)
+
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._running.discard(future)
+
+    def _run(self, user_id):
+        with self.app.app_context():
+            try:
+                return self.purge(user_id)
+            except Exception:
+                db.session.rollback()
+
+                with self._lock:
+                    self.failures += 1
+
+                self.app.logger.exception(
+                    "Purging user %s failed; `flask purge-deleted-users` "
+                    "will retry it.", user_id)
+                raise
+
+    def purge(self, user_id):
+        """Delete the account `user_id` batch by batch, committing each;
+        return the number of messages deleted."""
+
+        followers = max(1, self.batch_size // TIMELINE_MAX_LENGTH)
+        messages = max(1, self.batch_size // ROWS_PER_MESSAGE)
+        after = 0
+
+        while after is not None:
+            after = User.unpublish_batch(user_id, after, followers)
+            db.session.commit()
+
+        total = 0
+
+        while True:
+            deleted = User.purge_batch(user_id, messages)
+            db.session.commit()
+            total += deleted
+
+            with self._lock:
+                self.messages_purged += deleted
+
+            if not deleted:
+                break
+
+        with self._lock:
+            self.purged += 1
+
+        return total
+
+    def join(self, timeout=None):
+        """Wait for the purges scheduled so far to finish."""
+
+        with self._lock:
+            running = list(self._running)
+
+        wait(running, timeout=timeout)
+
+    def render_metrics(self):
+        """Return the purge counts as Prometheus text lines."""
+
+        with self._lock:
+            running = len(self._running)
+            purged = self.purged
+            messages_purged = self.messages_purged
+            failures = self.failures
+
+        return [
+            "# TYPE warbler_user_purges_running gauge",
+            f"warbler_user_purges_running {running}",
+            "# TYPE warbler_users_purged_total counter",
+            f"warbler_users_purged_total {purged}",
+            "# TYPE warbler_messages_purged_total counter",
+            f"warbler_messages_purged_total {messages_purged}",
+            "# TYPE warbler_user_purge_failures_total counter",
+            f"warbler_user_purge_failures_total {failures}",
+        ]
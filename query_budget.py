@@ -0,0 +1,101 @@
+"""Count the SQL statements a block of code runs, and time them.
+
+Used by the test suite to pin how many queries each route may run, so an
+accidental N+1 (e.g. touching `msg.user` lazily in a loop) fails a test
+instead of quietly getting slower as data grows:
+
+    with query_budget(4):
+        client.get("/")
+"""
+
+from contextlib import ContextDecorator
+from contextvars import ContextVar
+from time import perf_counter
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Counters that are currently active in this thread / context.
+_active_counters = ContextVar("active_query_counters", default=())
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised when a block runs more SQL statements than its budget."""
+
+
+class QueryCounter(ContextDecorator):
+    """Context manager that counts SQL statements run inside it, and the
+    total seconds spent executing them."""
+
+    def __init__(self, keep_statements=True):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = []
+        self.keep_statements = keep_statements
+        self._token = None
+
+    def __enter__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = []
+        self._token = _active_counters.set(_active_counters.get() + (self,))
+        return self
+
+    def __exit__(self, *exc):
+        # Take only this counter out: counters needn't exit in the order
+        # they entered (a request's counter stops at teardown, which for a
+        # preserved test request comes after the next block has started).
+        _active_counters.set(tuple(counter
+                                   for counter in _active_counters.get()
+                                   if counter is not self))
+        return False
+
+
+class query_budget(QueryCounter):
+    """Context manager / decorator that fails if more than `limit` SQL
+    statements run inside it."""
+
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+
+    def __exit__(self, exc_type, *exc):
+        super().__exit__(exc_type, *exc)
+
+        if exc_type is None and self.count > self.limit:
+            statements = "\n\n".join(self.statements)
+            raise QueryBudgetExceeded(
+                f"Ran {self.count} SQL statements, budget was {self.limit}:"
+                f"\n\n{statements}")
+
+        return False
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    """Record `statement` against every active counter."""
+
+    counters = _active_counters.get()
+
+    if counters:
+        context._query_budget_start = perf_counter()
+
+    for counter in counters:
+        counter.count += 1
+        if counter.keep_statements:
+            counter.statements.append(statement)
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _time_statement(conn, cursor, statement, parameters, context, executemany):
+    """Add the time `statement` took to every active counter."""
+
+    start = getattr(context, "_query_budget_start", None)
+
+    if start is None:
+        return
+
+    elapsed = perf_counter() - start
+
+    for counter in _active_counters.get():
+        counter.duration += elapsed
@@ -0,0 +1,219 @@
+"""Token-bucket rate limiting for the bcrypt-heavy auth endpoints.
+
+Every login, signup and profile-edit attempt takes a token from a bucket
+for the client's IP (request.remote_addr, read from X-Forwarded-For as far
+as TRUSTED_PROXY_HOPS allows) and one for the username involved. Buckets
+hold up to `burst` tokens and refill at `per_minute` tokens a minute. An
+attempt with an empty bucket is rejected before any password is hashed, so
+the CPU spent on bcrypt stays bounded however many attempts arrive.
+
+Buckets live in process memory by default. Setting AUTH_RATE_LIMIT_DB to a
+file path keeps them in a local SQLite database instead, shared by every
+gunicorn worker on the machine.
+"""
+
+import sqlite3
+import threading
+from collections import OrderedDict
+from time import time
+
+
+class RateLimited(Exception):
+    """Raised when an attempt is over its rate limit."""
+
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+def refill(tokens, updated, now, burst, per_second):
+    """Return the tokens in a bucket last left with `tokens` at `updated`."""
+
+    return min(burst, tokens + (now - updated) * per_second)
+
+
+class MemoryBuckets:
+    """Token buckets in a bounded in-process LRU.
+
+    Evicting a bucket forgets it, which is the same as it being full, so
+    the bound can only make the limiter more lenient, never stricter.
+    """
+
+    def __init__(self, maxsize=100_000):
+        self.maxsize = maxsize
+        # {key: (tokens, updated)}
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, burst, per_second, now):
+        """Take a token from `key`'s bucket; return tokens left, or -1 if
+        the bucket was empty."""
+
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = refill(tokens, updated, now, burst, per_second)
+
+            if tokens >= 1:
+                tokens -= 1
+                remaining = tokens
+            else:
+                remaining = -1
+
+            self._buckets[key] = (tokens, now)
+
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+
+            return remaining
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SQLiteBuckets:
+    """Token buckets in a local SQLite file, shared between processes."""
+
+    # Delete full buckets every this many takes, to keep the table small.
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._takes = 0
+
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "key TEXT PRIMARY KEY, tokens REAL NOT NULL, "
+                "updated REAL NOT NULL)")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+
+        return conn
+
+    def take(self, key, burst, per_second, now):
+        """Take a token from `key`'s bucket; return tokens left, or -1 if
+        the bucket was empty."""
+
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+
+        try:
+            row = conn.execute(
+                "SELECT tokens, updated FROM buckets WHERE key = ?",
+                (key,)).fetchone()
+            tokens = burst if row is None else refill(
+                row[0], row[1], now, burst, per_second)
+
+            if tokens >= 1:
+                tokens -= 1
+                remaining = tokens
+            else:
+                remaining = -1
+
+            conn.execute(
+                "INSERT INTO buckets (key, tokens, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE "
+                "SET tokens = excluded.tokens, updated = excluded.updated",
+                (key, tokens, now))
+
+            self._takes += 1
+            if self._takes % self.PRUNE_EVERY == 0:
+                conn.execute("DELETE FROM buckets WHERE updated < ?",
+                             (now - burst / per_second,))
+
+            conn.execute("COMMIT")
+
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        return remaining
+
+    def clear(self):
+        self._connection().execute("DELETE FROM buckets")
+
+
+class AuthRateLimiter:
+    """Per-IP and per-username token buckets for auth attempts."""
+
+    def __init__(self, app=None):
+        self.enabled = True
+        self.buckets = MemoryBuckets()
+        # {scope: (burst, tokens per second)}
+        self.limits = {"ip": (20, 10 / 60), "username": (5, 5 / 60)}
+        # {(scope, outcome): count}, e.g. {("ip", "rejected"): 3}
+        self.counts = {(scope, outcome): 0
+                       for scope in ("ip", "username")
+                       for outcome in ("allowed", "rejected")}
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Configure from AUTH_RATE_LIMIT_* settings in `app.config`."""
+
+        self.enabled = app.config.get('AUTH_RATE_LIMIT_ENABLED', True)
+        self.limits = {
+            "ip": (app.config.get('AUTH_RATE_LIMIT_IP_BURST', 20),
+                   app.config.get('AUTH_RATE_LIMIT_IP_PER_MINUTE', 10) / 60),
+            "username": (
+                app.config.get('AUTH_RATE_LIMIT_USERNAME_BURST', 5),
+                app.config.get('AUTH_RATE_LIMIT_USERNAME_PER_MINUTE', 5) / 60),
+        }
+
+        path = app.config.get('AUTH_RATE_LIMIT_DB')
+        self.buckets = SQLiteBuckets(path) if path else MemoryBuckets()
+
+    def check(self, ip, username):
+        """Take a token for `ip` and for `username`.
+
+        Raises RateLimited if either bucket is empty. Only the buckets
+        checked before the empty one are charged.
+        """
+
+        if not self.enabled:
+            return
+
+        now = time()
+
+        for scope, key in (("ip", ip), ("username", username)):
+            if not key:
+                continue
+
+            burst, per_second = self.limits[scope]
+            remaining = self.buckets.take(f"{scope}:{key.lower()}",
+                                          burst, per_second, now)
+            outcome = "allowed" if remaining >= 0 else "rejected"
+
+            with self._lock:
+                self.counts[scope, outcome] += 1
+
+            if outcome == "rejected":
+                raise RateLimited(retry_after=max(1, round(1 / per_second)))
+
+    def reset(self):
+        """Forget every bucket, e.g. between tests."""
+
+        self.buckets.clear()
+
+    def render_metrics(self):
+        """Return the allowed/rejected counters as Prometheus text lines."""
+
+        lines = ["# TYPE warbler_auth_rate_limit_total counter"]
+
+        with self._lock:
+            for (scope, outcome), count in sorted(self.counts.items()):
+                lines.append(
+                    f'warbler_auth_rate_limit_total'
+                    f'{{scope="{scope}",outcome="{outcome}"}} {count}')
+
+        return lines
@@ -0,0 +1,162 @@
+"""Routing reads to read replicas.
+
+With DATABASE_REPLICA_URLS set, each replica becomes an extra bind
+(replica1, replica2, ...). ReadReplicas then picks one of them for every
+GET/HEAD/OPTIONS request, and RoutingSession sends that request's SELECTs
+to it. Everything else goes to the primary:
+
+- writes, and any request with an unsafe method such as POST;
+- reads later in a request that has written something;
+- every request from the same browser for REPLICA_STICKY_SECONDS after
+  one that wrote, so a user sees their own changes (read-your-writes)
+  while the replicas catch up.
+
+Stickiness is tracked in the Flask session, so it follows the user across
+workers. Replicas must be copies of the primary: tables are created, and
+migrations run, on the primary only.
+"""
+
+import random
+from threading import Lock
+from time import time
+
+from flask import g, has_app_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import orm
+from sqlalchemy.sql import Select
+
+SAFE_METHODS = frozenset(["GET", "HEAD", "OPTIONS"])
+
+# Session key: until when (a Unix time) this browser reads from the primary.
+PRIMARY_UNTIL_KEY = "db_primary_until"
+
+# Engine options for sizing a connection pool. SQLite files are opened
+# without a pool (NullPool), which doesn't take them.
+POOL_SIZE_OPTIONS = ("pool_size", "max_overflow", "pool_timeout")
+
+
+class RoutingSession(SignallingSession):
+    """Session that reads from the request's replica when it can."""
+
+    def get_bind(self, mapper=None, clause=None):
+        """Return the replica for a SELECT in a request routed to one,
+        else the primary (or the model's own bind)."""
+
+        if not has_app_context():
+            return super().get_bind(mapper, clause)
+
+        if self._flushing or getattr(clause, "is_dml", False):
+            g.db_wrote = True
+
+        replica = g.get("db_replica")
+
+        if (replica is not None
+                and not g.get("db_wrote")
+                and isinstance(clause, Select)
+                and not _bind_key(mapper)):
+            return self.db.get_engine(self.app, bind=replica)
+
+        return super().get_bind(mapper, clause)
+
+    @property
+    def db(self):
+        return self.app.extensions["sqlalchemy"].db
+
+
+def _bind_key(mapper):
+    """Return the __bind_key__ of `mapper`'s table, if any."""
+
+    if mapper is None:
+        return None
+
+    return mapper.persist_selectable.info.get("bind_key")
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy using RoutingSession, and leaving pool sizing out
+    of the options for SQLite engines."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def create_engine(self, sa_url, engine_opts):
+        if sa_url.get_backend_name() == "sqlite":
+            engine_opts = {key: value for key, value in engine_opts.items()
+                           if key not in POOL_SIZE_OPTIONS}
+
+        return super().create_engine(sa_url, engine_opts)
+
+
+class ReadReplicas:
+    """Pick a replica for each read-only request; see the module docs."""
+
+    def __init__(self, app=None):
+        self.binds = []
+        self.sticky_seconds = 5
+        self._lock = Lock()
+        # {bind name or "primary": read-only requests routed there}
+        self.routed = {}
+        self.sticky = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        urls = app.config.get("DATABASE_REPLICA_URLS") or []
+        binds = app.config.get("SQLALCHEMY_BINDS") or {}
+        self.binds = []
+
+        for n, url in enumerate(urls, 1):
+            binds[f"replica{n}"] = url
+            self.binds.append(f"replica{n}")
+
+        app.config["SQLALCHEMY_BINDS"] = binds
+        self.sticky_seconds = app.config.get("REPLICA_STICKY_SECONDS",
+                                             self.sticky_seconds)
+
+        app.before_request(self.route_request)
+        app.after_request(self.remember_writes)
+
+    def route_request(self):
+        """Choose where this request's reads go."""
+
+        g.db_replica = None
+        g.db_wrote = False
+
+        if not self.binds or request.method not in SAFE_METHODS:
+            return
+
+        sticky = session.get(PRIMARY_UNTIL_KEY, 0) > time()
+
+        if not sticky:
+            g.db_replica = random.choice(self.binds)
+
+        with self._lock:
+            destination = g.db_replica or "primary"
+            self.routed[destination] = self.routed.get(destination, 0) + 1
+            self.sticky += sticky
+
+    def remember_writes(self, response):
+        """Keep this browser on the primary for a while after a write."""
+
+        if self.binds and (request.method not in SAFE_METHODS
+                           or g.get("db_wrote")):
+            session[PRIMARY_UNTIL_KEY] = time() + self.sticky_seconds
+
+        return response
+
+    def render_metrics(self):
+        """Return the routing counts as Prometheus text lines."""
+
+        with self._lock:
+            routed = sorted(self.routed.items())
+            sticky = self.sticky
+
+        lines = ["# TYPE warbler_db_read_requests_total counter"]
+        lines.extend(f'warbler_db_read_requests_total{{database="{name}"}} '
+                     f'{count}'
+                     for name, count in routed)
+        lines.append("# TYPE warbler_db_sticky_requests_total counter")
+        lines.append(f"warbler_db_sticky_requests_total {sticky}")
+
+        return lines
@@ -0,0 +1,136 @@
+"""Indexed search for Warbler.
+
+User search matches every word of the query as a word prefix of a user's
+username, bio or location, case-insensitively. It is answered from an
+index rather than a `LIKE '%q%'` scan: a GIN full-text index on Postgres,
+or the FTS5 `users_fts` table on SQLite (see models.py). Results are ranked
+exact username match first, then username prefix, then everything else,
+and keyset-paginated on (rank, id).
+
+Message search uses the MessageTerm inverted index (see models.py). The
+query's longest word is read as an index range in (timestamp, id) order,
+and each other word is checked with a keyed EXISTS, so the messages table
+is only touched to fetch the page being shown. Results come newest first
+and are keyset-paginated like every other message list.
+"""
+
+from sqlalchemy import and_, case, func, literal_column, select, table
+from sqlalchemy.orm import aliased
+
+from models import (
+    db, Message, MessageTerm, User, USER_SEARCH_DOCUMENT, tokenize)
+from pagination import (
+    Page, USERS_PER_PAGE, keyset_page, paginate_messages)
+
+
+def escape_like(term):
+    """Escape LIKE wildcards in `term` (used with escape="\\")."""
+
+    return (term
+            .replace("\\", "\\\\")
+            .replace("%", "\\%")
+            .replace("_", "\\_"))
+
+
+def user_match_clause(terms):
+    """Return a WHERE clause matching users whose document has every term."""
+
+    dialect = db.engine.dialect.name
+
+    if dialect == "postgresql":
+        tsquery = " & ".join(f"{term}:*" for term in terms)
+        return (literal_column(USER_SEARCH_DOCUMENT)
+                .op("@@")(func.to_tsquery("simple", tsquery)))
+
+    if dialect == "sqlite":
+        fts_query = " ".join(f'"{term}"*' for term in terms)
+        users_fts = table("users_fts")
+        return User.id.in_(
+            select(literal_column("rowid"))
+            .select_from(users_fts)
+            .where(literal_column("users_fts").op("MATCH")(fts_query)))
+
+    # No search index on other databases; fall back to a scan.
+    return and_(*(
+        func.lower(User.username).like(f"%{escape_like(term)}%", escape="\\")
+        for term in terms))
+
+
+def user_rank(search):
+    """Return a 0-2 rank expression: exact username, prefix, other match."""
+
+    username = func.lower(User.username)
+    search = search.strip().lower()
+
+    return case(
+        (username == search, 0),
+        (username.like(f"{escape_like(search)}%", escape="\\"), 1),
+        else_=2,
+    )
+
+
+def search_users(search, cursor, per_page=USERS_PER_PAGE):
+    """Return one Page of users matching `search`, best matches first.
+
+    `cursor` is the "rank_id" string from the previous page's next_cursor.
+    """
+
+    terms = tokenize(search)
+
+    if not terms:
+        return Page([], None)
+
+    rank = user_rank(search)
+    query = (db.session
+             .query(User, rank.label("rank"))
+             .filter(user_match_clause(terms), User.deleted_at.is_(None)))
+
+    try:
+        last_rank, last_id = cursor.split("_")
+        key = (int(last_rank), int(last_id))
+    except (AttributeError, ValueError):
+        key = None
+
+    rows, has_more = keyset_page(query,
+                                 (rank, User.id),
+                                 key,
+                                 per_page,
+                                 descending=False)
+
+    next_cursor = None
+    if has_more:
+        last_user, last_rank = rows[-1]
+        next_cursor = f"{last_rank}_{last_user.id}"
+
+    return Page([user for user, _ in rows], next_cursor)
+
+
+def search_messages(search, cursor):
+    """Return one Page of messages containing every word of `search`,
+    newest first."""
+
+    terms = sorted(tokenize(search), key=len, reverse=True)
+
+    if not terms:
+        return Page([], None)
+
+    # Longer words tend to be rarer, so drive the scan from the longest.
+    lead, *others = terms
+
+    query = (Message
+             .published()
+             .join(MessageTerm, MessageTerm.message_id == Message.id)
+             .filter(MessageTerm.term == lead))
+
+    for term in others:
+        other = aliased(MessageTerm)
+        query = query.filter(
+            select(other.message_id)
+            .where(other.term == term,
+                   other.message_id == MessageTerm.message_id)
+            .exists())
+
+    return paginate_messages(query,
+                             cursor,
+                             timestamp=MessageTerm.timestamp,
+                             message_id=MessageTerm.message_id)
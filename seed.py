@@ -1,19 +1,47 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
+The CSVs are bulk loaded (see loader.py) with the tables' secondary
+indexes and constraints dropped, then the derived tables are rebuilt
+before the indexes come back.
+"""
+
+from time import perf_counter
+
+import migrations
 from app import db
-from models import User, Message, Follows
+from loader import deferred_indexes, load_csv, report
+from models import User, Message, Follows, TimelineEntry, MessageTerm
+
+
+def seed(directory='generator'):
+    """Recreate the tables and load users, messages and follows from the
+    CSVs in `directory`."""
+
+    db.drop_all()
+    db.create_all()
+    migrations.stamp(db.engine)
+
+    tables = [User.__table__,
+              Message.__table__,
+              Follows.__table__,
+              TimelineEntry.__table__,
+              MessageTerm.__table__]
 
-db.drop_all()
-db.create_all()
+    with deferred_indexes(db.engine, tables):
+        load_csv(db.engine, User.__table__, f'{directory}/users.csv')
+        load_csv(db.engine, Message.__table__, f'{directory}/messages.csv')
+        load_csv(db.engine, Follows.__table__, f'{directory}/follows.csv')
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+        for table in (TimelineEntry, MessageTerm):
+            start = perf_counter()
+            table.rebuild()
+            db.session.commit()
+            report(table.__tablename__, table.query.count(),
+                   perf_counter() - start)
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    User.reconcile_counters()
+    db.session.commit()
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
-db.session.commit()
+if __name__ == '__main__':
+    seed()
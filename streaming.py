@@ -0,0 +1,50 @@
+"""Streamed template rendering.
+
+stream_template() renders a template into the response as it goes instead
+of building the whole page as one string first, so the first bytes reach
+the client while later rows are still being fetched, and memory use doesn't
+grow with the length of the page. (Flask gains its own stream_template in
+2.2; this is the same idea for the Flask we run.)
+
+Jinja yields a great many tiny strings; they are joined into chunks of
+about STREAM_CHUNK_SIZE characters so the server isn't writing a few bytes
+at a time.
+"""
+
+from flask import Response, current_app, stream_with_context
+
+STREAM_CHUNK_SIZE = 8 * 1024
+
+
+def buffer_chunks(strings, size=STREAM_CHUNK_SIZE):
+    """Join `strings` into chunks of at least `size` characters."""
+
+    buffered = []
+    length = 0
+
+    for string in strings:
+        buffered.append(string)
+        length += len(string)
+
+        if length >= size:
+            yield "".join(buffered)
+            buffered = []
+            length = 0
+
+    if buffered:
+        yield "".join(buffered)
+
+
+def stream_template(template_name, **context):
+    """Return a streamed Response rendering `template_name` with `context`.
+
+    The request context stays available to the template (and to the
+    queries it triggers) until the last chunk has been sent.
+    """
+
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+
+    return Response(stream_with_context(
+        buffer_chunks(template.generate(**context))))
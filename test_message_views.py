@@ -8,7 +8,8 @@
 import os
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, MessageTerm, User, TimelineEntry
+from query_budget import query_budget
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -87,10 +88,180 @@ class MessageViewTestCase(TestCase):
             c.post("/messages/new", data={"text": "Hello"})
 
             user = User.query.get(self.testuser.id)
-            message = user.messages.one()
-            resp = c.post(f'/messages/{message.id}/delete')})
+            message = user.messages[0]
+            resp = c.post(f'/messages/{message.id}/delete')
 
             # Make sure it redirects
             self.assertEqual(resp.status_code, 302)
 
-            # Make sure user.messages does not include our message.
\ No newline at end of file
+            # Make sure user.messages does not include our message.
+            self.assertEqual(Message.query.filter_by(user_id=user.id).count(), 0)
+
+    def test_home_page_query_budget(self):
+        """Does the home page run a fixed number of queries however many
+        authors are on it?"""
+
+        authors = [User(username=f"author{i}",
+                        email=f"author{i}@test.com",
+                        password="HASHED_PASSWORD")
+                   for i in range(30)]
+        db.session.add_all(authors)
+        db.session.flush()
+
+        user = User.query.get(self.testuser.id)
+        user.following.extend(authors)
+        db.session.add_all(Message(text=f"from {author.username}",
+                                   user_id=author.id)
+                           for author in authors)
+        db.session.flush()
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            # user, timeline page with authors, likes for that page
+            with query_budget(3):
+                resp = c.get("/")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("from author29", str(resp.data))
+
+    def test_show_message_query_budget(self):
+        """Does showing a message load its author in the same query?"""
+
+        msg = Message(text="Hello", user_id=self.testuser.id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            # user, message with author
+            with query_budget(2):
+                resp = c.get(f"/messages/{msg_id}")
+
+            self.assertEqual(resp.status_code, 200)
+
+    def test_search_messages(self):
+        """Does search find messages with every word, and forget deleted ones?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Herons are great"})
+            c.post("/messages/new", data={"text": "Egrets are great too"})
+            c.post("/messages/new", data={"text": "A heron, an egret"})
+
+            html = c.get("/messages/search?q=GREAT").get_data(as_text=True)
+            self.assertIn("Herons are great", html)
+            self.assertIn("Egrets are great too", html)
+            self.assertNotIn("A heron, an egret", html)
+
+            html = c.get("/messages/search?q=egret+heron").get_data(as_text=True)
+            self.assertIn("A heron, an egret", html)
+            self.assertNotIn("great", html)
+
+            message = Message.query.filter_by(text="A heron, an egret").one()
+            c.post(f"/messages/{message.id}/delete")
+
+            self.assertEqual(MessageTerm.query.filter_by(term="heron").count(), 0)
+            html = c.get("/messages/search?q=heron").get_data(as_text=True)
+            self.assertIn("Sorry, no warbles found", html)
+
+    def test_like_counts(self):
+        """Are like counts kept by likes, unlikes and deleted likers, and
+        shown without counting likes per message?"""
+
+        msg = Message(text="Likeable", user_id=self.testuser.id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        fans = []
+        for i in range(3):
+            fans.append(User.signup(username=f"fan{i}",
+                                    email=f"fan{i}@test.com",
+                                    password="password",
+                                    image_url=None))
+        db.session.commit()
+        fan_ids = [fan.id for fan in fans]
+
+        with self.client as c:
+            for fan_id in fan_ids:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = fan_id
+                c.post(f"/messages/likes/{msg_id}")
+
+            self.assertEqual(Message.query.get(msg_id).like_count, 3)
+
+            c.post(f"/messages/unlikes/{msg_id}")
+            self.assertEqual(Message.query.get(msg_id).like_count, 2)
+
+            # The second fan deletes their account, and their like with it.
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = fan_ids[1]
+            c.post("/users/delete")
+            db.session.expire_all()
+            self.assertEqual(Message.query.get(msg_id).like_count, 1)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = fan_ids[0]
+
+            # user, message with author, follows and likes for the button
+            with query_budget(4):
+                html = c.get(f"/messages/{msg_id}").get_data(as_text=True)
+            self.assertIn('<span class="like-count">1</span>', html)
+            self.assertIn("You like this!", html)
+
+        Message.query.filter_by(id=msg_id).update({"like_count": 7})
+        self.assertEqual(Message.reconcile_counters(), {"like_count": 1})
+        self.assertEqual(Message.query.get(msg_id).like_count, 1)
+
+    def test_batch_likes(self):
+        """Can many messages be liked at once, and liked twice safely?"""
+
+        author = User.signup(username="author",
+                             email="author@test.com",
+                             password="password",
+                             image_url=None)
+        db.session.flush()
+        messages = [Message(text=f"like me {i}", user_id=author.id)
+                    for i in range(5)]
+        own = Message(text="my own", user_id=self.testuser.id)
+        db.session.add_all([*messages, own])
+        db.session.commit()
+        message_ids = [msg.id for msg in messages]
+        own_id = own.id
+        user_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            ids = ",".join(map(str, message_ids + [own_id]))
+            c.post("/messages/likes", data={"ids": ids})
+
+            # user, insert, two counter updates
+            with query_budget(4):
+                resp = c.post("/messages/likes", data={"ids": ids})
+            self.assertEqual(resp.status_code, 302)
+
+            c.post(f"/messages/unlikes/{message_ids[0]}")
+            c.post(f"/messages/unlikes/{message_ids[0]}")
+
+            resp = c.post("/messages/likes", data={"ids": "1,x"},
+                          follow_redirects=True)
+            html = str(resp.data)
+            self.assertIn("Pick between 1 and 100 messages to like", html)
+            self.assertNotIn("user ids", html)
+
+        db.session.expire_all()
+        self.assertEqual(User.query.get(user_id).likes_count, 4)
+        self.assertEqual([Message.query.get(i).like_count for i in message_ids],
+                         [0, 1, 1, 1, 1])
+        self.assertEqual(Message.query.get(own_id).like_count, 0)
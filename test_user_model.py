@@ -6,11 +6,24 @@
 
 
 import os
+from datetime import datetime, timedelta
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+from time import perf_counter
+from types import SimpleNamespace
 from unittest import TestCase
 
-from models import db, User, Message, Follows, Likes
+import migrations
+from loader import deferred_indexes, load_csv
+from models import (
+    db, User, Message, Follows, Likes, MessageTerm, TimelineEntry)
+from pagination import keyset_query
+from passwords import password_hasher, PasswordHasher, PasswordHasherBusy
 from flask_bcrypt import Bcrypt
-from sqlalchemy import exc
+import psycopg2
+from sqlalchemy import (
+    Column, DateTime, ForeignKey, Integer, MetaData, String, Table, Text,
+    create_engine, exc, inspect, text)
 
 
 # BEFORE we import our app, let's set an environmental variable
@@ -173,6 +186,38 @@ class UserModelTestCase(TestCase):
         self.assertFalse(user_1.is_followed_by(user_2))
 
 
+    def test_preloaded_membership(self):
+        """do preloaded follow/like lookups agree with the database"""
+
+        user_1 = User.query.get(self.test_u1_id)
+        user_2 = User.query.get(self.test_u2_id)
+        user_3 = User.query.get(self.test_u3_id)
+
+        liked = Message(text="liked", user_id=user_2.id)
+        not_liked = Message(text="not liked", user_id=user_3.id)
+
+        user_1.following.append(user_2)
+        user_1.liked_messages.append(liked)
+        db.session.add(not_liked)
+        db.session.commit()
+
+        user_1.preload_membership(users=[user_2, user_3],
+                                  messages=[liked, not_liked])
+
+        self.assertEqual(user_1._following_ids,
+                         {user_2.id: True, user_3.id: False})
+        self.assertEqual(user_1._liked_ids,
+                         {liked.id: True, not_liked.id: False})
+
+        self.assertTrue(user_1.is_following(user_2))
+        self.assertFalse(user_1.is_following(user_3))
+        self.assertTrue(user_1.has_liked(liked))
+        self.assertFalse(user_1.has_liked(not_liked))
+
+        # rows that weren't preloaded still fall back to the database
+        self.assertFalse(user_2.is_following(user_1))
+        self.assertTrue(user_2.is_followed_by(user_1))
+
     def test_successful_authentication(self):
         """checks to see if user is successfully authenticated with correct UN and PW"""
 
@@ -188,6 +233,63 @@ class UserModelTestCase(TestCase):
 
         self.assertTrue(user_4.authenticate(user_4.username,"test_my_user"))
 
+    def test_authentication_upgrades_hash_cost(self):
+        """does logging in rehash a password stored at an outdated cost"""
+
+        user_1 = User.query.get(self.test_u1_id)
+        user_1.password = bcrypt.generate_password_hash("pass1234", 4).decode()
+        db.session.commit()
+
+        self.assertTrue(password_hasher.needs_rehash(user_1.password))
+
+        user = User.authenticate(user_1.username, "pass1234")
+        db.session.commit()
+
+        self.assertFalse(password_hasher.needs_rehash(user.password))
+        self.assertTrue(user.password.startswith(
+            f"$2b${password_hasher.rounds:02d}$"))
+        self.assertTrue(User.authenticate(user_1.username, "pass1234"))
+
+    def test_password_hasher_fails_fast(self):
+        """Is a hash with the pool and its queue full refused at once?"""
+
+        hasher = PasswordHasher(rounds=4, workers=1, max_pending=1)
+        running = Event()
+        release = Event()
+
+        def hold():
+            running.set()
+            release.wait()
+
+        busy = Thread(target=hasher._run, args=(hold,))
+        busy.start()
+        self.addCleanup(busy.join)
+        self.addCleanup(release.set)
+        running.wait()
+
+        start = perf_counter()
+        with self.assertRaises(PasswordHasherBusy):
+            hasher.hash("password")
+        self.assertLess(perf_counter() - start, 0.1)
+
+        release.set()
+        busy.join()
+        self.assertTrue(hasher.check(hasher.hash("password"), "password"))
+
+    def test_password_hasher_pending_below_threads(self):
+        """Does init_app refuse a pending limit that could hold every
+        request thread?"""
+
+        for config in ({"WEB_THREADS": 8, "BCRYPT_MAX_PENDING": 8},
+                       {"WEB_THREADS": 4, "BCRYPT_WORKERS": 4}):
+            with self.assertRaises(ValueError):
+                PasswordHasher().init_app(SimpleNamespace(config=config))
+
+        hasher = PasswordHasher()
+        hasher.init_app(SimpleNamespace(config={"WEB_THREADS": 8}))
+        self.assertEqual(hasher.max_pending, 4)
+        self.assertLess(password_hasher.max_pending, app.config["WEB_THREADS"])
+
     def test_failed_password_authentication(self):
         """checks to see if user is NOT authenticated with incorrect PW"""
         user_1 = User.query.get(self.test_u1_id)
@@ -203,4 +305,324 @@ class UserModelTestCase(TestCase):
 
 
 
-    #does user.authenticate find correct user or fail to authenticate when user not found based on UN / password
\ No newline at end of file
+    #does user.authenticate find correct user or fail to authenticate when user not found based on UN / password
+
+
+class SchemaTestCase(TestCase):
+    """Test that the hot queries are served by indexes."""
+
+    def load_rows(self):
+        """Load a few thousand analyzed rows, so the plans are the ones a
+        real database would get rather than the ones for empty tables."""
+
+        for table in (Likes, TimelineEntry, MessageTerm, Message, Follows,
+                      User):
+            table.query.delete()
+
+        users = 200
+        now = datetime.utcnow()
+
+        db.session.execute(User.__table__.insert(), [
+            dict(id=i, email=f"user{i}@test.com", username=f"user{i}",
+                 password="password")
+            for i in range(1, users + 1)])
+        db.session.execute(Message.__table__.insert(), [
+            dict(id=i, text=f"message {i}", user_id=i % users + 1,
+                 timestamp=now - timedelta(minutes=i))
+            for i in range(1, 4001)])
+        db.session.execute(Follows.__table__.insert(), [
+            dict(user_following_id=i, user_being_followed_id=j)
+            for i in range(1, users + 1)
+            for j in range(i + 1, i + 21) if j <= users])
+        db.session.execute(Likes.__table__.insert(), [
+            dict(user_liking_id=i, message_liked_id=m)
+            for i in range(1, users + 1)
+            for m in range(i, 4001, 200)])
+        TimelineEntry.rebuild()
+        MessageTerm.rebuild()
+        db.session.commit()
+
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql(
+                "ANALYZE users, messages, follows, likes, timeline_entries, "
+                "message_terms")
+
+    def tearDown(self):
+        db.session.rollback()
+
+        for table in (Likes, TimelineEntry, MessageTerm, Message, Follows,
+                      User):
+            table.query.delete()
+
+        db.session.commit()
+
+    def assertUsesIndex(self, query, index):
+        """Assert Postgres plans `query` with `index` and no sequential scan.
+
+        Sequential scans are priced out of the planner, so the tiny test
+        tables don't make one look cheaper than the index.
+        """
+
+        compiled = query.statement.compile(dialect=db.engine.dialect)
+
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql("SET LOCAL enable_seqscan = off")
+            plan = connection.exec_driver_sql(
+                f"EXPLAIN {compiled}", compiled.params).scalars().all()
+
+        plan = "\n".join(plan)
+        self.assertIn(f" {index} ", plan)
+        self.assertNotIn("Seq Scan", plan)
+
+    def test_hot_queries_use_indexes(self):
+        """Do timeline, profile, follow and like queries use indexes?"""
+
+        self.load_rows()
+        user_id = 1
+
+        newest_first = dict(columns=(Message.timestamp, Message.id),
+                            key=None, per_page=20, descending=True)
+        by_id = dict(columns=(User.id,), key=None, per_page=20,
+                     descending=False)
+        # The home page: paginate_messages() over TimelineEntry.timeline()
+        # keyed on the entries' columns, as in app.homepage.
+        home_page = dict(columns=(TimelineEntry.timestamp,
+                                  TimelineEntry.message_id),
+                         per_page=100, descending=True)
+        cursor = (datetime(2024, 1, 1), 1000)
+
+        # Each hot query, keyed by the index that should serve it: a
+        # user's home page (first and later pages), messages (profile),
+        # follows both ways, likes, and the rows deleting a message
+        # cascades to.
+        queries = {
+            "ix_timeline_entries_user_id_timestamp": keyset_query(
+                TimelineEntry.timeline(user_id), key=None, **home_page),
+            "ix_timeline_entries_user_id_timestamp (after a cursor)":
+                keyset_query(TimelineEntry.timeline(user_id), key=cursor,
+                             **home_page),
+            "ix_messages_user_id_timestamp":
+                keyset_query(Message.query.filter_by(user_id=user_id),
+                             **newest_first),
+            "ix_follows_user_following_id": keyset_query(
+                User.query
+                .join(Follows, Follows.user_being_followed_id == User.id)
+                .filter(Follows.user_following_id == user_id),
+                **by_id),
+            "follows_pkey": keyset_query(
+                User.query
+                .join(Follows, Follows.user_following_id == User.id)
+                .filter(Follows.user_being_followed_id == user_id),
+                **by_id),
+            "likes_pkey": keyset_query(
+                Message.query
+                .join(Likes, Likes.message_liked_id == Message.id)
+                .filter(Likes.user_liking_id == user_id),
+                **newest_first),
+            "ix_likes_message_liked_id":
+                Likes.query.filter_by(message_liked_id=1),
+            "ix_timeline_entries_message_id":
+                TimelineEntry.query.filter_by(message_id=1),
+            "ix_message_terms_message_id":
+                MessageTerm.query.filter_by(message_id=1),
+        }
+
+        for name, query in queries.items():
+            with self.subTest(name):
+                self.assertUsesIndex(query, name.split()[0])
+
+    def test_failed_load_restores_indexes(self):
+        """Are the indexes and constraints a bulk load drops put back when
+        the load fails?"""
+
+        tables = [Follows.__table__, Likes.__table__]
+
+        def deferrables():
+            inspector = inspect(db.engine)
+
+            return (self.schema(db.engine),
+                    {table.name: (inspector.get_foreign_keys(table.name),
+                                  inspector.get_unique_constraints(table.name))
+                     for table in tables})
+
+        before = deferrables()
+
+        with TemporaryDirectory() as directory:
+            path = f"{directory}/follows.csv"
+
+            with open(path, "w") as f:
+                f.write("user_being_followed_id,user_following_id\n"
+                        "not an id,1\n")
+
+            with self.assertRaises(psycopg2.DataError):
+                with deferred_indexes(db.engine, tables):
+                    self.assertNotEqual(deferrables(), before)
+                    load_csv(db.engine, Follows.__table__, path)
+
+        self.assertEqual(deferrables(), before)
+
+    def test_migrations_are_idempotent(self):
+        """Does upgrading an up-to-date schema do nothing?"""
+
+        migrations.stamp(db.engine)
+
+        self.assertEqual(migrations.pending(db.engine), [])
+        self.assertEqual(migrations.upgrade(db.engine, db.metadata), [])
+
+    def original_schema(self):
+        """Return MetaData for the tables as the app first declared them,
+        before there were migrations."""
+
+        metadata = MetaData()
+        Table("users", metadata,
+              Column("id", Integer, primary_key=True),
+              Column("email", Text, nullable=False, unique=True),
+              Column("username", Text, nullable=False, unique=True),
+              Column("image_url", Text),
+              Column("header_image_url", Text),
+              Column("bio", Text),
+              Column("location", Text),
+              Column("password", Text, nullable=False))
+        Table("messages", metadata,
+              Column("id", Integer, primary_key=True),
+              Column("text", String(140), nullable=False),
+              Column("timestamp", DateTime, nullable=False),
+              Column("user_id", Integer,
+                     ForeignKey("users.id", ondelete="CASCADE"),
+                     nullable=False))
+        Table("follows", metadata,
+              Column("user_being_followed_id", Integer,
+                     ForeignKey("users.id", ondelete="cascade"),
+                     primary_key=True),
+              Column("user_following_id", Integer,
+                     ForeignKey("users.id", ondelete="cascade"),
+                     primary_key=True))
+        Table("likes", metadata,
+              Column("user_liking_id", Integer,
+                     ForeignKey("users.id", ondelete="cascade"),
+                     primary_key=True),
+              Column("message_liked_id", Integer,
+                     ForeignKey("messages.id", ondelete="cascade"),
+                     primary_key=True))
+
+        return metadata
+
+    def schema(self, engine):
+        """Return {table: (column names, {index name: columns})} for the
+        tables in models.py."""
+
+        inspector = inspect(engine)
+
+        return {name: ({column["name"]
+                        for column in inspector.get_columns(name)},
+                       {index["name"]: index["column_names"]
+                        for index in inspector.get_indexes(name)})
+                for name in db.metadata.tables}
+
+    def test_upgrade_from_original_schema(self):
+        """Does `flask migrate` bring a database made before migrations up
+        to the schema create_all() makes, and fill in the new tables?"""
+
+        with TemporaryDirectory() as directory:
+            for dialect in ("sqlite", "postgresql"):
+                with self.subTest(dialect):
+                    if dialect == "sqlite":
+                        legacy = create_engine(
+                            f"sqlite:///{directory}/legacy.db")
+                        fresh = create_engine(
+                            f"sqlite:///{directory}/fresh.db")
+                    else:
+                        legacy, fresh = (
+                            self.postgres_schema(name)
+                            for name in ("legacy", "fresh"))
+
+                    self.check_upgrade(legacy, fresh)
+
+    def postgres_schema(self, name):
+        """Return an engine for a new, empty Postgres schema `name`."""
+
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql(f"DROP SCHEMA IF EXISTS {name} CASCADE")
+            connection.exec_driver_sql(f"CREATE SCHEMA {name}")
+
+        self.addCleanup(self.drop_postgres_schema, name)
+
+        return create_engine(db.engine.url,
+                             connect_args={"options": f"-csearch_path={name}"})
+
+    def drop_postgres_schema(self, name):
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql(f"DROP SCHEMA IF EXISTS {name} CASCADE")
+
+    def check_upgrade(self, legacy, fresh):
+        self.original_schema().create_all(legacy)
+        now = datetime.utcnow()
+
+        with legacy.begin() as connection:
+            connection.execute(text(
+                "INSERT INTO users (id, email, username, bio, password) "
+                "VALUES (1, 'a@test.com', 'author', 'heron fan', 'x'), "
+                "(2, 'b@test.com', 'reader', NULL, 'x')"))
+            connection.execute(
+                text("INSERT INTO messages (id, text, timestamp, user_id) "
+                     "VALUES (:id, :text, :timestamp, 1)"),
+                [dict(id=i, text=f"Warble number {i}",
+                      timestamp=now - timedelta(minutes=i))
+                 for i in range(1, 4)])
+            connection.execute(text(
+                "INSERT INTO follows VALUES (1, 2)"))
+            connection.execute(text(
+                "INSERT INTO likes VALUES (2, 1)"))
+
+        migrations.upgrade(legacy, db.metadata)
+        self.assertEqual(migrations.pending(legacy), [])
+
+        db.metadata.create_all(fresh)
+        self.assertEqual(self.schema(legacy), self.schema(fresh))
+
+        with legacy.begin() as connection:
+            self.assertEqual(
+                connection.execute(text(
+                    "SELECT id, messages_count, following_count, "
+                    "followers_count, likes_count, version "
+                    "FROM users ORDER BY id")).all(),
+                [(1, 3, 0, 1, 0, 1), (2, 0, 1, 0, 1, 1)])
+            self.assertEqual(
+                connection.execute(text(
+                    "SELECT user_id, count(*) FROM timeline_entries "
+                    "GROUP BY user_id ORDER BY user_id")).all(),
+                [(1, 3), (2, 3)])
+            self.assertEqual(
+                connection.execute(text(
+                    "SELECT message_id FROM message_terms "
+                    "WHERE term = 'number' ORDER BY message_id"
+                )).scalars().all(),
+                [1, 2, 3])
+
+            if legacy.dialect.name == "sqlite":
+                found = connection.execute(text(
+                    "SELECT rowid FROM users_fts WHERE users_fts MATCH 'heron'"))
+            else:
+                found = connection.execute(text(
+                    "SELECT 1 FROM pg_indexes "
+                    "WHERE schemaname = current_schema() "
+                    "AND indexname = 'ix_users_search'"))
+            self.assertEqual(len(found.all()), 1)
+
+        legacy.dispose()
+        fresh.dispose()
+
+    def test_hot_path_migration(self):
+        """Does the index migration run again cleanly on the schema?"""
+
+        module = {name: module for version, name, module
+                  in migrations.migrations()}["0002_hot_path_indexes"]
+
+        with db.engine.begin() as connection:
+            module.upgrade(connection)
+
+        self.assertTrue(
+            {"ix_follows_user_following_id", "ix_likes_message_liked_id"}
+            <= {index["name"] for index
+                in db.inspect(db.engine).get_indexes("follows")
+                + db.inspect(db.engine).get_indexes("likes")})
@@ -5,10 +5,25 @@
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
 
+import gzip
 import os
+import re
+import zlib
+from datetime import datetime, timedelta
+from html import unescape
+from tempfile import TemporaryDirectory
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from werkzeug.test import Client
+
+from assets import build
+from compression import CompressionMiddleware
+from csrf import unmask
+from models import (
+    db, connect_db, Message, MessageTerm, User, TimelineEntry,
+    TIMELINE_MAX_LENGTH, TIMELINE_PRUNE_EVERY)
+from pagination import StreamedPage
+from query_budget import QueryCounter, query_budget
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -19,7 +34,9 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import (
+    app, CURR_USER_KEY, auth_limiter, fragment_cache, metrics, replicas,
+    static_assets, user_cache, user_purger)
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -31,6 +48,9 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+app.config['METRICS_TOKEN'] = "metrics-token"
+METRICS_AUTH = {"Authorization": "Bearer metrics-token"}
+
 class UserViewTestCase(TestCase):
     """Test views for messages."""
 
@@ -115,4 +135,991 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 302)
             self.assertEqual(resp2.status_code, 302)
 
+    def test_homepage_shows_followed_messages(self):
+        """Does following backfill the home timeline and unfollowing clear it?"""
+
+        early = Message(text="posted before the follow",
+                        user_id=self.testuser_2_id)
+        db.session.add(early)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get("/")
+            self.assertNotIn("posted before the follow", str(resp.data))
+
+            c.post(f"/users/follow/{self.testuser_2_id}")
+
+            late = Message(text="posted after the follow",
+                           user_id=self.testuser_2_id)
+            db.session.add(late)
+            db.session.flush()
+            TimelineEntry.fan_out(late)
+            db.session.commit()
+
+            resp = c.get("/")
+            self.assertIn("posted before the follow", str(resp.data))
+            self.assertIn("posted after the follow", str(resp.data))
+
+            c.post(f"/users/stop-following/{self.testuser_2_id}")
+
+            resp = c.get("/")
+            self.assertNotIn("posted after the follow", str(resp.data))
+
+    def test_rebuild_timelines(self):
+        """Does rebuilding give each user their own and followed messages?"""
+
+        user1 = User.query.get(self.testuser_id)
+        user2 = User.query.get(self.testuser_2_id)
+        user1.following.append(user2)
+
+        db.session.add(Message(text="from user 2", user_id=user2.id))
+        db.session.commit()
+
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        for user in (user1, user2):
+            self.assertEqual(
+                [m.text for m in TimelineEntry.timeline(user.id)],
+                ["from user 2"])
+
+    def test_timelines_pruned_every_few_posts(self):
+        """Are timelines left to run a little over TIMELINE_MAX_LENGTH, and
+        pruned back to it by every TIMELINE_PRUNE_EVERY-th post?"""
+
+        start = datetime(2021, 1, 1)
+        db.session.execute(Message.__table__.insert(), [
+            dict(text=f"old {i}", user_id=self.testuser_2_id,
+                 timestamp=start + timedelta(minutes=i))
+            for i in range(TIMELINE_MAX_LENGTH)])
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        def timeline_length():
+            return TimelineEntry.query.filter_by(
+                user_id=self.testuser_2_id).count()
+
+        while True:
+            message = Message(text="new", user_id=self.testuser_2_id)
+            db.session.add(message)
+            db.session.flush()
+            TimelineEntry.fan_out(message)
+            db.session.commit()
+
+            if message.id % TIMELINE_PRUNE_EVERY == 0:
+                break
+
+            self.assertGreater(timeline_length(), TIMELINE_MAX_LENGTH)
+
+        self.assertEqual(timeline_length(), TIMELINE_MAX_LENGTH)
+        self.assertFalse(TimelineEntry.query.join(Message).filter(
+            Message.text == "old 0").count())
+
+    def test_profile_pagination(self):
+        """Does a profile show one page of messages with a link to older ones?"""
+
+        start = datetime(2021, 1, 1)
+        for i in range(60):
+            db.session.add(Message(text=f"warble number {i}",
+                                   timestamp=start + timedelta(minutes=i),
+                                   user_id=self.testuser_2_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get(f"/users/{self.testuser_2_id}")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("warble number 59<", html)
+            self.assertIn("warble number 10<", html)
+            self.assertNotIn("warble number 9<", html)
+            self.assertIn('id="older"', html)
+
+            older_link = re.search(r'href="([^"]+)"[^>]*id="older"', html)
+            resp = c.get(unescape(older_link.group(1)))
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("warble number 9<", html)
+            self.assertIn("warble number 0<", html)
+            self.assertNotIn("warble number 10<", html)
+            self.assertNotIn('id="older"', html)
+
+    def test_following_pagination(self):
+        """Does the following page page through followed users by id?"""
+
+        user1 = User.query.get(self.testuser_id)
+        for i in range(50):
+            followed = User(username=f"followed{i}",
+                            email=f"followed{i}@test.com",
+                            password="HASHED_PASSWORD")
+            user1.following.append(followed)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get(f"/users/{self.testuser_id}/following")
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("@followed47<", html)
+            self.assertNotIn("@followed48<", html)
+            self.assertIn('id="more"', html)
+
+            more_link = re.search(r'href="([^"]+)"[^>]*id="more"', html)
+            resp = c.get(unescape(more_link.group(1)))
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("@followed48<", html)
+            self.assertIn("@followed49<", html)
+            self.assertNotIn("@followed47<", html)
+            self.assertNotIn('id="more"', html)
+
+    def test_follow_counters(self):
+        """Do follow and unfollow keep both users' counters in step?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post(f"/users/follow/{self.testuser_2_id}")
+
+            user1 = User.query.get(self.testuser_id)
+            user2 = User.query.get(self.testuser_2_id)
+            self.assertEqual(user1.following_count, 1)
+            self.assertEqual(user2.followers_count, 1)
+
+            c.post(f"/users/stop-following/{self.testuser_2_id}")
+
+            user1 = User.query.get(self.testuser_id)
+            user2 = User.query.get(self.testuser_2_id)
+            self.assertEqual(user1.following_count, 0)
+            self.assertEqual(user2.followers_count, 0)
+
+    def test_reconcile_counters(self):
+        """Does reconciling fix drifted counters and report how many?"""
+
+        user1 = User.query.get(self.testuser_id)
+        user2 = User.query.get(self.testuser_2_id)
+
+        # Write through the relationships, bypassing the counters.
+        user1.following.append(user2)
+        user1.messages.append(Message(text="uncounted"))
+        db.session.commit()
+
+        drift = User.reconcile_counters()
+        db.session.commit()
+
+        self.assertEqual(drift, {'messages_count': 1,
+                                 'following_count': 1,
+                                 'followers_count': 1,
+                                 'likes_count': 0})
+
+        user1 = User.query.get(self.testuser_id)
+        self.assertEqual(user1.messages_count, 1)
+        self.assertEqual(user1.following_count, 1)
+
+        self.assertEqual(User.reconcile_counters(),
+                         {'messages_count': 0,
+                          'following_count': 0,
+                          'followers_count': 0,
+                          'likes_count': 0})
+
+    def test_user_pages_query_budget(self):
+        """Do profile and list pages run a fixed number of queries however
+        much data is on them?"""
+
+        user1 = User.query.get(self.testuser_id)
+        for i in range(20):
+            other = User(username=f"other{i}",
+                         email=f"other{i}@test.com",
+                         password="HASHED_PASSWORD")
+            user1.following.append(other)
+            user1.liked_messages.append(Message(text=f"by other{i}",
+                                                user=other))
+        db.session.commit()
+
+        # current user, profile user, page of rows, preloaded follows/likes
+        budgets = {
+            f"/users/{self.testuser_id}": 5,
+            f"/users/{self.testuser_id}/likes": 5,
+            f"/users/{self.testuser_id}/following": 4,
+            f"/users/{self.testuser_id}/followers": 4,
+            "/users": 3,
+        }
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            for url, budget in budgets.items():
+                with query_budget(budget):
+                    resp = c.get(url)
+
+                self.assertEqual(resp.status_code, 200, url)
+
+    def test_request_metrics(self):
+        """Are requests timed in a header and aggregated on /metrics?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get(f"/users/{self.testuser_id}")
+            self.assertRegex(resp.headers["Server-Timing"],
+                             r'app;dur=[\d.]+, db;dur=[\d.]+;desc="\d+ queries"')
+
+            resp = c.get("/metrics", headers=METRICS_AUTH)
+            metrics = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('warbler_request_duration_seconds_count'
+                          '{endpoint="users_show"}', metrics)
+            self.assertIn('warbler_request_db_queries_quantile'
+                          '{endpoint="users_show",quantile="0.99"}', metrics)
+
+    def test_metrics_need_token(self):
+        """Is /metrics only served to a scraper with METRICS_TOKEN, and not
+        at all without one configured?"""
+
+        for headers in ({}, {"Authorization": "Bearer wrong"},
+                        {"Authorization": "metrics-token"}):
+            resp = self.client.get("/metrics", headers=headers)
+            self.assertEqual(resp.status_code, 401, headers)
+            self.assertNotIn("warbler_", resp.get_data(as_text=True))
+
+        app.config['METRICS_TOKEN'] = None
+        self.addCleanup(app.config.__setitem__, 'METRICS_TOKEN',
+                        "metrics-token")
+        resp = self.client.get("/metrics", headers=METRICS_AUTH)
+        self.assertEqual(resp.status_code, 404)
+
+    def test_streamed_request_metrics(self):
+        """Are a streamed page's queries and time, rendering included,
+        recorded once it has been sent?"""
+
+        def observed(name):
+            histogram = metrics.histograms.get((name, "list_users"))
+            return (histogram.count, histogram.sum) if histogram else (0, 0)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            count, queries = observed("warbler_request_db_queries")
+            _, seconds = observed("warbler_request_duration_seconds")
+
+            with QueryCounter() as counter:
+                resp = c.get("/users")
+                # Nothing is recorded until the body has been sent.
+                self.assertEqual(observed("warbler_request_db_queries"),
+                                 (count, queries))
+                html = resp.get_data(as_text=True)
+                resp.close()
+
+            self.assertIn("testuser_2", html)
+            # user, directory page, follow state for it.
+            self.assertEqual(counter.count, 3)
+            to_headers = re.fullmatch(
+                r'headers;dur=([\d.]+);desc="body streamed"',
+                resp.headers["Server-Timing"])
+
+            self.assertEqual(observed("warbler_request_db_queries"),
+                             (count + 1, queries + counter.count))
+            _, seconds_after = observed("warbler_request_duration_seconds")
+            self.assertGreaterEqual((seconds_after - seconds) * 1000,
+                                    float(to_headers[1]))
+
+    def test_user_cache(self):
+        """Is the logged-in user served from the cache until they edit
+        their profile?"""
+
+        user_cache.clear()
+        hits = user_cache.hits
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.get("/users")
+            c.get("/users")
+            self.assertEqual(user_cache.hits, hits + 1)
+
+            c.post("/users/profile", data={"username": "renamed",
+                                           "email": "test@test.com",
+                                           "validate_password": "testuser"})
+
+            resp = c.get("/")
+            self.assertIn('alt="renamed"', str(resp.data))
+
+    def test_search_users(self):
+        """Does search match username, bio and location case-insensitively,
+        best username matches first?"""
+
+        db.session.add_all([
+            User(username="birdwatcher", email="bw@test.com",
+                 password="HASHED_PASSWORD", bio="I like herons"),
+            User(username="heron", email="heron@test.com",
+                 password="HASHED_PASSWORD", location="Heronsgate"),
+            User(username="heronfan", email="hf@test.com",
+                 password="HASHED_PASSWORD"),
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            html = c.get("/users?q=HERON").get_data(as_text=True)
+
+            found = re.findall(r"<p>@(\w+)</p>", html)
+            self.assertEqual(found, ["heron", "heronfan", "birdwatcher"])
+
+            html = c.get("/users?q=heronsgate").get_data(as_text=True)
+            self.assertEqual(re.findall(r"<p>@(\w+)</p>", html), ["heron"])
+
+            html = c.get("/users?q=nobody").get_data(as_text=True)
+            self.assertIn("Sorry, no users found", html)
+
+    def test_login_rate_limit(self):
+        """Are repeated logins for one username cut off before bcrypt runs?"""
+
+        auth_limiter.reset()
+        burst, _ = auth_limiter.limits["username"]
+        rejected = auth_limiter.counts["username", "rejected"]
+
+        with self.client as c:
+            for _ in range(burst):
+                resp = c.post("/login", data={"username": "testuser",
+                                              "password": "wrongpassword"})
+                self.assertEqual(resp.status_code, 200)
+
+            resp = c.post("/login", data={"username": "TestUser",
+                                          "password": "testuser"})
+
+            self.assertEqual(resp.status_code, 429)
+            self.assertIn("Retry-After", resp.headers)
+            self.assertEqual(auth_limiter.counts["username", "rejected"],
+                             rejected + 1)
+
+            # Other usernames from the same IP still get through.
+            resp = c.post("/login", data={"username": "testuser_2",
+                                          "password": "testuser2"})
+            self.assertEqual(resp.status_code, 302)
+
+        auth_limiter.reset()
+
+    def test_rate_limit_client_ip(self):
+        """Are IP buckets keyed on the address the Heroku router saw, not on
+        the router's own or one the client made up?"""
+
+        auth_limiter.reset()
+        self.addCleanup(auth_limiter.reset)
+        limits = auth_limiter.limits
+        auth_limiter.limits = {**limits, "ip": (2, 1 / 60)}
+        self.addCleanup(setattr, auth_limiter, "limits", limits)
+
+        def login(username, forwarded_for):
+            return self.client.post(
+                "/login",
+                data={"username": username, "password": "wrongpassword"},
+                headers={"X-Forwarded-For": forwarded_for})
+
+        for n in range(2):
+            self.assertEqual(login(f"nobody{n}", "203.0.113.1").status_code,
+                             200)
+
+        self.assertEqual(login("nobody2", "203.0.113.1").status_code, 429)
+        # Prepending an address doesn't get the client a fresh bucket...
+        self.assertEqual(
+            login("nobody3", "198.51.100.7, 203.0.113.1").status_code, 429)
+        # ...but another client behind the same router has its own.
+        self.assertEqual(login("nobody4", "203.0.113.2").status_code, 200)
+
+    def test_message_card_cache(self):
+        """Are message cards reused across viewers and re-rendered after
+        their author edits their profile?"""
+
+        fragment_cache.clear()
+        db.session.add(Message(text="cached warble",
+                               user_id=self.testuser_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_2_id
+
+            c.get(f"/users/{self.testuser_id}")
+            hits = fragment_cache.hits
+            html = c.get(f"/users/{self.testuser_id}").get_data(as_text=True)
+
+            self.assertEqual(fragment_cache.hits, hits + 1)
+            self.assertIn("cached warble", html)
+            # The viewer-specific like button is still spliced in.
+            self.assertIn("/messages/likes/", html)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post("/users/profile", data={"username": "renamed",
+                                           "email": "test@test.com",
+                                           "validate_password": "testuser"})
+            html = c.get(f"/users/{self.testuser_id}").get_data(as_text=True)
+
+            self.assertIn("@renamed</a>", html)
+            # Authors can't like their own messages.
+            self.assertNotIn("/messages/likes/", html)
+
+    def test_profile_etag(self):
+        """Do profile pages answer If-None-Match with a 304 until something
+        on them changes?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_2_id
+
+            resp = c.get(f"/users/{self.testuser_id}")
+            etag = resp.headers["ETag"]
+
+            self.assertEqual(resp.headers["Cache-Control"], "private, no-cache")
+            self.assertIn("Cookie", resp.headers["Vary"])
+
+            resp = c.get(f"/users/{self.testuser_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
+
+            # Following them changes the button and their follower count.
+            c.post(f"/users/follow/{self.testuser_id}")
+            resp = c.get(f"/users/{self.testuser_id}",
+                         headers={"If-None-Match": etag})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers["ETag"], etag)
+            etag = resp.headers["ETag"]
+
+            # So does the user editing their profile.
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post("/users/profile", data={"username": "renamed",
+                                           "email": "test@test.com",
+                                           "validate_password": "testuser"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_2_id
+
+            resp = c.get(f"/users/{self.testuser_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@renamed", resp.get_data(as_text=True))
+
+            # Pages without a policy still aren't cached at all.
+            resp = c.get("/")
+            self.assertEqual(resp.headers["Cache-Control"], "no-store")
+            self.assertNotIn("ETag", resp.headers)
+
+    def test_fingerprinted_static_assets(self):
+        """Are built assets linked by hash, cached for a year and sent
+        gzipped?"""
+
+        original_folder = static_assets.dist_folder
+
+        with TemporaryDirectory() as dist_folder:
+            manifest = build(app.static_folder, dist_folder)
+            static_assets.load(dist_folder)
+
+            try:
+                stylesheet = manifest['stylesheets/style.css']
+                self.assertRegex(stylesheet,
+                                 r"^stylesheets/style\.[0-9a-f]{12}\.css$")
+
+                html = self.client.get("/login").get_data(as_text=True)
+                self.assertIn(f'href="/static/dist/{stylesheet}"', html)
+
+                resp = self.client.get(f"/static/dist/{stylesheet}",
+                                       headers={"Accept-Encoding": "gzip"})
+                css = gzip.decompress(resp.data).decode()
+
+                self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+                self.assertEqual(resp.mimetype, "text/css")
+                self.assertEqual(resp.headers["Cache-Control"],
+                                 "public, max-age=31536000, immutable")
+                # Images the stylesheet uses point at their hashed names.
+                self.assertIn(manifest['images/nav-bg.png'], css)
+                resp.close()
+
+                resp = self.client.get(f"/static/dist/{stylesheet}")
+                self.assertNotIn("Content-Encoding", resp.headers)
+                self.assertEqual(resp.get_data(as_text=True), css)
+                resp.close()
+
+            finally:
+                static_assets.load(original_folder)
+
+        # Without a build, templates fall back to the plain files.
+        html = self.client.get("/login").get_data(as_text=True)
+        self.assertIn('href="/static/stylesheets/style.css"', html)
+
+    def test_compressed_responses(self):
+        """Are pages compressed for clients that accept it, and do their
+        weakened ETags still revalidate?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_2_id
+
+            url = f"/users/{self.testuser_id}"
+            resp = c.get(url, headers={"Accept-Encoding": "gzip, deflate"})
+
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+            self.assertIn("Accept-Encoding", resp.headers["Vary"])
+            self.assertIn("@testuser", gzip.decompress(resp.data).decode())
+
+            etag = resp.headers["ETag"]
+            self.assertTrue(etag.startswith("W/"))
+
+            resp = c.get(url, headers={"Accept-Encoding": "gzip",
+                                       "If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            resp = c.get(url, headers={"Accept-Encoding": "deflate"})
+            self.assertEqual(resp.headers["Content-Encoding"], "deflate")
+            self.assertIn("@testuser", zlib.decompress(resp.data).decode())
+
+            resp = c.get(url, headers={"Accept-Encoding": "gzip;q=0"})
+            self.assertNotIn("Content-Encoding", resp.headers)
+            self.assertIn("@testuser", resp.get_data(as_text=True))
+
+            # Small responses aren't worth compressing.
+            resp = c.get("/logout", headers={"Accept-Encoding": "gzip"})
+            self.assertEqual(resp.status_code, 405)
+            self.assertNotIn("Content-Encoding", resp.headers)
+
+    def test_compression_write_callable(self):
+        """Is data an app sends through start_response's write() kept?"""
+
+        def legacy_app(environ, start_response):
+            write = start_response("200 OK", [("Content-Type", "text/plain")])
+            write(b"written " * 100)
+            return [b"returned"]
+
+        resp = Client(CompressionMiddleware(legacy_app)).get(
+            "/", headers={"Accept-Encoding": "gzip"})
+
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(resp.data),
+                         b"written " * 100 + b"returned")
+
+    def test_csrf_token_masked(self):
+        """Does each page carry differently masked CSRF tokens, so they
+        can't be read back out of compressed pages, and do they work?"""
+
+        app.config['WTF_CSRF_ENABLED'] = True
+        self.addCleanup(app.config.__setitem__, 'WTF_CSRF_ENABLED', False)
+        auth_limiter.reset()
+        self.addCleanup(auth_limiter.reset)
+
+        def token():
+            html = c.get("/login").get_data(as_text=True)
+            return re.search(
+                r'name="csrf_token" type="hidden" value="([^"]+)"', html)[1]
+
+        def login(csrf_token):
+            return c.post("/login", data={"username": "testuser_2",
+                                          "password": "testuser2",
+                                          "csrf_token": csrf_token})
+
+        with self.client as c:
+            first, second = token(), token()
+
+            # The same session token, in different bytes from the start.
+            self.assertEqual(unmask(first), unmask(second))
+            self.assertNotEqual(first[:8], second[:8])
+
+            for bad in (unmask(first), "x" + first[1:], ""):
+                self.assertEqual(login(bad).status_code, 200)
+
+            self.assertEqual(login(first).status_code, 302)
+
+    def test_streamed_user_directory(self):
+        """Is the user directory streamed in batches and still paginated?"""
+
+        user = User.query.get(self.testuser_id)
+        for i in range(5):
+            other = User(username=f"other{i}",
+                         email=f"other{i}@test.com",
+                         password="HASHED_PASSWORD")
+            db.session.add(other)
+            if i % 2:
+                user.following.append(other)
+        db.session.commit()
+
+        batches = []
+        page = StreamedPage(User.query, None, per_page=5, batch_size=2,
+                            on_batch=batches.append)
+        users = list(page.items)
+
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        self.assertEqual(page.next_cursor, str(users[-1].id))
+
+        app.config['USERS_DIRECTORY_PAGE_SIZE'] = 3
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser_id
+
+                url = "/users"
+                seen = []
+                unfollow_buttons = 0
+
+                while url:
+                    resp = c.get(url)
+                    html = resp.get_data(as_text=True)
+
+                    self.assertNotIn("Content-Length", resp.headers)
+                    seen += re.findall(r"<p>@(\w+)</p>", html)
+                    unfollow_buttons += html.count("Unfollow")
+                    more = re.search(r'href="([^"]+)"[^>]*id="more"', html)
+                    url = more and unescape(more[1])
+
+                self.assertEqual(len(seen), 7)
+                self.assertEqual(set(seen),
+                                 {u.username for u in User.query})
+                self.assertEqual(unfollow_buttons, 2)
+
+        finally:
+            app.config['USERS_DIRECTORY_PAGE_SIZE'] = 48
+
+    def test_read_replica_routing(self):
+        """Are GETs read from a replica, except just after a write?"""
+
+        with TemporaryDirectory() as directory:
+            app.config['SQLALCHEMY_BINDS'] = {
+                'replica1': f"sqlite:///{directory}/replica.db"}
+            replicas.binds = ['replica1']
+            replica = db.get_engine(app, bind='replica1')
+
+            # A replica that's behind: it has the users, but an old bio.
+            db.metadata.create_all(replica)
+            users = [dict(row._mapping) for row
+                     in db.session.execute(User.__table__.select())]
+            with replica.begin() as connection:
+                connection.execute(User.__table__.insert(), users)
+                connection.execute(User.__table__.update()
+                                   .values(bio="Stale replica bio"))
+            user_cache.invalidate(self.testuser_id, self.testuser_2_id)
+
+            try:
+                with self.client as c:
+                    with c.session_transaction() as sess:
+                        sess[CURR_USER_KEY] = self.testuser_id
+
+                    resp = c.get(f"/users/{self.testuser_2_id}")
+                    self.assertIn("Stale replica bio",
+                                  resp.get_data(as_text=True))
+
+                    # After a write, this browser reads from the primary.
+                    resp = c.post(f"/users/follow/{self.testuser_2_id}")
+                    self.assertEqual(resp.status_code, 302)
+                    self.assertEqual(
+                        replica.execute("SELECT count(*) FROM follows")
+                        .scalar(), 0)
+
+                    resp = c.get(f"/users/{self.testuser_2_id}")
+                    self.assertNotIn("Stale replica bio",
+                                     resp.get_data(as_text=True))
+                    self.assertIn("Unfollow", resp.get_data(as_text=True))
+
+                    # Until the replicas have had time to catch up.
+                    with c.session_transaction() as sess:
+                        sess["db_primary_until"] = 0
+
+                    resp = c.get(f"/users/{self.testuser_2_id}")
+                    self.assertIn("Stale replica bio",
+                                  resp.get_data(as_text=True))
+
+                    metrics = c.get("/metrics", headers=METRICS_AUTH
+                                    ).get_data(as_text=True)
+                    self.assertIn('warbler_db_read_requests_total'
+                                  '{database="replica1"}', metrics)
+
+            finally:
+                replicas.binds = []
+                app.config['SQLALCHEMY_BINDS'] = {}
+                replica.dispose()
+                user_cache.invalidate(self.testuser_id, self.testuser_2_id)
+
+    def test_json_api(self):
+        """Do the API endpoints page through messages and hydrate users?"""
+
+        start = datetime(2024, 1, 1)
+        messages = [Message(text=f"api message {i}",
+                            user_id=self.testuser_2_id,
+                            timestamp=start + timedelta(minutes=i))
+                    for i in range(5)]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get("/api/v1/timeline")
+            self.assertEqual(resp.status_code, 401)
+            self.assertEqual(resp.json, {"error": "Log in first."})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post(f"/users/follow/{self.testuser_2_id}")
+
+            for url in ("/api/v1/timeline",
+                        f"/api/v1/users/{self.testuser_2_id}/messages"):
+                texts = []
+                before = ""
+
+                while before is not None:
+                    with query_budget(3):
+                        resp = c.get(f"{url}?limit=2&before={before}")
+
+                    self.assertEqual(resp.content_type, "application/json")
+                    self.assertNotIn(b", ", resp.data)
+                    self.assertEqual(set(resp.json["messages"][0]),
+                                     {"id", "text", "timestamp", "user_id",
+                                      "like_count"})
+                    texts += [m["text"] for m in resp.json["messages"]]
+                    before = resp.json["next"]
+
+                self.assertEqual(texts,
+                                 [f"api message {i}" for i in range(4, -1, -1)])
+
+            resp = c.get(f"/api/v1/users/{self.testuser_2_id}")
+            self.assertEqual(resp.json["username"], "testuser_2")
+            self.assertEqual(resp.json["followers_count"], 1)
+
+            with query_budget(2):
+                resp = c.get(f"/api/v1/users?ids={self.testuser_2_id},0,"
+                             f"{self.testuser_id},{self.testuser_2_id}")
+
+            self.assertEqual([user["username"] for user in resp.json["users"]],
+                             ["testuser_2", "testuser"])
+
+            resp = c.get("/api/v1/users?ids=x")
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn("comma-separated user ids", str(resp.data))
+            self.assertEqual(c.get("/api/v1/users/0").status_code, 404)
+            self.assertEqual(c.get("/api/v1/users/0/messages").status_code,
+                             404)
+
+    def test_follow_writes(self):
+        """Are follows idempotent, batchable, and written without loading
+        the follower's other follows?"""
+
+        others = [User(username=f"other{i}",
+                       email=f"other{i}@test.com",
+                       password="HASHED_PASSWORD")
+                  for i in range(30)]
+        db.session.add_all(others)
+        db.session.flush()
+        other_ids = [other.id for other in others]
+        db.session.add_all([Message(text=f"by other{i}", user_id=other_id)
+                            for i, other_id in enumerate(other_ids)])
+        User.change_counts(other_ids, messages_count=1)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            # Everyone but the testuser themself and a missing id.
+            ids = ",".join(map(str, other_ids + [self.testuser_id, 0]))
+            # user, insert, one timeline backfill and prune for all of
+            # them, two counter updates.
+            with query_budget(6):
+                resp = c.post("/users/follow", data={"ids": ids})
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(
+                TimelineEntry.query.filter_by(user_id=self.testuser_id)
+                .count(), 30)
+
+            # A double click is a no-op. However many users they follow,
+            # one more is: user, insert, timeline backfill and prune,
+            # two counter updates.
+            for attempt in range(2):
+                with query_budget(6):
+                    resp = c.post(f"/users/follow/{self.testuser_2_id}")
+                self.assertEqual(resp.status_code, 302)
+
+            user = User.query.get(self.testuser_id)
+            self.assertEqual(user.following_count, 31)
+            self.assertEqual(len(user.following), 31)
+            self.assertEqual(User.query.get(self.testuser_2_id).followers_count,
+                             1)
+
+            resp = c.post("/users/follow", data={"ids": "1,x"},
+                          follow_redirects=True)
+            self.assertIn("Pick between 1 and 100 users to follow",
+                          str(resp.data))
+
+            for attempt in range(2):
+                c.post(f"/users/stop-following/{self.testuser_2_id}")
+
+            db.session.expire_all()
+            self.assertEqual(User.query.get(self.testuser_id).following_count,
+                             30)
+            self.assertEqual(User.reconcile_counters(),
+                             {name: 0 for name in User.counter_sources()})
+
+    def make_account(self):
+        """Give the testuser messages liked by testuser_2, followers and
+        likes of their own; return the ids of the messages they posted."""
+
+        user = User.query.get(self.testuser_id)
+        fan = User.query.get(self.testuser_2_id)
+        posted = [Message(text=f"post {i}", user_id=user.id) for i in range(5)]
+        theirs = Message(text="not mine", user_id=fan.id)
+        db.session.add_all([*posted, theirs])
+        db.session.flush()
+        for message in [*posted, theirs]:
+            TimelineEntry.fan_out(message)
+            MessageTerm.index(message)
+        User.change_counts([user.id], messages_count=5)
+        User.change_counts([fan.id], messages_count=1)
+
+        fan.follow([user.id])
+        user.follow([fan.id])
+        fan.like([message.id for message in posted])
+        user.like([theirs.id])
+        db.session.commit()
+
+        self.theirs_id = theirs.id
+        return [message.id for message in posted]
+
+    def assert_account_gone(self, posted_ids):
+        db.session.expire_all()
+        self.assertIsNone(User.query.get(self.testuser_id))
+        self.assertEqual(Message.query.filter(Message.id.in_(posted_ids))
+                         .count(), 0)
+        self.assertEqual(TimelineEntry.query.filter(
+            TimelineEntry.message_id.in_(posted_ids)).count(), 0)
+
+        fan = User.query.get(self.testuser_2_id)
+        self.assertEqual((fan.followers_count, fan.following_count,
+                          fan.likes_count, fan.messages_count),
+                         (0, 0, 0, 1))
+        self.assertEqual(Message.query.get(self.theirs_id).like_count, 0)
+        self.assertEqual(User.reconcile_counters(),
+                         {name: 0 for name in User.counter_sources()})
+        self.assertEqual(Message.reconcile_counters(), {'like_count': 0})
+
+    def test_delete_account(self):
+        """Is an account deleted with a fixed number of statements, however
+        much it has, and are other users' counters kept right?"""
+
+        posted_ids = self.make_account()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            # user, lock, four counter updates, the DELETE.
+            with query_budget(7):
+                resp = c.post("/users/delete")
+            self.assertEqual(resp.status_code, 302)
+
+        self.assert_account_gone(posted_ids)
+
+    def test_purge_big_account(self):
+        """Is a big account hidden at once, then purged in batches?"""
+
+        posted_ids = self.make_account()
+        threshold = user_purger.threshold
+        batch_size = user_purger.batch_size
+        user_purger.threshold = 3
+        user_purger.batch_size = 2
+        self.addCleanup(setattr, user_purger, "threshold", threshold)
+        self.addCleanup(setattr, user_purger, "batch_size", batch_size)
+        purged = user_purger.messages_purged
+
+        def shown(c):
+            """Where testuser_2 sees testuser's first message."""
+
+            timeline = c.get("/api/v1/timeline").get_json()["messages"]
+            return {
+                "home": "post 0" in c.get("/").get_data(as_text=True),
+                "api timeline": posted_ids[0] in [m["id"] for m in timeline],
+                "search": "post 0" in c.get(
+                    "/messages/search?q=post").get_data(as_text=True),
+                "likes": "post 0" in c.get(
+                    f"/users/{self.testuser_2_id}/likes").get_data(
+                        as_text=True),
+                "message": c.get(
+                    f"/messages/{posted_ids[0]}").status_code == 200,
+            }
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_2_id
+
+            visible = shown(c)
+            self.assertTrue(all(visible.values()), visible)
+
+            # Marked deleted, as if the worker hadn't got to it yet.
+            User.query.filter_by(id=self.testuser_id).update(
+                {User.deleted_at: datetime.utcnow()})
+            db.session.commit()
+
+            # Its messages are gone from every page at once, though their
+            # timeline entries, postings and likes are still there.
+            hidden = shown(c)
+            self.assertFalse(any(hidden.values()), hidden)
+            self.assertIn("not mine", c.get("/").get_data(as_text=True))
+
+            for path in (f"/users/{self.testuser_id}",
+                         f"/api/v1/users/{self.testuser_id}",
+                         f"/api/v1/users/{self.testuser_id}/messages"):
+                self.assertEqual(c.get(path).status_code, 404, path)
+
+            resp = c.get(f"/api/v1/users?ids={self.testuser_id},"
+                         f"{self.testuser_2_id}")
+            self.assertEqual([user["id"] for user in resp.get_json()["users"]],
+                             [self.testuser_2_id])
+
+            # Nor listed anywhere: search, or who testuser_2 follows
+            # and is followed by (testuser, both ways).
+            for path in ("/users?q=testuser",
+                         f"/users/{self.testuser_2_id}/following",
+                         f"/users/{self.testuser_2_id}/followers"):
+                html = c.get(path).get_data(as_text=True)
+                self.assertNotIn(f"/users/{self.testuser_id}\"", html, path)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            # Logged out everywhere, and can't log back in.
+            resp = c.get("/users/profile")
+            self.assertEqual(resp.status_code, 302)
+            c.post("/login", data={"username": "testuser",
+                                   "password": "testuser"})
+            with c.session_transaction() as sess:
+                self.assertNotIn(CURR_USER_KEY, sess)
+
+        User.query.filter_by(id=self.testuser_id).update({User.deleted_at: None})
+        db.session.commit()
+        user_cache.invalidate(self.testuser_id)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.post("/users/delete")
+            self.assertEqual(resp.status_code, 302)
+            user_purger.join(timeout=30)
 
+        self.assertEqual(user_purger.messages_purged - purged, 5)
+        self.assert_account_gone(posted_ids)
@@ -0,0 +1,116 @@
+"""In-process cache of logged-in users, shared across requests.
+
+Every request looks up the logged-in user in add_user_to_g. UserCache keeps
+a bounded LRU of column snapshots of recently seen users, each valid for a
+short TTL. On a hit the snapshot is merged into the request's session
+without running a query, so g.user is still an ordinary session-bound User
+whose relationships lazy-load as usual.
+
+Routes that change a user's row (profile edits, deletes, counter updates)
+call invalidate() for the users they touched. The cache is per process, so
+with several workers a change made in one worker can be stale in another
+for up to the TTL.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+from sqlalchemy.orm import make_transient_to_detached
+
+from models import db, User
+
+
+class UserCache:
+    """Bounded TTL + LRU cache of User snapshots keyed by id."""
+
+    def __init__(self, maxsize=1024, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # {user id: (expires at, detached User snapshot)}
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id):
+        """Return the User with `user_id` attached to the current session,
+        or None if there is no such user."""
+
+        now = monotonic()
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                snapshot = entry[1]
+            else:
+                self.misses += 1
+                snapshot = None
+
+        if snapshot is not None:
+            return db.session.merge(snapshot, load=False)
+
+        user = User.query.get(user_id)
+
+        if user is not None:
+            self._store(user, now)
+
+        return user
+
+    def _store(self, user, now):
+        """Keep a detached copy of `user`'s columns."""
+
+        snapshot = User(**{column.key: getattr(user, column.key)
+                           for column in User.__table__.columns})
+        make_transient_to_detached(snapshot)
+
+        with self._lock:
+            self._entries[user.id] = (now + self.ttl, snapshot)
+            self._entries.move_to_end(user.id)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *user_ids):
+        """Drop cached snapshots of `user_ids`."""
+
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def clear(self):
+        """Drop every cached snapshot."""
+
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return hit/miss counters and current size."""
+
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+            }
+
+    def render_metrics(self):
+        """Return the stats as Prometheus text lines."""
+
+        lines = []
+
+        for name, value in self.stats().items():
+            kind = "gauge" if name == "size" else "counter"
+            metric = f"warbler_user_cache_{name}"
+            if kind == "counter":
+                metric += "_total"
+            lines.append(f"# TYPE {metric} {kind}")
+            lines.append(f"{metric} {value}")
+
+        return lines